@@ -0,0 +1,176 @@
+import io
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from PIL import Image
+import metrics
+import upscale
+
+# Generation and video jobs reserve their estimated peak memory before they
+# run. Jobs that don't fit wait in a queue; after ADMISSION_TIMEOUT_SECONDS,
+# or when the queue is full, they are turned away.
+MEMORY_BUDGET_BYTES = int(os.getenv('ADMISSION_MEMORY_BUDGET_MB', '1024')) * 1024 * 1024
+# Also hold jobs back while process RSS plus the job would exceed this (0 disables)
+RSS_LIMIT_BYTES = int(os.getenv('ADMISSION_RSS_LIMIT_MB', '2048')) * 1024 * 1024
+ADMISSION_TIMEOUT_SECONDS = float(os.getenv('ADMISSION_TIMEOUT_SECONDS', '30'))
+MAX_QUEUED_JOBS = 32
+# RSS can fall without any job finishing (e.g. the history spilling), so
+# queued jobs re-check at least this often
+RECHECK_SECONDS = 0.25
+
+# Fraction of jobs whose peak allocation is measured with tracemalloc
+TRACEMALLOC_SAMPLE_RATE = float(os.getenv('TRACEMALLOC_SAMPLE_RATE', '0.02'))
+# Typical image-to-video response; the real size isn't known until it arrives
+VIDEO_RESPONSE_BYTES = 8 * 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job can't be admitted within the memory budget"""
+
+
+def process_rss() -> int:
+    """Current resident set size in bytes (0 where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def estimate_image_job(width: int, height: int, upscale_factor: int = 1) -> int:
+    """Peak bytes for one generation: response body, decoded and sharpened
+    frames, the re-encoded PNG and the copy Streamlit serves, plus upscaling"""
+    frame = width * height * 3
+    total = 5 * frame
+    if upscale_factor > 1:
+        out_width = width * upscale_factor
+        # float32 window, vertical pass and tile output, plus the uint8 band
+        total += upscale.TILE_SIZE * out_width * 3 * (3 * 4 + 1)
+        # The finished PNG is read back for the download button
+        total += frame * upscale_factor ** 2
+    return total
+
+
+def estimate_video_job(raw: bytes) -> int:
+    """Peak bytes for one video job from the upload size and its decoded dimensions"""
+    try:
+        width, height = Image.open(io.BytesIO(raw)).size
+    except Exception:
+        width, height = 4096, 4096
+    # Upload, decoded frame and resized input, then the JSON body, its
+    # base64 payload and the decoded video
+    return len(raw) + width * height * 4 + 1024 * 1024 * 3 * 2 + VIDEO_RESPONSE_BYTES * 4
+
+
+class AdmissionController:
+    """Admit jobs while their estimated peak memory fits the budget"""
+
+    def __init__(self, budget: int = MEMORY_BUDGET_BYTES, rss_limit: int = RSS_LIMIT_BYTES,
+                 timeout: float = ADMISSION_TIMEOUT_SECONDS, max_queued: int = MAX_QUEUED_JOBS):
+        self.budget = budget
+        self.rss_limit = rss_limit
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._running = 0
+        self._queued = 0
+
+    @property
+    def in_flight_bytes(self) -> int:
+        return self._in_flight
+
+    def _fits(self, estimate: int) -> bool:
+        # A lone job is always admitted, however large, so nothing starves
+        if self._running == 0:
+            return True
+        if self._in_flight + estimate > self.budget:
+            return False
+        return not self.rss_limit or process_rss() + estimate <= self.rss_limit
+
+    def _acquire(self, kind: str, estimate: int):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            if not self._fits(estimate):
+                if self._queued >= self.max_queued:
+                    metrics.inc("admission_total", kind=kind, outcome="shed")
+                    raise AdmissionRejected("The server is busy right now. Please try again in a minute.")
+                self._queued += 1
+                try:
+                    while not self._fits(estimate):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            metrics.inc("admission_total", kind=kind, outcome="timed_out")
+                            raise AdmissionRejected(
+                                "The server is under heavy load and couldn't start your job. Please try again shortly.")
+                        self._cond.wait(min(remaining, RECHECK_SECONDS))
+                finally:
+                    self._queued -= 1
+            self._in_flight += estimate
+            self._running += 1
+            metrics.set_gauge("admission_in_flight_bytes", self._in_flight)
+            metrics.set_gauge("admission_queued_jobs", self._queued)
+        metrics.inc("admission_total", kind=kind, outcome="admitted")
+        metrics.observe("admission_wait_seconds", time.monotonic() - started, kind=kind)
+
+    def _release(self, estimate: int):
+        with self._cond:
+            self._in_flight -= estimate
+            self._running -= 1
+            metrics.set_gauge("admission_in_flight_bytes", self._in_flight)
+            self._cond.notify_all()
+        metrics.set_gauge("process_rss_bytes", process_rss())
+
+    @contextmanager
+    def admit(self, kind: str, estimate: int):
+        """Hold a share of the memory budget for the duration of a job"""
+        self._acquire(kind, estimate)
+        sampled = _start_sample()
+        try:
+            yield
+        finally:
+            if sampled:
+                _finish_sample(kind, estimate)
+            self._release(estimate)
+
+
+_sample_lock = threading.Lock()
+
+
+def _start_sample() -> bool:
+    # tracemalloc is process-wide, so only one job is traced at a time
+    if random.random() >= TRACEMALLOC_SAMPLE_RATE or tracemalloc.is_tracing():
+        return False
+    if not _sample_lock.acquire(blocking=False):
+        return False
+    tracemalloc.start()
+    return True
+
+
+def _finish_sample(kind: str, estimate: int):
+    """Record a traced job's peak; allocations by concurrent jobs are included,
+    and Pillow's pixel buffers are not (process_rss_bytes covers those)"""
+    try:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        _sample_lock.release()
+    metrics.observe("job_peak_traced_bytes", peak, kind=kind)
+    metrics.observe("job_peak_estimate_bytes", estimate, kind=kind)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """Get the process-wide controller shared by all sessions"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController()
+        return _controller
@@ -1,18 +1,25 @@
-from sqlalchemy import func
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
-from models import User, Image, Payment
+from models import User, Image, ImageRecord, Payment
 import pandas as pd
 import plotly.express as px
+import metrics
+from search import get_prompt_index
+from phash import get_hash_index, to_signed, to_unsigned, NEAR_DUPLICATE_DISTANCE
+from partitions import HOT_DAYS
+
+PAGE_SIZE = 20
 
 class Analytics:
     def __init__(self, db: Session):
         self.db = db
     
+    @metrics.timed("db.analytics.get_user_stats")
     def get_user_stats(self, user_id: int) -> dict:
         """Get basic stats for a user"""
         user = self.db.query(User).filter(User.id == user_id).first()
-        total_images = self.db.query(Image).filter(Image.user_id == user_id).count()
+        total_images = self.db.query(ImageRecord).filter(ImageRecord.user_id == user_id).count()
         total_spent = self.db.query(func.sum(Payment.amount)).filter(
             Payment.user_id == user_id,
             Payment.status == 'completed'
@@ -25,59 +32,82 @@ class Analytics:
             'total_spent': total_spent
         }
     
+    @metrics.timed("db.analytics.get_daily_usage")
     def get_daily_usage(self, user_id: int, days: int = 30) -> list:
         """Get daily image generation stats"""
         start_date = datetime.utcnow() - timedelta(days=days)
+        # Recent windows only touch the live table (or its newest partitions)
+        model = Image if days <= HOT_DAYS else ImageRecord
         
         daily_stats = self.db.query(
-            func.date(Image.created_at).label('date'),
-            func.count(Image.id).label('count')
+            func.date(model.created_at).label('date'),
+            func.count(model.id).label('count')
         ).filter(
-            Image.user_id == user_id,
-            Image.created_at >= start_date
+            model.user_id == user_id,
+            model.created_at >= start_date
         ).group_by(
-            func.date(Image.created_at)
+            func.date(model.created_at)
         ).all()
         
         return daily_stats
     
+    @metrics.timed("db.analytics.get_style_distribution")
     def get_style_distribution(self, user_id: int) -> dict:
         """Get distribution of styles used"""
         styles = self.db.query(
-            Image.style,
-            func.count(Image.id).label('count')
+            ImageRecord.style,
+            func.count(ImageRecord.id).label('count')
         ).filter(
-            Image.user_id == user_id
+            ImageRecord.user_id == user_id
         ).group_by(
-            Image.style
+            ImageRecord.style
         ).all()
         
         return {style: count for style, count in styles}
     
+    @metrics.timed("db.analytics.get_resolution_stats")
     def get_resolution_stats(self, user_id: int) -> dict:
         """Get statistics about image resolutions used"""
         resolutions = self.db.query(
-            Image.width,
-            Image.height,
-            func.count(Image.id).label('count')
+            ImageRecord.width,
+            ImageRecord.height,
+            func.count(ImageRecord.id).label('count')
         ).filter(
-            Image.user_id == user_id
+            ImageRecord.user_id == user_id
         ).group_by(
-            Image.width,
-            Image.height
+            ImageRecord.width,
+            ImageRecord.height
         ).all()
         
         return {f"{width}x{height}": count for width, height, count in resolutions}
     
-    def get_payment_history(self, user_id: int) -> list:
-        """Get user's payment history"""
-        payments = self.db.query(Payment).filter(
-            Payment.user_id == user_id
-        ).order_by(
-            Payment.created_at.desc()
-        ).all()
+    def _keyset_page(self, model, user_id: int, limit: int, cursor: tuple) -> tuple:
+        """Fetch rows newest first, starting after a (created_at, id) cursor"""
+        query = self.db.query(model).filter(model.user_id == user_id)
+        if cursor:
+            # Row-value comparison lets the (user_id, created_at, id) index
+            # seek straight to the cursor instead of skipping OFFSET rows
+            query = query.filter(tuple_(model.created_at, model.id) < tuple_(*cursor))
+        rows = query.order_by(
+            model.created_at.desc(),
+            model.id.desc()
+        ).limit(limit + 1).all()
         
-        return payments
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1].created_at, rows[-1].id)
+        return rows, next_cursor
+    
+    @metrics.timed("db.analytics.get_images_page")
+    def get_images_page(self, user_id: int, limit: int = PAGE_SIZE, cursor: tuple = None) -> tuple:
+        """Get one page of a user's images and the cursor for the next page"""
+        return self._keyset_page(ImageRecord, user_id, limit, cursor)
+    
+    @metrics.timed("db.analytics.get_payment_history")
+    def get_payment_history(self, user_id: int, limit: int = PAGE_SIZE, cursor: tuple = None) -> tuple:
+        """Get one page of a user's payment history and the cursor for the next page"""
+        return self._keyset_page(Payment, user_id, limit, cursor)
     
     def generate_usage_report(self, user_id: int) -> dict:
         """Generate a comprehensive usage report"""
@@ -106,9 +136,12 @@ class Analytics:
             'usage_graph': fig
         }
     
+    @metrics.timed("db.analytics.track_image_generation")
     def track_image_generation(self, user_id: int, prompt: str, style: str,
-                             width: int, height: int, image_url: str):
-        """Track a new image generation"""
+                             width: int, height: int, image_url: str, phash: int = None):
+        """Track a new image generation; `phash` (unsigned) feeds near-duplicate lookups"""
+        prompt_index = get_prompt_index(self.db)
+        
         new_image = Image(
             user_id=user_id,
             prompt=prompt,
@@ -116,12 +149,36 @@ class Analytics:
             width=width,
             height=height,
             image_url=image_url,
+            phash=to_signed(phash) if phash is not None else None,
             created_at=datetime.utcnow()
         )
         
         self.db.add(new_image)
+        self.db.flush()
+        
+        # Index the prompt in the same transaction as the row
+        prompt_index.add(new_image)
         self.db.commit()
+        if phash is not None:
+            get_hash_index(self.db).add(new_image.id, phash, user_id)
+        return new_image
+    
+    @metrics.timed("db.analytics.find_near_duplicates")
+    def find_near_duplicates(self, user_id: int, image_id: int,
+                             max_distance: int = NEAR_DUPLICATE_DISTANCE) -> list:
+        """Get the user's images that look nearly the same as image_id, closest first"""
+        image = self.db.get(ImageRecord, image_id)
+        if image is None or image.phash is None:
+            return []
+        matches = [
+            match_id for match_id, _ in
+            get_hash_index(self.db).query(to_unsigned(image.phash), max_distance, owner=user_id)
+            if match_id != image_id
+        ]
+        images = {i.id: i for i in self.db.query(ImageRecord).filter(ImageRecord.id.in_(matches))}
+        return [images[i] for i in matches if i in images]
     
+    @metrics.timed("db.analytics.track_payment")
     def track_payment(self, user_id: int, amount: float, payment_type: str):
         """Track a new payment"""
         new_payment = Payment(
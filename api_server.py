@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import secrets
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from sqlalchemy.orm import sessionmaker
+from models import ApiKey, User, create_schema, get_engine
+from subscription import deduct_credit, refund_credit
+import admission
+import dispatch
+import keypool
+import media
+import metrics
+import stability
+
+# Programmatic generation for plans with API access. Requests are
+# authenticated with API keys, jobs run on one shared worker pool and
+# results are fetched by job id:
+#   POST /v1/images              {"prompt", "style", "width", "height"} -> 202 {"id", ...}
+#   POST /v1/videos?seed=&motion_bucket_id=&prompt=   (body: the image) -> 202 {"id", ...}
+#   GET  /v1/jobs/{id}?wait=30   job status, optionally waiting for it to finish
+#   GET  /v1/jobs/{id}/result    the PNG or MP4
+API_PORT = int(os.getenv('API_PORT', '8503'))
+API_WORKERS = int(os.getenv('API_WORKERS', '16'))
+# Beyond this many queued or running jobs, submissions get 429
+API_MAX_PENDING_JOBS = int(os.getenv('API_MAX_PENDING_JOBS', '256'))
+API_PLANS = ('business', 'enterprise')
+KEY_PREFIX = 'sk-art-'
+# Verified keys are trusted this long, so a revoked key stops working within a minute
+KEY_CACHE_SECONDS = 60
+KEY_CACHE_SIZE = 10000
+# Finished jobs (and their results) are kept this long for clients to fetch,
+# and dropped oldest-first sooner if held results exceed API_JOB_RESULT_MAX_BYTES
+JOB_TTL_SECONDS = int(os.getenv('API_JOB_TTL_SECONDS', '900'))
+JOB_RESULT_MAX_BYTES = int(os.getenv('API_JOB_RESULT_MAX_BYTES', str(512 * 1024 * 1024)))
+JOB_EXPIRE_INTERVAL = 30
+MAX_WAIT_SECONDS = 30
+MAX_VIDEO_UPLOAD_BYTES = 20 * 1024 * 1024
+IMAGE_SIZES = {(1024, 1024), (1024, 576), (576, 1024)}
+CREDIT_COST = {'image': 1, 'video': 1}
+
+
+def hash_key(key: str) -> str:
+    # Keys are random 256-bit tokens, so a fast hash is enough
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def create_api_key(db, user_id: int) -> str:
+    """Issue a new API key for a user; only its hash is stored"""
+    key = KEY_PREFIX + secrets.token_urlsafe(32)
+    db.add(ApiKey(user_id=user_id, key_hash=hash_key(key), prefix=key[:len(KEY_PREFIX) + 6]))
+    db.commit()
+    return key
+
+
+class _KeyCache:
+    """key hash -> (user_id, plan), trusted for KEY_CACHE_SECONDS"""
+
+    def __init__(self, ttl: float = KEY_CACHE_SECONDS, size: int = KEY_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_hash: str):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def put(self, key_hash: str, value):
+        with self._lock:
+            self._entries[key_hash] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class _Job:
+    __slots__ = ('id', 'user_id', 'kind', 'status', 'result', 'content_type', 'meta', 'error',
+                 'created_at', 'finished_at', 'future')
+
+    def __init__(self, user_id: int, kind: str):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.status = 'queued'
+        self.result = None
+        self.content_type = None
+        self.meta = {}
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    def to_dict(self) -> dict:
+        payload = {'id': self.id, 'kind': self.kind, 'status': self.status, **self.meta}
+        if self.status == 'succeeded':
+            payload['result_url'] = f"/v1/jobs/{self.id}/result"
+        if self.error:
+            payload['error'] = self.error
+        return payload
+
+
+class ApiService:
+    """Shared state behind the HTTP API: key lookups, the job table and the worker pool"""
+
+    def __init__(self, database_url: str, upstream_key: str, workers: int = API_WORKERS,
+                 max_pending: int = API_MAX_PENDING_JOBS, max_result_bytes: int = JOB_RESULT_MAX_BYTES):
+        engine = create_schema(get_engine(database_url))
+        self.session_factory = sessionmaker(bind=engine, autoflush=False)
+        self.upstream_keys = keypool.as_pool(upstream_key)
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='api-worker')
+        self.keys = _KeyCache()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.max_result_bytes = max_result_bytes
+        self._result_bytes = 0
+        self._stopped = threading.Event()
+        threading.Thread(target=self._expire_loop, name='api-job-expiry', daemon=True).start()
+
+    def close(self):
+        self._stopped.set()
+        self.pool.shutdown(wait=False)
+
+    def _with_session(self, func, *args):
+        db = self.session_factory()
+        try:
+            return func(db, *args)
+        finally:
+            db.close()
+
+    def _lookup_key(self, db, key_hash: str):
+        row = db.query(User.id, User.subscription_type).join(ApiKey, ApiKey.user_id == User.id).filter(
+            ApiKey.key_hash == key_hash, ApiKey.revoked_at.is_(None)).first()
+        return tuple(row) if row else None
+
+    async def authenticate(self, request):
+        """(user_id, plan) for the request's bearer key, or None"""
+        scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not key.startswith(KEY_PREFIX):
+            return None
+        key_hash = hash_key(key.strip())
+        account = self.keys.get(key_hash)
+        if account is None:
+            metrics.inc("api_key_cache_total", outcome="miss")
+            account = await run_in_threadpool(self._with_session, self._lookup_key, key_hash)
+            if account is not None:
+                self.keys.put(key_hash, account)
+        else:
+            metrics.inc("api_key_cache_total", outcome="hit")
+        return account
+
+    def get_job(self, job_id: str, user_id: int):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    def _drop_job(self, job: _Job, reason: str):
+        del self._jobs[job.id]
+        if job.result is not None:
+            self._result_bytes -= len(job.result)
+        metrics.inc("api_jobs_expired_total", reason=reason)
+
+    def _expire_jobs(self, now: float = None):
+        """Drop finished jobs past JOB_TTL_SECONDS, then the oldest finished
+        ones while results exceed max_result_bytes (caller holds the lock)"""
+        cutoff = (now or time.time()) - JOB_TTL_SECONDS
+        finished = sorted((job for job in self._jobs.values() if job.finished_at is not None),
+                          key=lambda job: job.finished_at)
+        for job in finished:
+            if job.finished_at < cutoff:
+                self._drop_job(job, 'ttl')
+            elif self._result_bytes > self.max_result_bytes:
+                self._drop_job(job, 'memory')
+            else:
+                break
+        metrics.set_gauge("api_job_result_bytes", self._result_bytes)
+
+    def _expire_loop(self):
+        while not self._stopped.wait(JOB_EXPIRE_INTERVAL):
+            with self._lock:
+                self._expire_jobs()
+
+    async def submit(self, user_id: int, kind: str, estimate: int, work) -> _Job:
+        """Charge the user and queue `work()` -> (bytes, content_type, meta) on the pool
+
+        Raises OverflowError when the queue is full and ValueError when the
+        user has no credits left.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise OverflowError("Too many jobs in progress; retry shortly")
+            self._pending += 1
+        try:
+            await run_in_threadpool(self._with_session, deduct_credit, user_id, CREDIT_COST[kind])
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+        job = _Job(user_id, kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            metrics.set_gauge("api_jobs_pending", self._pending)
+        job.future = asyncio.get_running_loop().run_in_executor(self.pool, self._run, job, estimate, work)
+        return job
+
+    def _run(self, job: _Job, estimate: int, work):
+        job.status = 'running'
+        try:
+            with admission.get_admission_controller().admit(job.kind, estimate):
+                with metrics.span(f"api.job.{job.kind}"):
+                    job.result, job.content_type, meta = work()
+            job.meta.update(meta)
+            job.status = 'succeeded'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            try:
+                self._with_session(refund_credit, job.user_id, CREDIT_COST[job.kind])
+            except Exception as refund_error:
+                job.error += f" (credit refund failed: {refund_error})"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._pending -= 1
+                metrics.set_gauge("api_jobs_pending", self._pending)
+                if job.result is not None:
+                    self._result_bytes += len(job.result)
+                    if self._result_bytes > self.max_result_bytes:
+                        self._expire_jobs()
+            metrics.inc("api_jobs_total", kind=job.kind, status=job.status)
+            metrics.observe("api_job_seconds", job.finished_at - job.created_at, kind=job.kind)
+
+    def image_work(self, prompt: str, style: str, width: int, height: int):
+        def work():
+            body = stability.build_image_body(prompt, style, width, height)
+            artifact = dispatch.generate(self.upstream_keys, body)[0]
+            _, png = media.finish_image(artifact['image'])
+            return png, 'image/png', {'seed': artifact['seed']}
+        return work
+
+    def video_work(self, raw: bytes, seed: int, motion_bucket_id: int, prompt: str):
+        def work():
+            data, info = media.prepare_video_input(raw)
+            video = dispatch.animate(self.upstream_keys, data, seed=seed,
+                                     motion_bucket_id=motion_bucket_id, text_prompt=prompt)
+            return video, 'video/mp4', {'seed': seed, 'size': list(info['size'])}
+        return work
+
+
+def _reply(endpoint: str, status: int, payload: dict, headers: dict = None) -> JSONResponse:
+    metrics.inc("api_requests_total", endpoint=endpoint, status=str(status))
+    return JSONResponse(payload, status_code=status, headers=headers)
+
+
+async def _authorize(request, endpoint: str):
+    """(user_id, None) or (None, error response)"""
+    account = await request.app.state.service.authenticate(request)
+    if account is None:
+        return None, _reply(endpoint, 401, {'error': 'Missing or invalid API key'})
+    user_id, plan = account
+    if plan not in API_PLANS:
+        return None, _reply(endpoint, 403, {'error': 'API access requires the Business plan'})
+    return user_id, None
+
+
+async def _queue(request, endpoint: str, user_id: int, kind: str, estimate: int, work):
+    try:
+        job = await request.app.state.service.submit(user_id, kind, estimate, work)
+    except OverflowError as e:
+        return _reply(endpoint, 429, {'error': str(e)}, {'Retry-After': '5'})
+    except ValueError as e:
+        return _reply(endpoint, 402, {'error': str(e)})
+    return _reply(endpoint, 202, job.to_dict(), {'Location': f"/v1/jobs/{job.id}"})
+
+
+async def submit_image(request):
+    user_id, error = await _authorize(request, 'images')
+    if error:
+        return error
+    try:
+        body = await request.json()
+        prompt = str(body['prompt']).strip()
+        style = body.get('style') or ''
+        width, height = int(body.get('width', 1024)), int(body.get('height', 1024))
+    except (ValueError, KeyError, TypeError):
+        return _reply('images', 400, {'error': 'Expected a JSON body with a "prompt"'})
+    if not prompt:
+        return _reply('images', 400, {'error': 'prompt must not be empty'})
+    if style and style not in stability.STYLE_PROMPTS:
+        return _reply('images', 400, {'error': f"style must be one of {sorted(stability.STYLE_PROMPTS)}"})
+    if (width, height) not in IMAGE_SIZES:
+        return _reply('images', 400, {'error': f"width x height must be one of {sorted(IMAGE_SIZES)}"})
+
+    service = request.app.state.service
+    return await _queue(request, 'images', user_id, 'image', admission.estimate_image_job(width, height),
+                        service.image_work(prompt, style, width, height))
+
+
+async def submit_video(request):
+    user_id, error = await _authorize(request, 'videos')
+    if error:
+        return error
+    raw = await request.body()
+    if not raw or len(raw) > MAX_VIDEO_UPLOAD_BYTES:
+        return _reply('videos', 400, {'error': 'Send a PNG or JPEG image of at most 20 MB as the body'})
+    try:
+        seed = int(request.query_params.get('seed', 0))
+        motion_bucket_id = int(request.query_params.get('motion_bucket_id', 32))
+    except ValueError:
+        return _reply('videos', 400, {'error': 'seed and motion_bucket_id must be integers'})
+    if not 1 <= motion_bucket_id <= 255:
+        return _reply('videos', 400, {'error': 'motion_bucket_id must be between 1 and 255'})
+
+    service = request.app.state.service
+    return await _queue(request, 'videos', user_id, 'video', admission.estimate_video_job(raw),
+                        service.video_work(raw, seed, motion_bucket_id, request.query_params.get('prompt', '')))
+
+
+async def job_status(request):
+    user_id, error = await _authorize(request, 'jobs')
+    if error:
+        return error
+    job = request.app.state.service.get_job(request.path_params['job_id'], user_id)
+    if job is None:
+        return _reply('jobs', 404, {'error': 'Unknown job'})
+    try:
+        wait = min(float(request.query_params.get('wait', 0)), MAX_WAIT_SECONDS)
+    except ValueError:
+        wait = 0
+    if wait > 0 and not job.future.done():
+        # Long poll: the handler sleeps on the job's future, not a thread
+        try:
+            await asyncio.wait_for(asyncio.shield(job.future), wait)
+        except asyncio.TimeoutError:
+            pass
+    return _reply('jobs', 200, job.to_dict())
+
+
+async def job_result(request):
+    user_id, error = await _authorize(request, 'results')
+    if error:
+        return error
+    job = request.app.state.service.get_job(request.path_params['job_id'], user_id)
+    if job is None:
+        return _reply('results', 404, {'error': 'Unknown job'})
+    if job.status != 'succeeded':
+        return _reply('results', 409, job.to_dict())
+    metrics.inc("api_requests_total", endpoint='results', status='200')
+    return Response(job.result, media_type=job.content_type)
+
+
+async def health(request):
+    return JSONResponse({'status': 'ok'})
+
+
+def create_app(database_url: str, upstream_key: str, workers: int = API_WORKERS) -> Starlette:
+    app = Starlette(routes=[
+        Route('/v1/images', submit_image, methods=['POST']),
+        Route('/v1/videos', submit_video, methods=['POST']),
+        Route('/v1/jobs/{job_id}', job_status, methods=['GET']),
+        Route('/v1/jobs/{job_id}/result', job_result, methods=['GET']),
+        Route('/healthz', health, methods=['GET']),
+    ])
+    app.state.service = ApiService(database_url, upstream_key, workers)
+    return app
+
+
+def start_api_server(database_url: str, upstream_key: str, port: int = API_PORT, host: str = '127.0.0.1',
+                     workers: int = API_WORKERS):
+    """Serve the API from a background thread; returns (uvicorn server, bound port)"""
+    app = create_app(database_url, upstream_key, workers)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    server = uvicorn.Server(uvicorn.Config(app, log_level='warning', backlog=1024))
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]}, name='api-server', daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, sock.getsockname()[1]
+
+
+def benchmark(levels=(1, 8, 32, 64), jobs_per_client: int = 8, latency: float = 0.5, workers: int = API_WORKERS):
+    """Submit-and-wait throughput at several client concurrencies against the mock upstream"""
+    import tempfile
+    import numpy as np
+    import requests
+    from mock_stability import start_mock_server
+
+    mock = start_mock_server(port=0, latency=latency)
+    stability.API_HOST = f"http://127.0.0.1:{mock.server_address[1]}"
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'api.db')}"
+    server, port = start_api_server(url, 'local', port=0, workers=workers)
+    base = f"http://127.0.0.1:{port}"
+
+    service = server.config.app.state.service
+    db = service.session_factory()
+    user = User(email='api@example.com', subscription_type='business', credits_remaining=10 ** 6)
+    db.add(user)
+    db.commit()
+    headers = {'Authorization': f"Bearer {create_api_key(db, user.id)}"}
+    db.close()
+
+    def client(_):
+        latencies = []
+        with requests.Session() as session:
+            for _ in range(jobs_per_client):
+                started = time.perf_counter()
+                job = session.post(f"{base}/v1/images", headers=headers, json={
+                    'prompt': 'a lighthouse at dusk', 'style': 'Cinematic', 'width': 1024, 'height': 576}).json()
+                while job['status'] in ('queued', 'running'):
+                    job = session.get(f"{base}/v1/jobs/{job['id']}?wait=10", headers=headers).json()
+                if job['status'] != 'succeeded':
+                    raise RuntimeError(job)
+                session.get(f"{base}{job['result_url']}", headers=headers).content
+                latencies.append(time.perf_counter() - started)
+        return latencies
+
+    print(f"upstream latency {latency:.2f}s, {workers} API workers, {jobs_per_client} jobs per client")
+    for clients in levels:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            latencies = np.concatenate(list(pool.map(client, range(clients))))
+        elapsed = time.perf_counter() - started
+        p50, p95 = np.percentile(latencies, [50, 95])
+        print(f"{clients:>4} clients: {len(latencies) / elapsed:6.1f} jobs/s, "
+              f"p50 {p50:.2f}s, p95 {p95:.2f}s")
+    counters = metrics.counter_values()
+    hits = counters.get('api_key_cache_total{outcome="hit"}', 0)
+    misses = counters.get('api_key_cache_total{outcome="miss"}', 0)
+    print(f"key cache: {hits:.0f} hits, {misses:.0f} database lookups")
+    server.should_exit = True
+    mock.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP API for programmatic generation")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--port', type=int, default=API_PORT)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    key_parser = subparsers.add_parser('create-key', help="Issue an API key for a user")
+    key_parser.add_argument('email')
+    bench_parser = subparsers.add_parser('bench')
+    bench_parser.add_argument('--latency', type=float, default=0.5, help="Mock upstream latency in seconds")
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        benchmark(latency=args.latency)
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        database_url = os.environ['DATABASE_URL']
+        if args.command == 'create-key':
+            engine = create_schema(get_engine(database_url))
+            db = sessionmaker(bind=engine)()
+            user = db.query(User).filter(User.email == args.email).first()
+            if user is None:
+                raise SystemExit(f"No user with email {args.email}")
+            print(create_api_key(db, user.id))
+            db.close()
+        else:
+            app = create_app(database_url, keypool.get_key_pool())
+            metrics.start_metrics_server()
+            print(f"API on http://{args.host}:{args.port}")
+            uvicorn.run(app, host=args.host, port=args.port, log_level='warning', backlog=1024)
@@ -1,11 +1,22 @@
 import streamlit as st
-import requests
-from PIL import Image, ImageEnhance
-import io
 import os
-import base64
 import time
+import uuid
 from dotenv import load_dotenv
+import metrics
+import media
+from history import get_history
+import stability
+import dispatch
+import keypool
+import drafts
+import admission
+import auth
+import phash
+from analytics import Analytics
+from models import init_db, get_write_db
+import upscale
+import tempfile
 
 # Load environment variables
 load_dotenv()
@@ -13,6 +24,9 @@ load_dotenv()
 # Set page config
 st.set_page_config(page_title="AI Art Generator", layout="wide")
 
+# Expose per-stage timings for Prometheus
+metrics.start_metrics_server()
+
 # Custom CSS for pricing modal and upgrade button
 st.markdown("""
     <style>
@@ -34,88 +48,93 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+UPSCALE_PLANS = ('business', 'enterprise')
+
 def get_api_key():
+    """Pool of the configured Stability API keys, shared by every session"""
     try:
-        return st.secrets["STABILITY_API_KEY"]
+        keys = st.secrets.get("STABILITY_API_KEYS") or [st.secrets["STABILITY_API_KEY"]]
+        if isinstance(keys, str):
+            keys = [k.strip() for k in keys.split(',') if k.strip()]
     except:
-        api_key = os.getenv("STABILITY_API_KEY")
-        if api_key:
-            return api_key
-        else:
-            st.error("API key not found. Please set STABILITY_API_KEY in secrets.toml or .env file")
-            return None
-
-def generate_image(prompt, style="", width=1024, height=1024):
+        keys = keypool.configured_keys()
+    if keys:
+        return keypool.get_key_pool(keys)
+    else:
+        st.error("API key not found. Please set STABILITY_API_KEY or STABILITY_API_KEYS in secrets.toml or .env file")
+        return None
+
+def generate_image(prompt, style="", width=1024, height=1024, seed=0):
     try:
         api_key = get_api_key()
         if not api_key:
             return None, None
 
-        # Use the latest SDXL model for better quality
-        url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
-        
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-
-        # Enhanced prompting for better results
-        style_prompts = {
-            "Photorealistic": "ultra realistic, 8k uhd, high detail, professional photography",
-            "Cinematic": "cinematic lighting, dramatic composition, movie still, 8k resolution",
-            "Anime": "high quality anime art, detailed illustration, Studio Ghibli style",
-            "Digital Art": "highly detailed digital art, 8k resolution, trending on artstation",
-            "Fantasy": "epic fantasy art, detailed illustration, trending on artstation, 8k"
-        }
-
-        # Add style-specific enhancements
-        style_enhancement = style_prompts.get(style, "")
-        enhanced_prompt = f"{prompt}, {style_enhancement}, masterpiece, highly detailed, sharp focus, 8k uhd" if style else f"{prompt}, masterpiece, highly detailed, sharp focus, 8k uhd"
-
-        body = {
-            "text_prompts": [
-                {"text": enhanced_prompt, "weight": 1},
-                {"text": "blurry, low quality, low resolution, pixelated, watermark", "weight": -1}
-            ],
-            "cfg_scale": 8,  # Increased for better prompt adherence
-            "height": height,
-            "width": width,
-            "samples": 1,
-            "steps": 50,  # Increased for better quality
-            "style_preset": "enhance",
-            "sampler": "K_DPM_2_ANCESTRAL",  # Using a supported sampler
-        }
-
-        response = requests.post(url, headers=headers, json=body)
-        if response.status_code != 200:
-            raise Exception(f"Non-200 response: {response.text}")
+        # Enhanced prompting for better results; a seed re-renders a chosen draft
+        if seed:
+            body = drafts.refine_body(prompt, style, width, height, seed)
+        else:
+            body = stability.build_image_body(prompt, style, width, height)
 
-        data = response.json()
-        image_data = base64.b64decode(data["artifacts"][0]["base64"])
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Enhance image sharpness
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(1.2)
-        
-        # Convert back to bytes for download
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG', quality=100)
-        image_data = img_byte_arr.getvalue()
+        # SDXL first; slow calls are hedged and failing engines fall back
+        artifact = dispatch.generate(api_key, body)[0]
+        # Sharpen and convert back to PNG bytes for download
+        image, image_data = media.finish_image(artifact["image"])
         
+        metrics.inc("generation_requests_total", kind="image", status="ok")
         return image, image_data
 
     except Exception as e:
+        metrics.inc("generation_requests_total", kind="image", status="error")
         st.error(f"Error generating image: {str(e)}")
         return None, None
 
-def show_pricing_modal():
-    # Create columns for the pricing cards
-    col1, col2, col3, col4 = st.columns(4)
+def save_to_account(user, image, image_data, prompt, style, width, height):
+    """Keep a signed-in user's image for their dashboard gallery, search and duplicate checks"""
+    try:
+        init_db()
+        db = get_write_db()
+        try:
+            with metrics.span("image.phash"):
+                image_hash = phash.dhash(image)
+            Analytics(db).track_image_generation(
+                user.id, prompt, style, width, height, media.store_image(image_data), phash=image_hash)
+        finally:
+            db.close()
+    except Exception as e:
+        metrics.inc("image_saves_failed_total")
+        st.warning(f"The image was generated but couldn't be saved to your account: {str(e)}")
+
+def show_image_history():
+    # Only thumbnails stay in memory; full images are loaded on demand
+    entries = get_history().entries(st.session_state.history_session_id)
+    if not entries:
+        return
+
+    st.subheader("Your Recent Images")
+    cols = st.columns(5)
+    for idx, entry in enumerate(entries[:10]):
+        with cols[idx % 5]:
+            st.image(entry.thumbnail, caption=entry.meta.get("prompt", "")[:40], use_column_width=True)
+
+    labels = {entry.id: f"{entry.meta.get('prompt', '')[:60]} ({time.strftime('%H:%M:%S', time.localtime(entry.created_at))})"
+              for entry in entries}
+    selected = st.selectbox("Download from history", list(labels), format_func=labels.get, key="history_select")
+    if selected:
+        try:
+            st.download_button(
+                label="Download Selected Image",
+                data=get_history().get_png(st.session_state.history_session_id, selected),
+                file_name=f"generated_image_{selected[:8]}.png",
+                mime="image/png",
+                key="history_download"
+            )
+        except (KeyError, OSError):
+            st.info("That image is no longer available")
 
-    with col1:
-        st.markdown("""
+# Pricing card markup is static; only the buttons are interactive
+PRICING_CARDS = (
+    ("""
             <div style="background-color: #1E1E1E; padding: 20px; border-radius: 10px; text-align: center;">
                 <h2 style="color: white;">Basic</h2>
                 <h1 style="color: #8B5CF6; margin: 20px 0;">$9.99<span style="font-size: 16px; color: #A1A1AA;">/mo</span></h1>
@@ -129,11 +148,8 @@ def show_pricing_modal():
                     <li style="margin: 10px 0;">✓ Email Support</li>
                 </ul>
             </div>
-        """, unsafe_allow_html=True)
-        st.button("Get Started", key="basic_btn", use_container_width=True)
-
-    with col2:
-        st.markdown("""
+        """, "Get Started", "basic_btn", "secondary"),
+    ("""
             <div style="background-color: #1E1E1E; padding: 20px; border-radius: 10px; text-align: center; border: 2px solid #8B5CF6;">
                 <div style="background: #8B5CF6; color: white; padding: 5px 10px; border-radius: 15px; position: absolute; top: -10px; right: 10px; font-size: 12px;">MOST POPULAR</div>
                 <h2 style="color: white;">Pro</h2>
@@ -150,11 +166,8 @@ def show_pricing_modal():
                     <li style="margin: 10px 0;">✓ Priority Support</li>
                 </ul>
             </div>
-        """, unsafe_allow_html=True)
-        st.button("Upgrade Now", key="pro_btn", type="primary", use_container_width=True)
-
-    with col3:
-        st.markdown("""
+        """, "Upgrade Now", "pro_btn", "primary"),
+    ("""
             <div style="background-color: #1E1E1E; padding: 20px; border-radius: 10px; text-align: center;">
                 <h2 style="color: white;">Business</h2>
                 <h1 style="color: #8B5CF6; margin: 20px 0;">$49.99<span style="font-size: 16px; color: #A1A1AA;">/mo</span></h1>
@@ -171,11 +184,8 @@ def show_pricing_modal():
                     <li style="margin: 10px 0;">✓ Dedicated Support</li>
                 </ul>
             </div>
-        """, unsafe_allow_html=True)
-        st.button("Get Business", key="business_btn", use_container_width=True)
-
-    with col4:
-        st.markdown("""
+        """, "Get Business", "business_btn", "secondary"),
+    ("""
             <div style="background-color: #1E1E1E; padding: 20px; border-radius: 10px; text-align: center;">
                 <h2 style="color: white;">Enterprise</h2>
                 <h1 style="color: #8B5CF6; margin: 20px 0;">$199.99<span style="font-size: 16px; color: #A1A1AA;">/mo</span></h1>
@@ -191,58 +201,121 @@ def show_pricing_modal():
                     <li style="margin: 10px 0;">✓ Custom Features</li>
                 </ul>
             </div>
-        """, unsafe_allow_html=True)
-        st.button("Contact Sales", key="enterprise_btn", use_container_width=True)
+        """, "Contact Sales", "enterprise_btn", "secondary"),
+)
 
-def main():
-    # Add session state for user plan and current tab
-    if 'user_plan' not in st.session_state:
-        st.session_state.user_plan = 'free'
-        st.session_state.images_remaining = 10
-        st.session_state.show_pricing = False
-
-    # Add floating upgrade button
-    st.markdown("""
-        <div class="upgrade-button" onclick="document.getElementById('pricing-section').scrollIntoView();">
-            ⚡ Upgrade
-        </div>
-    """, unsafe_allow_html=True)
-
-    # Create tabs for Image and Video Generation
-    tab1, tab2, tab3 = st.tabs(["🖼️ Image Generation", "🎥 Video Generation", "💎 Pricing"])
-
-    with tab1:
-        st.title("Generate Images with AI")
-        prompt = st.text_input("Describe what you want to see", key="image_prompt")
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            styles = ["None", "Photorealistic", "Cinematic", "Anime", "Digital Art", "Fantasy"]
-            selected_style = st.selectbox("Style", styles, key="image_style")
+def show_pricing_modal():
+    # Create columns for the pricing cards
+    columns = st.columns(len(PRICING_CARDS))
+
+    for column, (card_html, label, key, button_type) in zip(columns, PRICING_CARDS):
+        with column:
+            st.markdown(card_html, unsafe_allow_html=True)
+            st.button(label, key=key, type=button_type, use_container_width=True)
+
+def use_free_image():
+    """Count one generation (or one round of drafts) against the free allowance"""
+    if st.session_state.user_plan == 'free':
+        st.session_state.images_remaining -= 1
+        st.info(f"⚡ {st.session_state.images_remaining} generations remaining today")
+
+def free_limit_reached():
+    if st.session_state.user_plan == 'free' and st.session_state.images_remaining <= 0:
+        st.warning("⚡ You've used all your free images for today! Upgrade to Pro for unlimited generations.")
+        st.session_state.show_pricing = True
+        return True
+    return False
+
+@st.fragment
+@metrics.timed("app.fragment.image_form")
+def image_form():
+    st.title("Generate Images with AI")
+    prompt = st.text_input("Describe what you want to see", key="image_prompt")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        styles = ["None", "Photorealistic", "Cinematic", "Anime", "Digital Art", "Fantasy"]
+        selected_style = st.selectbox("Style", styles, key="image_style")
 
-        with col2:
-            aspect_ratios = {
-                "1:1 Square": (1024, 1024),
-                "16:9 Landscape": (1024, 576),
-                "9:16 Portrait": (576, 1024)
-            }
-            selected_ratio = st.selectbox("Aspect Ratio", list(aspect_ratios.keys()), key="image_ratio")
-
-        if st.button("Generate", type="primary", key="image_generate"):
-            if prompt:
-                if st.session_state.user_plan == 'free' and st.session_state.images_remaining <= 0:
-                    st.warning("⚡ You've used all your free images for today! Upgrade to Pro for unlimited generations.")
-                    st.session_state.show_pricing = True
-                    return
-
-                with st.spinner("Creating your masterpiece..."):
-                    width, height = aspect_ratios[selected_ratio]
-                    style_prompt = "" if selected_style == "None" else selected_style
-                    image, image_data = generate_image(prompt, style_prompt, width, height)
-                    
+    with col2:
+        aspect_ratios = {
+            "1:1 Square": (1024, 1024),
+            "16:9 Landscape": (1024, 576),
+            "9:16 Portrait": (576, 1024)
+        }
+        selected_ratio = st.selectbox("Aspect Ratio", list(aspect_ratios.keys()), key="image_ratio")
+
+    # Ultra HD output is a Business feature
+    upscale_options = {"Standard": 1, "2x Upscale": 2, "4x Ultra HD": 4}
+    selected_upscale = st.selectbox(
+        "Output Size",
+        list(upscale_options.keys()),
+        key="image_upscale",
+        disabled=st.session_state.user_plan not in UPSCALE_PLANS,
+        help="Available on the Business and Enterprise plans"
+    )
+
+    draft_mode = st.toggle(
+        "Draft mode",
+        key="image_draft_mode",
+        help=f"Preview {drafts.DRAFT_COUNT} quick drafts, then render only the one you pick at full quality"
+    )
+
+    width, height = aspect_ratios[selected_ratio]
+    style_prompt = "" if selected_style == "None" else selected_style
+    factor = upscale_options[selected_upscale] if st.session_state.user_plan in UPSCALE_PLANS else 1
+    # (prompt, style, width, height, seed) to render at full quality this run
+    render = None
+
+    if st.button("Generate", type="primary", key="image_generate"):
+        if prompt:
+            if free_limit_reached():
+                return
+
+            st.session_state.pop("image_drafts", None)
+            if draft_mode:
+                with st.spinner("Sketching drafts..."):
+                    try:
+                        api_key = get_api_key()
+                        if api_key:
+                            with admission.get_admission_controller().admit(
+                                    "image", drafts.DRAFT_COUNT * admission.estimate_image_job(width, height)):
+                                st.session_state.image_drafts = {
+                                    'prompt': prompt, 'style': style_prompt, 'width': width, 'height': height,
+                                    'drafts': drafts.generate_drafts(api_key, prompt, style_prompt, width, height),
+                                }
+                            use_free_image()
+                    except admission.AdmissionRejected as e:
+                        st.warning(str(e))
+                    except Exception as e:
+                        st.error(f"Error generating drafts: {str(e)}")
+            else:
+                render = (prompt, style_prompt, width, height, 0)
+
+    pending = st.session_state.get("image_drafts")
+    if pending:
+        st.subheader("Pick a draft to render at full quality")
+        cols = st.columns(len(pending['drafts']))
+        for idx, draft in enumerate(pending['drafts']):
+            with cols[idx]:
+                st.image(draft['preview'], caption=f"Seed {draft['seed']}", use_column_width=True)
+                if st.button("Refine", key=f"image_refine_{idx}", use_container_width=True):
+                    render = (pending['prompt'], pending['style'], pending['width'], pending['height'], draft['seed'])
+
+    if render:
+        if free_limit_reached():
+            return
+        prompt, style_prompt, width, height, seed = render
+        with st.spinner("Creating your masterpiece..."):
+            try:
+                with admission.get_admission_controller().admit(
+                        "image", admission.estimate_image_job(width, height, factor)):
+                    with metrics.span("image.total"):
+                        image, image_data = generate_image(prompt, style_prompt, width, height, seed)
+            
                     if image and image_data:
                         st.image(image, caption="Generated Image", use_column_width=True)
-                        
+                
                         # Add download button
                         st.download_button(
                             label="Download Image",
@@ -251,155 +324,206 @@ def main():
                             mime="image/png",
                             use_container_width=True
                         )
-                        
-                        if st.session_state.user_plan == 'free':
-                            st.session_state.images_remaining -= 1
-                            st.info(f"⚡ {st.session_state.images_remaining} generations remaining today")
 
-    with tab2:
-        st.title("Generate Videos with AI")
+                        if factor > 1:
+                            with st.spinner(f"Upscaling to {width * factor}x{height * factor}..."):
+                                # Tiles are streamed to disk so the full frame is never held decoded
+                                with tempfile.TemporaryFile() as upscaled:
+                                    upscale.upscale_to_png(image, factor, upscaled)
+                                    upscaled.seek(0)
+                                    st.download_button(
+                                        label=f"Download {width * factor}x{height * factor}",
+                                        data=upscaled.read(),
+                                        file_name=f"generated_image_{int(time.time())}_{factor}x.png",
+                                        mime="image/png",
+                                        use_container_width=True
+                                    )
+
+                        get_history().add(
+                            st.session_state.history_session_id, image, image_data,
+                            prompt=prompt, style=style_prompt, width=width, height=height
+                        )
+                        user = auth.current_user()
+                        if user is not None:
+                            save_to_account(user, image, image_data, prompt, style_prompt, width, height)
+                
+                        use_free_image()
+            except admission.AdmissionRejected as e:
+                st.warning(str(e))
+
+    show_image_history()
+
+@st.fragment
+@metrics.timed("app.fragment.video_form")
+def video_form():
+    st.title("Generate Videos with AI")
+    
+    # Upload image
+    uploaded_file = st.file_uploader("Upload an image to animate", type=['png', 'jpg', 'jpeg'])
+    
+    if uploaded_file:
+        st.image(uploaded_file, caption="Uploaded Image", use_column_width=True)
         
-        # Upload image
-        uploaded_file = st.file_uploader("Upload an image to animate", type=['png', 'jpg', 'jpeg'])
+        # Add prompt input with placeholder text
+        prompt = st.text_area(
+            "Describe the motion you want (Optional)",
+            placeholder="Example: 'Make the person walk forward', 'Make the flower bloom', 'Make the water flow'",
+            help="Describe how you want the image to animate. Be specific about the motion you want to see."
+        )
         
-        if uploaded_file:
-            st.image(uploaded_file, caption="Uploaded Image", use_column_width=True)
-            
-            # Add prompt input with placeholder text
-            prompt = st.text_area(
-                "Describe the motion you want (Optional)",
-                placeholder="Example: 'Make the person walk forward', 'Make the flower bloom', 'Make the water flow'",
-                help="Describe how you want the image to animate. Be specific about the motion you want to see."
+        # Create two columns for controls
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            motion_strength = st.slider(
+                "Motion Strength",
+                min_value=1,
+                max_value=64,
+                value=32,
+                help="Higher values create more dramatic motion, lower values create subtle motion"
             )
             
-            # Create two columns for controls
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                motion_strength = st.slider(
-                    "Motion Strength",
-                    min_value=1,
-                    max_value=64,
-                    value=32,
-                    help="Higher values create more dramatic motion, lower values create subtle motion"
-                )
-                
-            with col2:
-                seed = st.number_input(
-                    "Seed (Optional)",
-                    value=0,
-                    help="Use the same seed to reproduce the same video motion"
-                )
-            
-            # Add motion style selection
-            motion_style = st.selectbox(
-                "Motion Style",
-                ["Smooth", "Dynamic", "Gentle", "Dramatic"],
-                help="Choose the style of motion for your video"
+        with col2:
+            seed = st.number_input(
+                "Seed (Optional)",
+                value=0,
+                help="Use the same seed to reproduce the same video motion"
             )
+        
+        # Add motion style selection
+        motion_style = st.selectbox(
+            "Motion Style",
+            ["Smooth", "Dynamic", "Gentle", "Dramatic"],
+            help="Choose the style of motion for your video"
+        )
+        
+        # Map motion styles to motion bucket IDs
+        motion_style_mapping = {
+            "Smooth": 32,
+            "Dynamic": 48,
+            "Gentle": 16,
+            "Dramatic": 64
+        }
+        
+        # Update motion_bucket_id based on style
+        motion_bucket_id = motion_style_mapping[motion_style]
             
-            # Map motion styles to motion bucket IDs
-            motion_style_mapping = {
-                "Smooth": 32,
-                "Dynamic": 48,
-                "Gentle": 16,
-                "Dramatic": 64
-            }
-            
-            # Update motion_bucket_id based on style
-            motion_bucket_id = motion_style_mapping[motion_style]
-                
-            if st.button("Generate Video", type="primary"):
-                with st.spinner("Generating video... This may take a few moments."):
-                    try:
-                        api_key = get_api_key()
-                        if not api_key:
-                            return
+        if st.button("Generate Video", type="primary"):
+            with st.spinner("Generating video... This may take a few moments."):
+                try:
+                    api_key = get_api_key()
+                    if not api_key:
+                        return
+
+                    raw_upload = uploaded_file.getvalue()
+                    with admission.get_admission_controller().admit(
+                            "video", admission.estimate_video_job(raw_upload)):
+                        # Shrink the upload to a supported resolution before encoding
+                        upload_data, upload_info = media.prepare_video_input(raw_upload)
 
-                        # Convert image to base64
-                        image_data = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
-                        
                         # Generate video using the correct endpoint
-                        url = "https://api.stability.ai/v1/generation/stable-video-diffusion/image-to-video/upscale"
-                        
-                        headers = {
-                            "Authorization": f"Bearer {api_key}",
-                            "Content-Type": "application/json",
-                            "Accept": "application/json"
-                        }
-
-                        body = {
-                            "image": image_data,
-                            "seed": seed,
-                            "cfg_scale": 2.5,
-                            "motion_bucket_id": motion_bucket_id,
-                            "fps": 24
-                        }
-
-                        if prompt.strip():
-                            body["text_prompt"] = prompt
-
-                        response = requests.post(url, headers=headers, json=body)
-                        
-                        if response.status_code != 200:
-                            st.error(f"Error: {response.text}")
-                            return
-
-                        result = response.json()
-                        
-                        if 'base64' in result:
-                            # Save the video
-                            video_data = base64.b64decode(result['base64'])
-                            
-                            # Save to a temporary file
-                            temp_file = "temp_video.mp4"
-                            with open(temp_file, "wb") as f:
+                        video_data = dispatch.animate(
+                            api_key,
+                            upload_data,
+                            seed=seed,
+                            motion_bucket_id=motion_bucket_id,
+                            text_prompt=prompt
+                        )
+                        metrics.inc("generation_requests_total", kind="video", status="ok")
+                    
+                        # Save to a temporary file
+                        # One file per job; concurrent sessions must not share a path
+                        fd, temp_file = tempfile.mkstemp(suffix=".mp4")
+                        with metrics.span("video.write_temp"):
+                            with os.fdopen(fd, "wb") as f:
                                 f.write(video_data)
-                            
-                            # Display the video
-                            st.success("✨ Video generated successfully!")
-                            st.video(temp_file)
-                            
-                            # Download button
-                            st.download_button(
-                                label="📥 Download Video",
-                                data=video_data,
-                                file_name=f"generated_video_{int(time.time())}.mp4",
-                                mime="video/mp4"
+                    
+                        # Display the video
+                        st.success("✨ Video generated successfully!")
+                        st.video(temp_file)
+                    
+                        # Download button
+                        st.download_button(
+                            label="📥 Download Video",
+                            data=video_data,
+                            file_name=f"generated_video_{int(time.time())}.mp4",
+                            mime="video/mp4"
+                        )
+                    
+                        # Display generation details
+                        with st.expander("Generation Details"):
+                            st.write(f"Motion Strength: {motion_bucket_id}")
+                            st.write(f"Seed: {seed}")
+                            if prompt:
+                                st.write(f"Prompt: {prompt}")
+                            st.write(f"Style: {motion_style}")
+                            width, height = upload_info['size']
+                            st.write(
+                                f"Upload: {upload_info['original_bytes'] / 1e6:.1f} MB → "
+                                f"{upload_info['upload_bytes'] / 1e6:.1f} MB at {width}x{height} "
+                                f"(~{upload_info['seconds_saved']:.1f}s upload time saved)"
                             )
-                            
-                            # Display generation details
-                            with st.expander("Generation Details"):
-                                st.write(f"Motion Strength: {motion_bucket_id}")
-                                st.write(f"Seed: {seed}")
-                                if prompt:
-                                    st.write(f"Prompt: {prompt}")
-                                st.write(f"Style: {motion_style}")
-                            
-                            # Clean up temp file
-                            try:
-                                os.remove(temp_file)
-                            except:
-                                pass
-                        else:
-                            st.error("Invalid response format from API")
+                    
+                        # Clean up temp file
+                        try:
+                            os.remove(temp_file)
+                        except:
+                            pass
+
+                except admission.AdmissionRejected as e:
+                    st.warning(str(e))
+                except Exception as e:
+                    metrics.inc("generation_requests_total", kind="video", status="error")
+                    st.error(f"Error generating video: {str(e)}")
+
+    # Add helpful tips
+    with st.expander("Tips for better results"):
+        st.markdown("""
+        - Upload clear, high-quality images
+        - Use descriptive prompts for specific motions
+        - Experiment with different motion strengths
+        - Try different seeds for varied results
+        - Choose motion styles that match your desired outcome
+        """)
+
+@st.fragment
+@metrics.timed("app.fragment.pricing")
+def pricing_section():
+    st.title("Choose Your Plan")
+    show_pricing_modal()
 
-                    except Exception as e:
-                        st.error(f"Error generating video: {str(e)}")
-
-        # Add helpful tips
-        with st.expander("Tips for better results"):
-            st.markdown("""
-            - Upload clear, high-quality images
-            - Use descriptive prompts for specific motions
-            - Experiment with different motion strengths
-            - Try different seeds for varied results
-            - Choose motion styles that match your desired outcome
-            """)
+def main():
+    # Add session state for user plan and current tab
+    if 'user_plan' not in st.session_state:
+        st.session_state.user_plan = 'free'
+        st.session_state.images_remaining = 10
+        st.session_state.show_pricing = False
+    if 'history_session_id' not in st.session_state:
+        st.session_state.history_session_id = uuid.uuid4().hex
+    # The plan comes from the session token, without a database lookup
+    user = auth.current_user()
+    st.session_state.user_plan = user.plan if user is not None else 'free'
+
+    # Add floating upgrade button
+    st.markdown("""
+        <div class="upgrade-button" onclick="document.getElementById('pricing-section').scrollIntoView();">
+            ⚡ Upgrade
+        </div>
+    """, unsafe_allow_html=True)
+
+    # Create tabs for Image and Video Generation
+    tab1, tab2, tab3 = st.tabs(["🖼️ Image Generation", "🎥 Video Generation", "💎 Pricing"])
+
+    with tab1:
+        image_form()
+
+    with tab2:
+        video_form()
 
     with tab3:
-        st.title("Choose Your Plan")
-        show_pricing_modal()
+        pricing_section()
 
 if __name__ == "__main__":
-    main()
+    # Full-script reruns; fragment-only reruns are timed as app.fragment.*
+    with metrics.span("app.rerun"):
+        main()
@@ -0,0 +1,297 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from jose import jwt, JWTError, ExpiredSignatureError
+import streamlit as st
+from sqlalchemy.exc import IntegrityError
+from models import User, get_read_db
+import metrics
+
+# Sessions are signed JWTs carrying the user's id and plan, so any process
+# holding JWT_SECRET can check one without a database lookup. Without it, a
+# random per-process secret is used and sessions end when the process does.
+# Tokens are short-lived and silently re-issued from the database until the
+# login itself (SESSION_TTL_SECONDS) runs out, so a plan change reaches
+# every session within JWT_TTL_SECONDS.
+JWT_SECRET = os.getenv('JWT_SECRET') or secrets.token_urlsafe(32)
+JWT_ALGORITHM = 'HS256'
+JWT_TTL_SECONDS = int(os.getenv('JWT_TTL_SECONDS', '300'))
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+TOKEN_CACHE_SIZE = 10000
+
+# bcrypt is deliberately slow. Hashes run on a small shared pool, which caps
+# how many run at once (bcrypt releases the GIL, so at most AUTH_WORKERS cores
+# go to hashing during a burst of logins). The calling script thread still
+# waits for its own hash.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', '2'))
+MIN_PASSWORD_LENGTH = 8
+# bcrypt ignores everything past 72 bytes
+MAX_PASSWORD_BYTES = 72
+
+_bcrypt_pool = ThreadPoolExecutor(AUTH_WORKERS, thread_name_prefix='bcrypt')
+_dummy_hash = None
+
+
+class AuthError(ValueError):
+    """Raised for bad credentials and invalid or expired session tokens"""
+
+
+class TokenExpired(AuthError):
+    """Raised for a validly signed token past its exp; see refresh_token"""
+
+
+class Principal:
+    """The signed-in user, as carried in a session token"""
+    __slots__ = ('id', 'email', 'plan', 'expires_at')
+
+    def __init__(self, id: int, email: str, plan: str, expires_at: int):
+        self.id = id
+        self.email = email
+        self.plan = plan
+        self.expires_at = expires_at
+
+
+def _hashpw(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('ascii')
+
+
+def _checkpw(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('ascii'))
+
+
+@metrics.timed("auth.hash_password")
+def hash_password(password: str) -> str:
+    """bcrypt hash of a password; waits for a free slot on the auth pool"""
+    return _bcrypt_pool.submit(_hashpw, password).result()
+
+
+@metrics.timed("auth.verify_password")
+def verify_password(password: str, hashed: str) -> bool:
+    """Check a password against its bcrypt hash; waits for a free slot on the auth pool"""
+    return _bcrypt_pool.submit(_checkpw, password, hashed).result()
+
+
+def _missing_user_check(password: str):
+    # Unknown emails cost as much as wrong passwords, so timing doesn't
+    # reveal which emails have accounts
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(secrets.token_urlsafe(16))
+    verify_password(password, _dummy_hash)
+
+
+class _TokenCache:
+    """LRU of verified tokens, so reruns skip signature checks and the User lookup"""
+
+    def __init__(self, size: int = TOKEN_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            principal = self._entries.get(token)
+            if principal is None:
+                return None
+            if principal.expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return principal
+
+    def put(self, token: str, principal: Principal):
+        with self._lock:
+            self._entries[token] = principal
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, token: str):
+        with self._lock:
+            self._entries.pop(token, None)
+
+
+_token_cache = _TokenCache()
+
+
+def issue_token(user: User, session_expires_at: int = None) -> str:
+    """Signed session token for a user; a new login unless session_expires_at is given"""
+    now = int(time.time())
+    session_expires_at = session_expires_at or now + SESSION_TTL_SECONDS
+    claims = {
+        'sub': str(user.id),
+        'email': user.email,
+        'plan': user.subscription_type or 'free',
+        'iat': now,
+        'exp': min(now + JWT_TTL_SECONDS, session_expires_at),
+        'session_exp': session_expires_at,
+    }
+    return jwt.encode(claims, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+def verify_token(token: str) -> Principal:
+    """Principal for a valid session token; raises AuthError otherwise"""
+    principal = _token_cache.get(token)
+    if principal is not None:
+        metrics.inc("auth_token_checks_total", outcome="cached")
+        return principal
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        principal = Principal(int(claims['sub']), claims.get('email', ''), claims.get('plan', 'free'),
+                              int(claims['exp']))
+    except ExpiredSignatureError:
+        metrics.inc("auth_token_checks_total", outcome="expired")
+        raise TokenExpired("Your session has expired. Please log in again")
+    except (JWTError, KeyError, ValueError):
+        metrics.inc("auth_token_checks_total", outcome="invalid")
+        raise AuthError("Your session has expired. Please log in again")
+    metrics.inc("auth_token_checks_total", outcome="verified")
+    _token_cache.put(token, principal)
+    return principal
+
+
+def refresh_token(db, token: str) -> str:
+    """Re-issue an expired token with the user's current plan, while its login lasts"""
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={'verify_exp': False})
+        user_id, session_expires_at = int(claims['sub']), int(claims['session_exp'])
+    except (JWTError, KeyError, ValueError):
+        raise AuthError("Your session has expired. Please log in again")
+    if session_expires_at <= time.time():
+        raise AuthError("Your session has expired. Please log in again")
+    user = db.query(User).filter(User.id == user_id).first()
+    if user is None:
+        raise AuthError("Your account no longer exists")
+    metrics.inc("auth_token_refreshes_total")
+    return issue_token(user, session_expires_at)
+
+
+def login(db, email: str, password: str) -> str:
+    """Check credentials and return a session token"""
+    user = db.query(User).filter(User.email == email.strip().lower()).first()
+    if user is None or not user.password:
+        _missing_user_check(password)
+        metrics.inc("auth_logins_total", outcome="rejected")
+        raise AuthError("Incorrect email or password")
+    if not verify_password(password, user.password):
+        metrics.inc("auth_logins_total", outcome="rejected")
+        raise AuthError("Incorrect email or password")
+    metrics.inc("auth_logins_total", outcome="ok")
+    return issue_token(user)
+
+
+def register(db, email: str, password: str) -> str:
+    """Create an account and return a session token for it"""
+    email = email.strip().lower()
+    if '@' not in email:
+        raise AuthError("Please enter a valid email address")
+    if len(password) < MIN_PASSWORD_LENGTH:
+        raise AuthError(f"Passwords need at least {MIN_PASSWORD_LENGTH} characters")
+    if len(password.encode('utf-8')) > MAX_PASSWORD_BYTES:
+        raise AuthError(f"Passwords can be at most {MAX_PASSWORD_BYTES} bytes")
+    user = User(email=email, password=hash_password(password))
+    db.add(user)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise AuthError("An account with this email already exists")
+    metrics.inc("auth_registrations_total")
+    return issue_token(user)
+
+
+def sign_in(token: str) -> Principal:
+    """Keep a session token in this Streamlit session"""
+    principal = verify_token(token)
+    st.session_state.auth_token = token
+    st.session_state.user = principal
+    return principal
+
+
+def sign_out():
+    token = st.session_state.pop('auth_token', None)
+    if token is not None:
+        _token_cache.discard(token)
+    st.session_state.pop('user', None)
+
+
+def current_user():
+    """The signed-in Principal for this Streamlit session, or None"""
+    token = st.session_state.get('auth_token')
+    if token is None:
+        return None
+    try:
+        principal = verify_token(token)
+    except TokenExpired:
+        db = get_read_db(primary=True)
+        try:
+            return sign_in(refresh_token(db, token))
+        except AuthError:
+            sign_out()
+            return None
+        finally:
+            db.close()
+    except AuthError:
+        sign_out()
+        return None
+    st.session_state.user = principal
+    return principal
+
+
+def benchmark(users: int = 16, logins: int = 64, workers: int = 8, checks: int = 20000):
+    """Login throughput, and the per-rerun cost of a cached token check vs looking the user up"""
+    import tempfile
+    import numpy as np
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from models import Base
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'auth.db')}")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    db = Session()
+    started = time.perf_counter()
+    tokens = [register(db, f"user{i}@example.com", f"password-{i}") for i in range(users)]
+    print(f"registered {users} users in {time.perf_counter() - started:.1f}s "
+          f"(bcrypt cost {BCRYPT_ROUNDS}, {AUTH_WORKERS} hashing threads)")
+    db.close()
+
+    def one_login(i):
+        session = Session()
+        try:
+            t = time.perf_counter()
+            login(session, f"user{i % users}@example.com", f"password-{i % users}")
+            return time.perf_counter() - t
+        finally:
+            session.close()
+
+    with ThreadPoolExecutor(workers) as pool:
+        started = time.perf_counter()
+        latencies = np.array(list(pool.map(one_login, range(logins))))
+        elapsed = time.perf_counter() - started
+    p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+    print(f"login: {logins / elapsed:.1f} logins/s with {workers} concurrent callers, "
+          f"p50 {p50:.0f} ms, p95 {p95:.0f} ms")
+
+    db = Session()
+    user_ids = [verify_token(token).id for token in tokens]
+    runs = {
+        'User lookup': lambda i: db.query(User).filter(User.id == user_ids[i % users]).first(),
+        'JWT decode': lambda i: jwt.decode(tokens[i % users], JWT_SECRET, algorithms=[JWT_ALGORITHM]),
+        'cached token': lambda i: verify_token(tokens[i % users]),
+    }
+    for name, check in runs.items():
+        started = time.perf_counter()
+        for i in range(checks):
+            check(i)
+        print(f"{name:>13}: {(time.perf_counter() - started) / checks * 1e6:.1f} µs per rerun")
+    db.close()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,301 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import requests
+import keypool
+import metrics
+import stability
+
+# Generation calls go through a dispatcher that hedges slow requests with a
+# duplicate and routes around unhealthy engines with a circuit breaker.
+FALLBACK_ENGINES = [e for e in os.getenv('STABILITY_FALLBACK_ENGINES', 'stable-diffusion-v1-6').split(',') if e]
+# Fixed hedge delay in seconds; when unset the engine's observed p95 is used
+HEDGE_DELAY_SECONDS = float(os.getenv('HEDGE_DELAY_SECONDS')) if os.getenv('HEDGE_DELAY_SECONDS') else None
+HEDGE_QUANTILE = 0.95
+HEDGE_DEFAULT_DELAY_SECONDS = 20.0
+HEDGE_MIN_DELAY_SECONDS = 0.1
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_WORKERS = 32
+
+BREAKER_WINDOW = 50
+BREAKER_MIN_REQUESTS = 10
+BREAKER_MAX_ERROR_RATE = float(os.getenv('BREAKER_MAX_ERROR_RATE', '0.5'))
+BREAKER_MAX_P95_SECONDS = float(os.getenv('BREAKER_MAX_P95_SECONDS', '60'))
+BREAKER_COOLDOWN_SECONDS = 30.0
+
+
+def _is_engine_failure(error: Exception) -> bool:
+    # Client errors (bad prompt, no credits) say nothing about engine health
+    if isinstance(error, stability.StabilityError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, requests.RequestException)
+
+
+class CircuitBreaker:
+    """Track one engine's recent outcomes and stop routing to it when it degrades
+
+    Closed: requests flow. Open: requests are refused until the cooldown ends.
+    Half-open: a single trial request decides whether to close or reopen.
+    """
+
+    def __init__(self, engine: str, window: int = BREAKER_WINDOW, min_requests: int = BREAKER_MIN_REQUESTS,
+                 max_error_rate: float = BREAKER_MAX_ERROR_RATE, max_p95: float = BREAKER_MAX_P95_SECONDS,
+                 cooldown: float = BREAKER_COOLDOWN_SECONDS):
+        self.engine = engine
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.max_p95 = max_p95
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._probing or time.monotonic() - self._opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now; claims the trial slot when half-open"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def latency_quantile(self, q: float):
+        """Quantile of recent successful latencies, None until enough are seen"""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return float(np.quantile(self._latencies, q))
+
+    def release(self):
+        """Give up the trial slot after an attempt that never reached the engine"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok: bool, seconds: float = None):
+        """Record an outcome; `seconds` is None when the latency isn't representative"""
+        with self._lock:
+            if self._opened_at is not None:
+                # Stragglers sent before the breaker opened don't decide the trial
+                if not self._probing:
+                    return
+                self._probing = False
+                if ok and (seconds is None or seconds <= self.max_p95):
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    self._latencies.clear()
+                    metrics.set_gauge("engine_breaker_open", 0, engine=self.engine)
+                else:
+                    self._opened_at = time.monotonic()
+                return
+
+            self._outcomes.append(ok)
+            if ok and seconds is not None:
+                self._latencies.append(seconds)
+            if len(self._outcomes) < self.min_requests:
+                return
+            error_rate = 1 - sum(self._outcomes) / len(self._outcomes)
+            slow = (len(self._latencies) >= self.min_requests
+                    and np.quantile(self._latencies, 0.95) > self.max_p95)
+            if error_rate > self.max_error_rate or slow:
+                self._opened_at = time.monotonic()
+                metrics.inc("engine_breaker_trips_total", engine=self.engine,
+                            reason='latency' if slow else 'errors')
+                metrics.set_gauge("engine_breaker_open", 1, engine=self.engine)
+
+
+class HedgedDispatcher:
+    """Run a generation call with a hedged duplicate and engine fallback"""
+
+    def __init__(self, engines: list = None, hedge_delay: float = HEDGE_DELAY_SECONDS,
+                 max_workers: int = HEDGE_MAX_WORKERS):
+        self.engines = list(engines or [stability.DEFAULT_ENGINE, *FALLBACK_ENGINES])
+        self.breakers = {engine: CircuitBreaker(engine) for engine in self.engines}
+        self.hedge_delay = hedge_delay
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='dispatch')
+
+    def current_hedge_delay(self, engine: str) -> float:
+        """Seconds to wait on a request before sending its duplicate"""
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        observed = self.breakers[engine].latency_quantile(HEDGE_QUANTILE)
+        if observed is None:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        return max(observed, HEDGE_MIN_DELAY_SECONDS)
+
+    def _choose_engine(self, exclude: str = None):
+        # Engines are listed in order of preference
+        for engine in self.engines:
+            if engine != exclude and self.breakers[engine].allow():
+                return engine
+        return None
+
+    def _attempt(self, request, engine: str, cancel: threading.Event, cost: float):
+        breaker = self.breakers[engine]
+        started = time.perf_counter()
+        try:
+            result = request(engine, cancel)
+        except stability.RequestCancelled as e:
+            # The loser finished upstream, so its credits were spent anyway
+            if e.status_code == 200:
+                breaker.record(True, time.perf_counter() - started)
+                metrics.inc("hedge_wasted_credits_total", cost, engine=engine)
+            else:
+                breaker.record(not _is_engine_failure(stability.StabilityError(e.status_code, '')))
+            raise
+        except (stability.StabilityError, requests.RequestException) as e:
+            breaker.record(not _is_engine_failure(e))
+            raise
+        except Exception:
+            # No free key, admission refused or a local bug: the engine was
+            # never asked, so this mustn't count as its trial
+            breaker.release()
+            raise
+        breaker.record(True, time.perf_counter() - started)
+        if cancel.is_set():
+            metrics.inc("hedge_wasted_credits_total", cost, engine=engine)
+        return result
+
+    def _submit(self, attempts: dict, request, engine: str, cost: float, role: str):
+        cancel = threading.Event()
+        future = self._pool.submit(self._attempt, request, engine, cancel, cost)
+        attempts[future] = (engine, cancel, role)
+        metrics.inc("generation_attempts_total", engine=engine, role=role)
+
+    def call(self, request, cost: float = 0.0):
+        """Run request(engine, cancel_event) and return the first successful result
+
+        If the first attempt hasn't finished after the hedge delay a duplicate
+        is sent to the same engine; the loser's cancel event is set. If the
+        first attempt fails outright, the call is retried once on the next
+        healthy engine.
+        """
+        engine = self._choose_engine()
+        if engine is None:
+            raise stability.StabilityError(503, "All generation engines are unavailable")
+        attempts = {}
+        self._submit(attempts, request, engine, cost, 'primary')
+        deadline = time.monotonic() + self.current_hedge_delay(engine)
+        hedged = failed_over = False
+        error = None
+
+        while attempts:
+            timeout = None if hedged or failed_over else max(deadline - time.monotonic(), 0)
+            done, _ = wait(attempts, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                self._submit(attempts, request, engine, cost, 'hedge')
+                continue
+
+            for future in done:
+                _, _, role = attempts.pop(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for _, cancel, _ in attempts.values():
+                    cancel.set()
+                if hedged:
+                    metrics.inc("generation_hedges_total", outcome='won' if role == 'hedge' else 'lost')
+                return future.result()
+
+            if not attempts and not failed_over and _is_engine_failure(error):
+                fallback = self._choose_engine(exclude=engine)
+                if fallback is not None:
+                    failed_over = True
+                    self._submit(attempts, request, fallback, cost, 'fallback')
+        raise error
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> HedgedDispatcher:
+    """Get the process-wide dispatcher so engine health is shared across sessions"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = HedgedDispatcher()
+        return _dispatcher
+
+
+def generate(api_key, body: dict) -> list:
+    """Hedged, engine-aware text_to_image; `api_key` is a key or a KeyPool
+
+    Each attempt (primary, hedge or fallback) takes its own key from the pool.
+    """
+    pool = keypool.as_pool(api_key)
+    cost = stability.estimate_credits(body)
+    return get_dispatcher().call(
+        lambda engine, cancel: pool.call(
+            lambda key: stability.text_to_image(key, body, engine=engine, cancel=cancel), cost),
+        cost=cost)
+
+
+def animate(api_key, image: bytes, **options) -> bytes:
+    """image_to_video on the least-loaded key of `api_key` (a key or a KeyPool)"""
+    return keypool.as_pool(api_key).call(lambda key: stability.image_to_video(key, image, **options),
+                                         stability.CREDITS_PER_VIDEO)
+
+
+def benchmark(requests_total: int = 400, latency: float = 0.05, slow_rate: float = 0.03,
+              slow_latency: float = 1.0, workers: int = 8):
+    """Compare latency percentiles with and without hedging against a mock API with a slow tail"""
+    from mock_stability import start_mock_server
+
+    server = start_mock_server(port=0, latency=latency, slow_rate=slow_rate, slow_latency=slow_latency)
+    stability.API_HOST = f"http://127.0.0.1:{server.server_address[1]}"
+    body = {"text_prompts": [{"text": "benchmark", "weight": 1}], "width": 512, "height": 512,
+            "samples": 1, "steps": 50}
+
+    def timed_call(call):
+        started = time.perf_counter()
+        call()
+        return time.perf_counter() - started
+
+    plain = lambda: stability.text_to_image('local', body)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda _: timed_call(plain), range(HEDGE_MIN_SAMPLES)))
+        baseline = np.array(list(pool.map(lambda _: timed_call(plain), range(requests_total))))
+
+        dispatcher = HedgedDispatcher()
+        hedged_call = lambda: dispatcher.call(
+            lambda engine, cancel: stability.text_to_image('local', body, engine=engine, cancel=cancel),
+            cost=stability.estimate_credits(body))
+        # Warm up so the hedge delay comes from observed latencies
+        list(pool.map(lambda _: timed_call(hedged_call), range(HEDGE_MIN_SAMPLES)))
+        before = metrics.counter_values()
+        hedged = np.array(list(pool.map(lambda _: timed_call(hedged_call), range(requests_total))))
+    # Let losers still in flight report their spend
+    dispatcher._pool.shutdown(wait=True)
+    server.shutdown()
+
+    after = metrics.counter_values()
+    delta = lambda key: after.get(key, 0) - before.get(key, 0)
+    engine = dispatcher.engines[0]
+    hedges = delta(f'generation_attempts_total{{engine="{engine}",role="hedge"}}')
+    wasted = delta(f'hedge_wasted_credits_total{{engine="{engine}"}}')
+    spent = requests_total * stability.estimate_credits(body)
+    for name, samples in (('direct', baseline), ('hedged', hedged)):
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+        print(f"{name:>7}: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms")
+    print(f"hedges sent: {hedges:.0f} ({hedges / requests_total:.1%}), "
+          f"extra credits: {wasted:.1f} ({wasted / spent:.1%} of {spent:.1f})")
+
+
+if __name__ == "__main__":
+    benchmark()
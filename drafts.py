@@ -0,0 +1,104 @@
+import io
+import os
+import time
+from PIL import Image
+import dispatch
+import metrics
+import stability
+from history import make_thumbnail
+
+# Draft mode renders a few low-step previews in one request. Only the one the
+# user picks is re-rendered at full quality, with the same seed and
+# parameters, so it keeps the draft's composition.
+DRAFT_STEPS = int(os.getenv('DRAFT_STEPS', '15'))
+DRAFT_COUNT = int(os.getenv('DRAFT_COUNT', '4'))
+FULL_STEPS = 50
+
+
+@metrics.timed("image.drafts")
+def generate_drafts(api_key: str, prompt: str, style: str = "", width: int = 1024, height: int = 1024,
+                    count: int = DRAFT_COUNT) -> list:
+    """[{'seed', 'preview'}] for `count` low-step drafts; previews are JPEG thumbnails"""
+    body = stability.build_image_body(prompt, style, width, height, steps=DRAFT_STEPS, samples=count)
+    artifacts = dispatch.generate(api_key, body)
+    metrics.inc("draft_images_total", len(artifacts))
+    metrics.inc("draft_credits_total", stability.estimate_credits(body))
+
+    drafts = []
+    for artifact in artifacts:
+        image = Image.open(io.BytesIO(artifact['image']))
+        drafts.append({'seed': artifact['seed'], 'preview': make_thumbnail(image)})
+    return drafts
+
+
+def refine_body(prompt: str, style: str, width: int, height: int, seed: int) -> dict:
+    """Full-quality request body for a chosen draft"""
+    metrics.inc("drafts_accepted_total")
+    return stability.build_image_body(prompt, style, width, height, steps=FULL_STEPS, seed=seed)
+
+
+def benchmark(users: int = 100, accept_rate: float = 0.3, latency: float = 1.0, workers: int = 4):
+    """Credits and latency per accepted image: always-50-steps vs draft-then-refine
+
+    Each simulated user keeps generating until they like a result, which
+    happens with probability `accept_rate` per candidate image. Without drafts
+    every candidate is a full 50-step image; with drafts each round is one
+    request for DRAFT_COUNT low-step previews, then one refine. Few users
+    run at once so client-side decoding doesn't swamp the timings.
+    """
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from mock_stability import start_mock_server
+
+    server = start_mock_server(port=0, latency=latency)
+    stability.API_HOST = f"http://127.0.0.1:{server.server_address[1]}"
+    prompt, style, width, height = "a lighthouse at dusk", "Cinematic", 1024, 576
+    draft_cost = stability.estimate_credits(
+        stability.build_image_body(prompt, style, width, height, steps=DRAFT_STEPS, samples=DRAFT_COUNT))
+
+    def always_full(user):
+        rng = random.Random(user)
+        credits, started = 0.0, time.perf_counter()
+        while True:
+            body = stability.build_image_body(prompt, style, width, height)
+            dispatch.generate('local', body)
+            credits += stability.estimate_credits(body)
+            if rng.random() < accept_rate:
+                return credits, time.perf_counter() - started
+
+    def draft_then_refine(user):
+        rng = random.Random(user)
+        credits, started = 0.0, time.perf_counter()
+        while True:
+            drafts = generate_drafts('local', prompt, style, width, height)
+            credits += draft_cost
+            # The same candidates the user would have accepted at full quality
+            liked = [draft for draft in drafts if rng.random() < accept_rate]
+            if liked:
+                break
+        body = refine_body(prompt, style, width, height, liked[0]['seed'])
+        artifact = dispatch.generate('local', body)[0]
+        if artifact['seed'] != liked[0]['seed']:
+            raise RuntimeError("Refined image came back with a different seed")
+        credits += stability.estimate_credits(body)
+        return credits, time.perf_counter() - started
+
+    results = {}
+    with ThreadPoolExecutor(workers) as pool:
+        for name, flow in (('always 50 steps', always_full), ('draft + refine', draft_then_refine)):
+            runs = list(pool.map(flow, range(users)))
+            results[name] = (sum(c for c, _ in runs) / users, sum(t for _, t in runs) / users)
+    server.shutdown()
+
+    print(f"{users} users, {accept_rate:.0%} of candidates acceptable, {latency:.1f}s per 50-step image, "
+          f"{DRAFT_COUNT} drafts at {DRAFT_STEPS} steps")
+    for name, (credits, seconds) in results.items():
+        print(f"{name:>16}: {credits:.2f} credits, {seconds:.1f}s per accepted image")
+    (full_credits, full_seconds), (draft_credits, draft_seconds) = results.values()
+    print(f"saved per accepted image: {full_credits - draft_credits:.2f} credits "
+          f"({1 - draft_credits / full_credits:.0%}), {full_seconds - draft_seconds:.1f}s "
+          f"({1 - draft_seconds / full_seconds:.0%})")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,237 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import metrics
+
+# Budgets cover bytes held in process memory (thumbnails + full PNGs not yet
+# spilled). Full PNGs beyond the budget are written to HISTORY_DIR.
+HISTORY_DIR = os.getenv('HISTORY_DIR', os.path.join(tempfile.gettempdir(), 'ai-art-history'))
+SESSION_BUDGET_BYTES = int(os.getenv('HISTORY_SESSION_BUDGET_MB', '16')) * 1024 * 1024
+GLOBAL_BUDGET_BYTES = int(os.getenv('HISTORY_GLOBAL_BUDGET_MB', '256')) * 1024 * 1024
+MAX_ENTRIES_PER_SESSION = 50
+SESSION_TTL_SECONDS = 6 * 60 * 60
+EXPIRE_INTERVAL_SECONDS = 60
+THUMBNAIL_SIZE = (256, 256)
+
+
+class HistoryEntry:
+    __slots__ = ('id', 'session_id', 'thumbnail', 'png', 'path', 'meta', 'created_at', 'last_used')
+
+    def __init__(self, session_id: str, thumbnail: bytes, png: bytes, meta: dict):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.thumbnail = thumbnail
+        self.png = png
+        self.path = None
+        self.meta = meta
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    @property
+    def resident_bytes(self) -> int:
+        # The PNG stops counting once it has a spill path, even while still being written
+        return len(self.thumbnail) + (len(self.png) if self.path is None else 0)
+
+
+def make_thumbnail(image) -> bytes:
+    """Encode a small JPEG preview of a PIL image"""
+    thumb = image.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE)
+    if thumb.mode != 'RGB':
+        thumb = thumb.convert('RGB')
+    output = io.BytesIO()
+    thumb.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+class ImageHistory:
+    """Per-session image history with bounded memory and LRU spill to disk"""
+
+    def __init__(self, directory: str = HISTORY_DIR, session_budget: int = SESSION_BUDGET_BYTES,
+                 global_budget: int = GLOBAL_BUDGET_BYTES, max_entries: int = MAX_ENTRIES_PER_SESSION,
+                 session_ttl: float = SESSION_TTL_SECONDS, expire_interval: float = EXPIRE_INTERVAL_SECONDS):
+        self.directory = directory
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.max_entries = max_entries
+        self.session_ttl = session_ttl
+        self._lock = threading.Lock()
+        # Entries whose full PNG is still in memory, least recently used first
+        self._in_memory = OrderedDict()
+        self._sessions = {}
+        self._session_bytes = {}
+        self._session_seen = {}
+        self._resident = 0
+        # Files of removed entries, deleted once the lock is released
+        self._doomed = []
+        os.makedirs(directory, exist_ok=True)
+        self._stopped = threading.Event()
+        # Idle sessions never call add(), so their files are reclaimed here
+        threading.Thread(target=self._expire_loop, args=(expire_interval,), name='history-expiry',
+                         daemon=True).start()
+
+    def close(self):
+        self._stopped.set()
+
+    def add(self, session_id: str, image, png: bytes, **meta) -> str:
+        """Store a generated image and return its entry id"""
+        entry = HistoryEntry(session_id, make_thumbnail(image), png, meta)
+        with self._lock:
+            self._expire_sessions()
+            self._sessions.setdefault(session_id, OrderedDict())[entry.id] = entry
+            self._session_seen[session_id] = entry.created_at
+            self._in_memory[entry.id] = entry
+            self._account(entry, entry.resident_bytes)
+
+            entries = self._sessions[session_id]
+            while len(entries) > self.max_entries:
+                self._remove(next(iter(entries.values())))
+            spills = self._enforce_session_budget(session_id) + self._enforce_global_budget()
+            self._publish()
+        self._write_spills(spills)
+        return entry.id
+
+    def entries(self, session_id: str) -> list:
+        """List a session's entries, newest first"""
+        with self._lock:
+            self._session_seen[session_id] = time.time()
+            return list(reversed(self._sessions.get(session_id, {}).values()))
+
+    def get_png(self, session_id: str, entry_id: str) -> bytes:
+        """Load the full PNG for an entry from memory or disk"""
+        with self._lock:
+            entry = self._sessions.get(session_id, {}).get(entry_id)
+            if entry is None:
+                raise KeyError(entry_id)
+            entry.last_used = time.time()
+            # Still in memory, or spilling and not yet written
+            if entry.png is not None:
+                if entry.id in self._in_memory:
+                    self._in_memory.move_to_end(entry.id)
+                return entry.png
+            path = entry.path
+        metrics.inc("history_disk_reads_total")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def drop_session(self, session_id: str):
+        """Forget a session and delete its spilled files"""
+        with self._lock:
+            for entry in list(self._sessions.get(session_id, {}).values()):
+                self._remove(entry)
+            self._publish()
+        self._delete_files()
+
+    def resident_bytes(self, session_id: str = None) -> int:
+        """Bytes held in memory, for one session or the whole store"""
+        with self._lock:
+            if session_id is not None:
+                return self._session_bytes.get(session_id, 0)
+            return self._resident
+
+    def _account(self, entry: HistoryEntry, delta: int):
+        self._resident += delta
+        self._session_bytes[entry.session_id] = self._session_bytes.get(entry.session_id, 0) + delta
+
+    def _claim_spill(self, entry: HistoryEntry) -> HistoryEntry:
+        # The PNG leaves the budget now; _write_spills writes it without the lock
+        entry.path = os.path.join(self.directory, f"{entry.id}.png")
+        self._account(entry, -len(entry.png))
+        self._in_memory.pop(entry.id, None)
+        return entry
+
+    def _write_spills(self, entries: list):
+        written = []
+        try:
+            for entry in entries:
+                with open(entry.path, 'wb') as f:
+                    f.write(entry.png)
+                written.append(entry)
+                metrics.inc("history_spills_total")
+        finally:
+            with self._lock:
+                for entry in entries:
+                    present = entry.id in self._sessions.get(entry.session_id, {})
+                    if entry in written:
+                        entry.png = None
+                        if not present:
+                            # Removed while its file was being written
+                            self._doomed.append(entry.path)
+                    elif present:
+                        # Keep the PNG in memory if it couldn't be written
+                        entry.path = None
+                        self._account(entry, len(entry.png))
+                        self._in_memory[entry.id] = entry
+            self._delete_files()
+
+    def _delete_files(self):
+        with self._lock:
+            paths, self._doomed = self._doomed, []
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _remove(self, entry: HistoryEntry):
+        self._account(entry, -entry.resident_bytes)
+        self._in_memory.pop(entry.id, None)
+        session = self._sessions.get(entry.session_id)
+        if session is not None:
+            session.pop(entry.id, None)
+            if not session:
+                del self._sessions[entry.session_id]
+                self._session_bytes.pop(entry.session_id, None)
+                self._session_seen.pop(entry.session_id, None)
+        if entry.path:
+            self._doomed.append(entry.path)
+
+    def _enforce_session_budget(self, session_id: str) -> list:
+        spills = []
+        for entry in list(self._in_memory.values()):
+            if self._session_bytes.get(session_id, 0) <= self.session_budget:
+                break
+            if entry.session_id == session_id:
+                spills.append(self._claim_spill(entry))
+        return spills
+
+    def _enforce_global_budget(self) -> list:
+        spills = []
+        while self._resident > self.global_budget and self._in_memory:
+            spills.append(self._claim_spill(next(iter(self._in_memory.values()))))
+        return spills
+
+    def _expire_sessions(self):
+        cutoff = time.time() - self.session_ttl
+        for session_id, seen in list(self._session_seen.items()):
+            if seen < cutoff:
+                for entry in list(self._sessions.get(session_id, {}).values()):
+                    self._remove(entry)
+
+    def _expire_loop(self, interval: float):
+        while not self._stopped.wait(interval):
+            with self._lock:
+                self._expire_sessions()
+                self._publish()
+            self._delete_files()
+
+    def _publish(self):
+        metrics.set_gauge("history_resident_bytes", self._resident)
+        metrics.set_gauge("history_sessions", len(self._sessions))
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history() -> ImageHistory:
+    """Get the process-wide history store shared by all sessions"""
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = ImageHistory()
+        return _history
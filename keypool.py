@@ -0,0 +1,330 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+import requests
+import metrics
+import stability
+
+# Upstream calls are spread over a pool of Stability API keys, so one
+# account's rate limit doesn't cap the whole fleet. Each key learns its own
+# concurrency limit (cut on 429, grown slowly on success), backs off when it
+# is rate limited, and is drained while its error rate is high, it is
+# rejected, or its credit balance runs low.
+KEY_INITIAL_CONCURRENCY = float(os.getenv('KEY_INITIAL_CONCURRENCY', '4'))
+KEY_MAX_CONCURRENCY = 64.0
+# Wait this long for a key to become available before failing the call
+KEY_WAIT_SECONDS = float(os.getenv('KEY_WAIT_SECONDS', '30'))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# After a 429, hold the learned limit this long before probing above it again
+PROBE_HOLD_SECONDS = 10.0
+
+KEY_ERROR_WINDOW = 50
+KEY_MIN_REQUESTS = 10
+KEY_MAX_ERROR_RATE = float(os.getenv('KEY_MAX_ERROR_RATE', '0.5'))
+DRAIN_SECONDS = 60.0
+# A rejected key (401/403) is probably revoked; keep it out much longer
+REJECTED_DRAIN_SECONDS = 3600.0
+
+# Keys below this balance are only used when nothing else is available
+MIN_BALANCE_CREDITS = float(os.getenv('KEY_MIN_BALANCE_CREDITS', '10'))
+BALANCE_REFRESH_SECONDS = 300.0
+
+
+class NoKeyAvailable(Exception):
+    """Raised when every key is throttled, drained or at its concurrency limit"""
+
+
+def key_label(key: str) -> str:
+    """Short fingerprint used in metrics and logs instead of the key"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]
+
+
+class KeyState:
+    """Load, limits and health of one API key (guarded by the pool's lock)"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.label = key_label(key)
+        self.in_flight = 0
+        self.limit = KEY_INITIAL_CONCURRENCY
+        self.throttles = 0
+        self.backoff_until = 0.0
+        self.hold_until = 0.0
+        self.drained_until = 0.0
+        self.drain_reason = None
+        self.balance = None
+        self.balance_at = 0.0
+        self.last_used = 0.0
+        self._outcomes = deque(maxlen=KEY_ERROR_WINDOW)
+
+    def available(self, now: float) -> bool:
+        return (now >= self.backoff_until and now >= self.drained_until
+                and self.in_flight < max(1, int(self.limit)))
+
+    def out_of_service(self, now: float) -> bool:
+        """Drained because the API rejected the key or it ran out of credits"""
+        return now < self.drained_until and self.drain_reason in ('rejected', 'exhausted')
+
+    @property
+    def low_balance(self) -> bool:
+        return self.balance is not None and self.balance < MIN_BALANCE_CREDITS
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def _gauges(self):
+        metrics.set_gauge("stability_key_in_flight", self.in_flight, key=self.label)
+        metrics.set_gauge("stability_key_limit", self.limit, key=self.label)
+        metrics.set_gauge("stability_key_utilisation", self.in_flight / max(1, int(self.limit)), key=self.label)
+        metrics.set_gauge("stability_key_drained", int(time.monotonic() < self.drained_until), key=self.label)
+        if self.balance is not None:
+            metrics.set_gauge("stability_key_balance", self.balance, key=self.label)
+
+
+class KeyPool:
+    """Pick the least-loaded healthy key for each upstream call"""
+
+    def __init__(self, keys: list, wait: float = KEY_WAIT_SECONDS):
+        if not keys:
+            raise ValueError("At least one API key is required")
+        self.keys = [KeyState(key) for key in dict.fromkeys(keys)]
+        self.wait = wait
+        self._cond = threading.Condition()
+        self._waiters = deque()
+        self._refresher = None
+
+    def _pick(self, now: float):
+        candidates = [state for state in self.keys if state.available(now)]
+        funded = [state for state in candidates if not state.low_balance]
+        if not candidates:
+            return None
+        # Least loaded relative to its limit; ties go to the least recently used
+        return min(funded or candidates, key=lambda s: (s.in_flight / s.limit, s.last_used))
+
+    def _acquire(self) -> KeyState:
+        deadline = time.monotonic() + self.wait
+        ticket = object()
+        with self._cond:
+            # First come, first served, so no caller starves behind later ones
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    state = self._pick(now) if self._waiters[0] is ticket else None
+                    if state is not None:
+                        state.in_flight += 1
+                        state.last_used = now
+                        state._gauges()
+                        return state
+                    if all(s.out_of_service(now) for s in self.keys):
+                        metrics.inc("stability_key_waits_total", outcome="no_usable_key")
+                        raise NoKeyAvailable("Every Stability API key is rejected or out of credits")
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        metrics.inc("stability_key_waits_total", outcome="timed_out")
+                        raise NoKeyAvailable("All Stability API keys are busy, throttled or unavailable")
+                    # Wake when a key frees up or the earliest backoff ends
+                    wakeups = [s.backoff_until - now for s in self.keys if s.backoff_until > now]
+                    wakeups += [s.drained_until - now for s in self.keys if s.drained_until > now]
+                    self._cond.wait(min([remaining, *wakeups]))
+            finally:
+                self._waiters.remove(ticket)
+                self._cond.notify_all()
+
+    def _release(self, state: KeyState, outcome: str, error: Exception = None, cost: float = 0.0):
+        with self._cond:
+            now = time.monotonic()
+            state.in_flight -= 1
+            if outcome == 'ok':
+                state.throttles = 0
+                if now >= state.hold_until:
+                    state.limit = min(KEY_MAX_CONCURRENCY, state.limit + 1 / state.limit)
+                state._outcomes.append(0)
+                if state.balance is not None:
+                    state.balance -= cost
+            elif outcome == 'throttled':
+                # The requests still in flight are what the key accepts, so
+                # that becomes its limit for a while. A 429 with nothing else
+                # in flight is a rate limit rather than a concurrency one and
+                # pauses the key, longer each time until a request succeeds.
+                state.throttles += 1
+                state.limit = max(1.0, min(state.limit, float(state.in_flight)))
+                state.hold_until = now + PROBE_HOLD_SECONDS
+                if state.in_flight == 0 and now >= state.backoff_until:
+                    backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (state.throttles - 1))
+                    state.backoff_until = now + max(backoff, getattr(error, 'retry_after', None) or 0)
+            elif outcome == 'rejected':
+                state.drained_until = now + REJECTED_DRAIN_SECONDS
+                state.drain_reason = outcome
+            elif outcome == 'exhausted':
+                # Until the next balance refresh shows credits again
+                state.balance = 0.0
+                state.drained_until = now + BALANCE_REFRESH_SECONDS
+                state.drain_reason = outcome
+            elif outcome == 'error':
+                state._outcomes.append(1)
+                if len(state._outcomes) >= KEY_MIN_REQUESTS and state.error_rate > KEY_MAX_ERROR_RATE:
+                    state.drained_until = now + DRAIN_SECONDS
+                    state.drain_reason = 'errors'
+                    state._outcomes.clear()
+                    metrics.inc("stability_key_drains_total", key=state.label, reason="errors")
+            if outcome in ('rejected', 'exhausted'):
+                metrics.inc("stability_key_drains_total", key=state.label, reason=outcome)
+            state._gauges()
+            self._cond.notify_all()
+        metrics.inc("stability_key_requests_total", key=state.label, outcome=outcome)
+
+    def call(self, request, cost: float = 0.0):
+        """Run request(api_key) on the best available key
+
+        A throttled (429), rejected (401/403) or out-of-credit (402) key is
+        benched and the call moves on to another key; other errors are
+        raised to the caller. Once every key is rejected or out of credit,
+        the last of those errors is raised instead of waiting for a key.
+        """
+        while True:
+            state = self._acquire()
+            try:
+                result = request(state.key)
+            except stability.StabilityError as e:
+                outcome = {429: 'throttled', 401: 'rejected', 403: 'rejected', 402: 'exhausted'}.get(e.status_code)
+                if outcome is None:
+                    self._release(state, 'error' if e.status_code >= 500 else 'ok', e)
+                    raise
+                self._release(state, outcome, e)
+                if outcome != 'throttled' and self._out_of_service():
+                    raise
+                continue
+            except stability.RequestCancelled:
+                self._release(state, 'ok', cost=cost)
+                raise
+            except requests.RequestException as e:
+                self._release(state, 'error', e)
+                raise
+            except Exception:
+                self._release(state, 'ok')
+                raise
+            self._release(state, 'ok', cost=cost)
+            return result
+
+    def _out_of_service(self) -> bool:
+        now = time.monotonic()
+        with self._cond:
+            return all(state.out_of_service(now) for state in self.keys)
+
+    def refresh_balances(self):
+        """Fetch each key's credit balance; keys whose balance can't be read keep the last value"""
+        for state in self.keys:
+            try:
+                balance = stability.get_balance(state.key)
+            except Exception:
+                continue
+            with self._cond:
+                state.balance = balance
+                state.balance_at = time.monotonic()
+                if balance >= MIN_BALANCE_CREDITS and state.drained_until > state.balance_at \
+                        and state.drained_until - state.balance_at <= BALANCE_REFRESH_SECONDS:
+                    # Topped up since it ran out
+                    state.drained_until = 0.0
+                state._gauges()
+                self._cond.notify_all()
+
+    def start_balance_refresh(self, interval: float = BALANCE_REFRESH_SECONDS):
+        """Refresh balances now and then every `interval` seconds in a daemon thread"""
+        if self._refresher is not None:
+            return
+
+        def run():
+            while True:
+                self.refresh_balances()
+                time.sleep(interval)
+
+        self._refresher = threading.Thread(target=run, name='key-balances', daemon=True)
+        self._refresher.start()
+
+    def snapshot(self) -> list:
+        """Per-key state for display"""
+        now = time.monotonic()
+        with self._cond:
+            return [{
+                'key': state.label,
+                'in_flight': state.in_flight,
+                'limit': round(state.limit, 1),
+                'balance': state.balance,
+                'error_rate': state.error_rate,
+                'backed_off': now < state.backoff_until,
+                'drained': now < state.drained_until,
+            } for state in self.keys]
+
+
+def configured_keys() -> list:
+    """Keys from STABILITY_API_KEYS (comma-separated), else STABILITY_API_KEY"""
+    keys = [k.strip() for k in os.getenv('STABILITY_API_KEYS', '').split(',') if k.strip()]
+    if not keys and os.getenv('STABILITY_API_KEY'):
+        keys = [os.getenv('STABILITY_API_KEY')]
+    return keys
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(keys=None) -> KeyPool:
+    """Get the process-wide pool for a set of keys (default: configured_keys())"""
+    keys = tuple(keys if keys is not None else configured_keys())
+    with _pools_lock:
+        pool = _pools.get(keys)
+        if pool is None:
+            pool = _pools[keys] = KeyPool(list(keys))
+            pool.start_balance_refresh()
+        return pool
+
+
+def as_pool(api_key) -> KeyPool:
+    """Accept a KeyPool or a single key string"""
+    return api_key if isinstance(api_key, KeyPool) else get_key_pool((api_key,))
+
+
+def benchmark(requests_total: int = 600, workers: int = 24, latency: float = 0.2):
+    """Throughput through one key vs a pool of keys with different per-key limits on the mock API"""
+    from concurrent.futures import ThreadPoolExecutor
+    from mock_stability import start_mock_server
+
+    limits = {'key-small': 2, 'key-medium': 4, 'key-large': 8}
+    credits = {'key-small': 1e6, 'key-medium': 1e6, 'key-large': 1e6, 'key-broke': 0.0}
+    # key-broke has no credits left and key-revoked is unknown to the API
+    server = start_mock_server(port=0, latency=latency, key_limits=limits, key_credits=credits)
+    stability.API_HOST = f"http://127.0.0.1:{server.server_address[1]}"
+    body = {"text_prompts": [{"text": "benchmark", "weight": 1}], "width": 512, "height": 512,
+            "samples": 1, "steps": 50}
+    cost = stability.estimate_credits(body)
+
+    for name, keys in (('one key', ['key-small']),
+                       ('pool', ['key-small', 'key-medium', 'key-large', 'key-broke', 'key-revoked'])):
+        pool = KeyPool(keys)
+        pool.refresh_balances()
+        before = metrics.counter_values()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda _: pool.call(lambda key: stability.text_to_image(key, body), cost),
+                              range(requests_total)))
+        elapsed = time.perf_counter() - started
+        after = metrics.counter_values()
+        print(f"{name}: {requests_total / elapsed:.1f} requests/s ({requests_total} requests, {workers} callers)")
+        for state, info in zip(pool.keys, pool.snapshot()):
+            counts = {outcome: after.get(f'stability_key_requests_total{{key="{state.label}",outcome="{outcome}"}}', 0)
+                      - before.get(f'stability_key_requests_total{{key="{state.label}",outcome="{outcome}"}}', 0)
+                      for outcome in ('ok', 'throttled', 'rejected', 'exhausted', 'error')}
+            served = {outcome: int(n) for outcome, n in counts.items() if n}
+            print(f"  {state.key:<12} limit {limits.get(state.key, '-')!s:>2}, learned {info['limit']:>4}, "
+                  f"balance {'-' if info['balance'] is None else round(info['balance'])}, "
+                  f"{'drained' if info['drained'] else 'healthy'}: {served}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark()
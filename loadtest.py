@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+import requests
+import websockets
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ClientState_pb2 import ClientState
+from streamlit.proto.Common_pb2 import FileURLsRequest, FileUploaderState, UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState, WidgetStates
+
+# Drives simulated browser sessions through a real `streamlit run app.py`
+# server over Streamlit's websocket protocol, with the mock Stability API
+# upstream, and reports where one server process saturates.
+#
+# Streamlit's AppTest swaps a process-global runtime in and out around every
+# run, so it can't run sessions concurrently; a headless client can.
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+FLOWS = ('image', 'video', 'dashboard')
+# Each session signs in as its own seeded Pro account
+SEED_EMAIL = 'loadtest{}@example.com'
+SEED_PASSWORD = 'loadtest-password'
+# A level counts as saturated once throughput grows by less than this
+SATURATION_GAIN = 1.1
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class RunFailed(Exception):
+    """Raised when a script run shows an error or raises"""
+
+
+class BrowserSession:
+    """One headless browser tab"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session_id = None
+        self.pages = {}
+        self.main_page = ''
+        # widget key (or label, for unkeyed widgets) -> widget id
+        self.widgets = {}
+        self._socket = None
+
+    async def connect(self):
+        url = self.base_url.replace('http', 'ws', 1) + '/_stcore/stream'
+        self._socket = await websockets.connect(url, subprotocols=['streamlit'], max_size=None)
+
+    async def close(self):
+        await self._socket.close()
+
+    async def _send(self, message: BackMsg):
+        await self._socket.send(message.SerializeToString())
+
+    async def _receive(self) -> ForwardMsg:
+        message = ForwardMsg()
+        message.ParseFromString(await self._socket.recv())
+        kind = message.WhichOneof('type')
+        if kind == 'new_session':
+            new_session = message.new_session
+            self.session_id = new_session.initialize.session_id or self.session_id
+            self.main_page = new_session.main_script_hash
+            self.pages.update({page.page_name: page.page_script_hash for page in new_session.app_pages})
+        elif kind == 'navigation':
+            # Newer releases list the pages/ scripts in a separate message
+            self.pages.update({page.page_name: page.page_script_hash for page in message.navigation.app_pages})
+        return message
+
+    async def rerun(self, widgets: list = (), page: str = None):
+        """Rerun the script with the given widget states and wait for it to finish"""
+        message = BackMsg()
+        message.rerun_script.CopyFrom(ClientState(
+            widget_states=WidgetStates(widgets=list(widgets)),
+            page_script_hash=self.pages.get(page, self.main_page) if page else self.main_page,
+        ))
+        await self._send(message)
+        error = None
+        while True:
+            reply = await self._receive()
+            kind = reply.WhichOneof('type')
+            if kind == 'delta' and reply.delta.WhichOneof('type') == 'new_element':
+                element = reply.delta.new_element
+                which = element.WhichOneof('type')
+                if which == 'exception':
+                    error = error or element.exception.message
+                elif which == 'alert' and element.alert.format == Alert.ERROR:
+                    error = error or element.alert.body
+                widget = getattr(element, which) if which else None
+                widget_id = getattr(widget, 'id', '')
+                if widget_id:
+                    key = widget_id.rsplit('-', 1)[-1]
+                    # Charts have ids but no label; nothing clicks them
+                    key = key if key != 'None' else getattr(widget, 'label', None)
+                    if key:
+                        self.widgets[key] = widget_id
+            elif kind == 'script_finished' and reply.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                break
+        if error:
+            raise RunFailed(error)
+
+    async def upload(self, name: str, data: bytes) -> UploadedFileInfo:
+        """Upload a file the way st.file_uploader does and return its widget entry"""
+        request_id = uuid.uuid4().hex
+        message = BackMsg()
+        message.file_urls_request.CopyFrom(FileURLsRequest(
+            request_id=request_id, file_names=[name], session_id=self.session_id))
+        await self._send(message)
+        while True:
+            reply = await self._receive()
+            if reply.WhichOneof('type') == 'file_urls_response' and reply.file_urls_response.response_id == request_id:
+                urls = reply.file_urls_response.file_urls[0]
+                break
+        response = await asyncio.to_thread(
+            requests.put, self.base_url + urls.upload_url, files={'file': (name, data, 'image/jpeg')})
+        response.raise_for_status()
+        return UploadedFileInfo(name=name, size=len(data), file_id=urls.file_id, file_urls=urls)
+
+    async def sign_in(self, email: str, password: str):
+        """Log in through the Login page so later runs see a signed-in user"""
+        await self.rerun(page='login')
+        await self.rerun([self.text('login_email', email), self.text('login_password', password),
+                          self.click('Log in')], page='login')
+        if 'logout' not in self.widgets:
+            raise RunFailed(f"Couldn't sign in as {email}")
+
+    def text(self, key: str, value: str) -> WidgetState:
+        return WidgetState(id=self.widgets[key], string_value=value)
+
+    def click(self, key: str) -> WidgetState:
+        return WidgetState(id=self.widgets[key], trigger_value=True)
+
+    def files(self, key: str, *infos: UploadedFileInfo) -> WidgetState:
+        return WidgetState(id=self.widgets[key],
+                           file_uploader_state_value=FileUploaderState(uploaded_file_info=list(infos)))
+
+
+async def _run_session(base_url: str, email: str, upload: bytes, deadline: float, samples: dict, errors: list):
+    session = BrowserSession(base_url)
+    await session.connect()
+    try:
+        await session.rerun()
+        await session.sign_in(email, SEED_PASSWORD)
+        uploaded = await session.upload('upload.jpg', upload)
+        step = 0
+        while time.monotonic() < deadline:
+            flow = FLOWS[step % len(FLOWS)]
+            step += 1
+            started = time.perf_counter()
+            try:
+                if flow == 'image':
+                    await session.rerun([session.text('image_prompt', f"a lighthouse in a storm {step}"),
+                                         session.click('image_generate')])
+                elif flow == 'video':
+                    attached = session.files("Upload an image to animate", uploaded)
+                    # The first run with the file attached renders the video controls
+                    if "Generate Video" not in session.widgets:
+                        await session.rerun([attached])
+                        started = time.perf_counter()
+                    await session.rerun([attached, session.click("Generate Video")])
+                else:
+                    # The next flow's rerun navigates back to the main page
+                    await session.rerun(page='dashboard')
+                samples[flow].append(time.perf_counter() - started)
+            except RunFailed as e:
+                errors.append((flow, e))
+    finally:
+        await session.close()
+
+
+def _process_usage(pid: int) -> tuple:
+    """(CPU seconds, RSS bytes) of a process from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    with open(f'/proc/{pid}/statm') as f:
+        rss = int(f.read().split()[1]) * PAGE_SIZE
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss
+
+
+async def run_level(base_url: str, pid: int, sessions: int, duration: float, upload: bytes) -> dict:
+    """Run `sessions` concurrent sessions for `duration` seconds and summarise them"""
+    samples = {flow: [] for flow in FLOWS}
+    errors = []
+    cpu_before, _ = _process_usage(pid)
+    started = time.monotonic()
+    tasks = [asyncio.create_task(_run_session(base_url, SEED_EMAIL.format(n), upload, started + duration,
+                                              samples, errors))
+             for n in range(sessions)]
+    peak_rss = 0
+    while not all(task.done() for task in tasks):
+        peak_rss = max(peak_rss, _process_usage(pid)[1])
+        await asyncio.sleep(0.2)
+    for task in tasks:
+        task.result()
+    wall = time.monotonic() - started
+    cpu_after, _ = _process_usage(pid)
+
+    latencies = np.array([value for values in samples.values() for value in values])
+    percentile = lambda values, q: float(np.percentile(values, q)) if len(values) else 0.0
+    return {
+        'sessions': sessions,
+        'completed': len(latencies),
+        'errors': len(errors),
+        'first_error': f"{errors[0][0]}: {errors[0][1]}"[:200] if errors else None,
+        'throughput': len(latencies) / wall,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'flows': {flow: percentile(values, 95) for flow, values in samples.items()},
+        'cpu_cores': (cpu_after - cpu_before) / wall,
+        'peak_rss_mb': peak_rss / 1024 / 1024,
+    }
+
+
+def _upload_bytes() -> bytes:
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    output = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (1536, 2048, 3), dtype=np.uint8)).save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def seed_users(database_url: str, count: int):
+    """Create the Pro accounts sessions sign in as, skipping ones that exist"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import auth
+    from models import User, create_schema
+
+    engine = create_schema(create_engine(database_url))
+    db = sessionmaker(bind=engine)()
+    try:
+        emails = [SEED_EMAIL.format(n) for n in range(count)]
+        existing = {email for email, in db.query(User.email).filter(User.email.in_(emails))}
+        # One hash shared by every account keeps seeding off the bcrypt cost
+        password = auth.hash_password(SEED_PASSWORD)
+        db.add_all([User(email=email, password=password, subscription_type='pro', credits_remaining=10 ** 6)
+                    for email in emails if email not in existing])
+        db.commit()
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def start_app_server(port: int, env: dict) -> subprocess.Popen:
+    """Start `streamlit run app.py` headless and wait until it is healthy"""
+    process = subprocess.Popen([
+        sys.executable, '-m', 'streamlit', 'run', APP_SCRIPT,
+        '--server.headless', 'true', '--server.port', str(port),
+        '--server.enableXsrfProtection', 'false', '--server.fileWatcherType', 'none',
+        '--browser.gatherUsageStats', 'false',
+    ], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("streamlit exited during startup")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/_stcore/health", timeout=1).ok:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("streamlit did not become healthy")
+
+
+def run(levels: list, duration: float, latency: float, port: int, database_url: str = None) -> list:
+    """Ramp through session counts and report the level where throughput stops scaling"""
+    from mock_stability import start_mock_server
+
+    workdir = tempfile.mkdtemp()
+    database_url = database_url or f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    seed_users(database_url, max(levels))
+    mock = start_mock_server(port=0, latency=latency)
+    env = dict(os.environ,
+               STABILITY_API_HOST=f"http://127.0.0.1:{mock.server_address[1]}",
+               STABILITY_API_KEY=os.getenv('STABILITY_API_KEY', 'local'),
+               DATABASE_URL=database_url,
+               IMAGE_DIR=os.getenv('IMAGE_DIR', os.path.join(workdir, 'images')),
+               METRICS_PORT='0')
+    server = start_app_server(port, env)
+    base_url = f"http://127.0.0.1:{port}"
+    upload = _upload_bytes()
+
+    results = []
+    try:
+        _, idle_rss = _process_usage(server.pid)
+        print(f"server pid {server.pid}, idle RSS {idle_rss / 1024 / 1024:.0f} MB, upstream latency {latency}s")
+        print(f"{'sessions':>8} {'runs/s':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+              f"{'image':>7} {'video':>7} {'dash':>7} {'cpu':>5} {'rss MB':>7} {'errors':>6}")
+        for sessions in levels:
+            result = asyncio.run(run_level(base_url, server.pid, sessions, duration, upload))
+            results.append(result)
+            flows = result['flows']
+            print(f"{sessions:>8} {result['throughput']:>7.1f} {result['p50'] * 1000:>7.0f} "
+                  f"{result['p95'] * 1000:>7.0f} {result['p99'] * 1000:>7.0f} {flows['image'] * 1000:>7.0f} "
+                  f"{flows['video'] * 1000:>7.0f} {flows['dashboard'] * 1000:>7.0f} {result['cpu_cores']:>5.2f} "
+                  f"{result['peak_rss_mb']:>7.0f} {result['errors']:>6}")
+            if result['first_error']:
+                print(f"         first error: {result['first_error']}")
+    finally:
+        server.terminate()
+        server.wait()
+        mock.shutdown()
+
+    saturated = next((a['sessions'] for a, b in zip(results, results[1:])
+                      if b['throughput'] < a['throughput'] * SATURATION_GAIN), None)
+    if saturated:
+        print(f"Throughput stops scaling past ~{saturated} concurrent sessions per process")
+    elif results:
+        print(f"Still scaling at {levels[-1]} sessions; try higher levels")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the Streamlit app")
+    parser.add_argument('--sessions', default='1,2,4,8,16,32', help="Comma-separated concurrency levels")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds per level")
+    parser.add_argument('--latency', type=float, default=0.5, help="Simulated upstream generation time")
+    parser.add_argument('--port', type=int, default=8599, help="Port for the app server under test")
+    parser.add_argument('--database-url', help="Database for the app (default: a temporary SQLite file)")
+    args = parser.parse_args()
+
+    run([int(n) for n in args.sessions.split(',')], args.duration, args.latency, args.port, args.database_url)
@@ -0,0 +1,118 @@
+import hashlib
+import io
+import os
+from PIL import Image, ImageEnhance, ImageOps
+import metrics
+
+# Input resolutions accepted by stable-video-diffusion
+VIDEO_SIZES = [(1024, 576), (576, 1024), (768, 768)]
+VIDEO_JPEG_QUALITY = 90
+
+# Used only to estimate the upload time saved by preprocessing
+UPLOAD_BANDWIDTH_MBPS = float(os.getenv('UPLOAD_BANDWIDTH_MBPS', '20'))
+
+# Saved images of signed-in users, named by content hash
+IMAGE_DIR = os.getenv('IMAGE_DIR', 'images')
+
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def finish_image(data: bytes) -> tuple:
+    """Decode a generated image, sharpen it and re-encode it; returns (image, png_bytes)"""
+    with metrics.span("image.decode"):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+
+    with metrics.span("image.sharpen"):
+        image = ImageEnhance.Sharpness(image).enhance(1.2)
+
+    with metrics.span("image.png_encode"):
+        output = io.BytesIO()
+        image.save(output, format='PNG', quality=100)
+    return image, output.getvalue()
+
+
+@metrics.timed("image.store")
+def store_image(png: bytes, directory: str = None) -> str:
+    """Write a PNG to IMAGE_DIR and return its path
+
+    Files are named by SHA-256, so byte-identical images share one file. An
+    existing file is only reused after comparing its bytes.
+    """
+    directory = directory or IMAGE_DIR
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256(png).hexdigest()
+    for attempt in range(100):
+        path = os.path.join(directory, f"{digest}{f'-{attempt}' if attempt else ''}.png")
+        try:
+            with open(path, 'xb') as f:
+                f.write(png)
+            return path
+        except FileExistsError:
+            with open(path, 'rb') as f:
+                if f.read() == png:
+                    metrics.inc("image_storage_deduplicated_total")
+                    return path
+    raise RuntimeError(f"Too many stored images collide with {digest}")
+
+
+def nearest_video_size(width: int, height: int) -> tuple:
+    """Pick the supported video size whose aspect ratio is closest to the input"""
+    aspect = width / height
+    return min(VIDEO_SIZES, key=lambda size: abs(size[0] / size[1] - aspect))
+
+
+def base64_size(num_bytes: int) -> int:
+    """Size of a payload once base64-encoded for the JSON request body"""
+    return (num_bytes + 2) // 3 * 4
+
+
+@metrics.timed("video.preprocess")
+def prepare_video_input(raw: bytes) -> tuple:
+    """Downscale, crop and re-encode an upload to a supported video input size
+
+    Returns (image_bytes, info) where info reports the original and upload
+    sizes and the estimated upload time saved. An upload that is already a
+    metadata-free JPEG or PNG of a supported size is sent as is when
+    re-encoding wouldn't make it smaller.
+    """
+    image = Image.open(io.BytesIO(raw))
+    exif = image.getexif()
+    orientation = exif.get(EXIF_ORIENTATION, 1)
+    width, height = image.size
+    already_valid = image.format in ('JPEG', 'PNG') and not exif and (width, height) in VIDEO_SIZES
+    if orientation in ROTATED_ORIENTATIONS:
+        width, height = height, width
+    target = nearest_video_size(width, height)
+
+    # Let the JPEG decoder skip DCT coefficients it doesn't need; draft()
+    # keeps the result at least as large as the requested size
+    draft_size = target[::-1] if orientation in ROTATED_ORIENTATIONS else target
+    scale = max(draft_size[0] / image.size[0], draft_size[1] / image.size[1])
+    image.draft('RGB', (int(image.size[0] * scale) + 1, int(image.size[1] * scale) + 1))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = ImageOps.fit(image, target, method=Image.LANCZOS)
+
+    # Saving without exif= drops all metadata from the upload
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=VIDEO_JPEG_QUALITY, optimize=True)
+    data = output.getvalue()
+    if already_valid and len(raw) <= len(data):
+        data = raw
+
+    # Uploads with metadata are always re-encoded and may come out larger
+    saved = max(0, base64_size(len(raw)) - base64_size(len(data)))
+    info = {
+        'original_bytes': len(raw),
+        'upload_bytes': len(data),
+        'bytes_saved': saved,
+        'seconds_saved': saved * 8 / (UPLOAD_BANDWIDTH_MBPS * 1e6),
+        'size': target,
+    }
+    metrics.inc("video_upload_bytes_total", len(data))
+    metrics.inc("video_upload_bytes_saved_total", saved)
+    return data, info
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics live in process memory and are shared by every Streamlit session
+# served by this process. They are exported as Prometheus text on METRICS_PORT.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+QUANTILES = (0.5, 0.95, 0.99)
+SAMPLE_WINDOW = 2048  # recent samples kept per timing series for quantiles
+
+STAGE_METRIC = 'stage_duration_seconds'
+
+HELP = {
+    STAGE_METRIC: 'Wall-clock time spent in each pipeline stage',
+    'stage_errors_total': 'Stages that raised an exception',
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+_server = None
+_server_failed = False
+
+
+class _Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Increment a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    """Set a gauge to an absolute value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    """Record one sample of a timing/size series"""
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            timing = _timings[key] = _Timing()
+        timing.observe(value)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block of code as one pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc('stage_errors_total', stage=stage)
+        raise
+    finally:
+        observe(STAGE_METRIC, time.perf_counter() - start, stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of span()"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stage_summary() -> list:
+    """Get count, mean and p50/p95/p99 for every timed stage"""
+    with _lock:
+        items = [(dict(labels), timing) for (name, labels), timing in _timings.items()
+                 if name == STAGE_METRIC]
+        rows = []
+        for labels, timing in items:
+            row = {
+                'stage': labels.get('stage', ''),
+                'count': timing.count,
+                'mean': timing.total / timing.count if timing.count else 0.0,
+            }
+            for q in QUANTILES:
+                row[f'p{int(q * 100)}'] = timing.quantile(q)
+            rows.append(row)
+    return sorted(rows, key=lambda row: row['stage'])
+
+
+def counter_values() -> dict:
+    """Get a snapshot of all counters and gauges keyed by display name"""
+    with _lock:
+        values = dict(_counters)
+        values.update(_gauges)
+    return {_format_series(name, dict(labels)): value for (name, labels), value in values.items()}
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    body = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{body}}}'
+
+
+def render_prometheus() -> str:
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        families = {}
+        for (name, labels), value in _counters.items():
+            families.setdefault((name, 'counter'), []).append((dict(labels), value))
+        for (name, labels), value in _gauges.items():
+            families.setdefault((name, 'gauge'), []).append((dict(labels), value))
+        timings = {}
+        for (name, labels), timing in _timings.items():
+            timings.setdefault(name, []).append((dict(labels), timing))
+
+        for (name, kind), series in sorted(families.items()):
+            if name in HELP:
+                lines.append(f'# HELP {name} {HELP[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                lines.append(f'{_format_series(name, labels)} {value}')
+
+        for name, series in sorted(timings.items()):
+            if name in HELP:
+                lines.append(f'# HELP {name} {HELP[name]}')
+            lines.append(f'# TYPE {name} summary')
+            for labels, timing in series:
+                for q in QUANTILES:
+                    lines.append(f'{_format_series(name, {**labels, "quantile": q})} {timing.quantile(q)}')
+                lines.append(f'{_format_series(name + "_sum", labels)} {timing.total}')
+                lines.append(f'{_format_series(name + "_count", labels)} {timing.count}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = None, host: str = '127.0.0.1'):
+    """Serve /metrics on a local port (idempotent across Streamlit reruns)"""
+    global _server, _server_failed
+    with _lock:
+        if _server is not None or _server_failed:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port or METRICS_PORT), _MetricsHandler)
+        except OSError:
+            # Another process on this host already owns the port
+            _server_failed = True
+            return None
+        thread = threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True)
+        thread.start()
+    return _server
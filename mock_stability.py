@@ -0,0 +1,205 @@
+import argparse
+import base64
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for the Stability REST API used for local benchmarking.
+# Run it and set STABILITY_API_HOST=http://127.0.0.1:<port>.
+
+TEXT_TO_IMAGE = re.compile(r'^/v1/generation/([\w.-]+)/text-to-image$')
+IMAGE_TO_VIDEO = re.compile(r'^/v1/generation/stable-video-diffusion/image-to-video')
+BALANCE = '/v1/user/balance'
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+_QUANTISE = bytes(b & 0xF8 for b in range(256))
+
+
+@lru_cache(maxsize=16)
+def fake_png(width: int, height: int, seed: int) -> bytes:
+    """Build a noisy RGB PNG so payload sizes resemble real generations"""
+    rng = random.Random(seed)
+    # Quantised noise compresses to roughly the size of a real generation
+    pixels = rng.randbytes(width * height * 3).translate(_QUANTISE)
+    stride = width * 3
+    raw = b''.join(b'\x00' + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(raw, 6)) + _png_chunk(b'IEND', b''))
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that abandon a response (e.g. a cancelled hedge) drop the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockStabilityHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        # Free the key's concurrency slot before the client can see the response
+        self._release_key()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        self._send(status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _api_key(self) -> str:
+        return self.headers.get('Authorization', '').partition(' ')[2]
+
+    def _hold_key(self, key: str, cost: float):
+        """Take a concurrency slot for the key; returns an error (status, message) if it can't"""
+        server = self.server
+        with server.keys_lock:
+            if server.key_credits is not None:
+                if key not in server.key_credits:
+                    return 401, 'Unknown API key'
+                if server.key_credits[key] < cost:
+                    return 402, 'Insufficient balance'
+            limit = server.key_limits.get(key)
+            if limit is not None and server.key_in_flight.get(key, 0) >= limit:
+                return 429, f'Too many concurrent requests for this key (limit {limit})'
+            server.key_in_flight[key] = server.key_in_flight.get(key, 0) + 1
+            if server.key_credits is not None:
+                server.key_credits[key] -= cost
+        self._held_key = key
+        return None
+
+    def _release_key(self):
+        key, self._held_key = getattr(self, '_held_key', None), None
+        if key is not None:
+            with self.server.keys_lock:
+                self.server.key_in_flight[key] -= 1
+
+    def do_GET(self):
+        if self.path != BALANCE:
+            self._send_json(404, {'message': f'Unknown path {self.path}'})
+            return
+        with self.server.keys_lock:
+            credits = (self.server.key_credits or {}).get(self._api_key())
+        if self.server.key_credits is not None and credits is None:
+            self._send_json(401, {'message': 'Unknown API key'})
+            return
+        self._send_json(200, {'credits': 1e9 if credits is None else credits})
+
+    def do_POST(self):
+        body = self._read_json()
+        key = self._api_key()
+        steps = int(body.get('steps', 50)) if TEXT_TO_IMAGE.match(self.path) else 50
+        error = self._hold_key(key, 0.9 * int(body.get('samples', 1)) * steps / 50)
+        if error:
+            status, message = error
+            self._send_json(status, {'message': message}, {'Retry-After': 1} if status == 429 else None)
+            return
+        try:
+            self._generate(body, steps)
+        finally:
+            self._release_key()
+
+    def _generate(self, body: dict, steps: int):
+        slow = random.random() < self.server.slow_rate
+        # Generation time scales with sampling steps and samples; `latency` is
+        # for one 50-step image
+        samples = int(body.get('samples', 1)) if TEXT_TO_IMAGE.match(self.path) else 1
+        time.sleep((self.server.slow_latency if slow else self.server.latency) * samples * steps / 50)
+
+        if TEXT_TO_IMAGE.match(self.path):
+            width = int(body.get('width', 1024))
+            height = int(body.get('height', 1024))
+            seed = int(body.get('seed', 0)) or random.randrange(1, 2 ** 31)
+            samples = int(body.get('samples', 1))
+
+            if self.headers.get('Accept') == 'image/png':
+                if samples != 1:
+                    self._send_json(400, {'message': 'image/png responses support samples=1 only'})
+                    return
+                self._send(200, fake_png(width, height, seed % 8), 'image/png',
+                           {'Seed': seed, 'Finish-Reason': 'SUCCESS'})
+                return
+
+            artifacts = [{
+                'base64': base64.b64encode(fake_png(width, height, (seed + i) % 8)).decode('ascii'),
+                'seed': seed + i,
+                'finishReason': 'SUCCESS',
+            } for i in range(samples)]
+            self._send_json(200, {'artifacts': artifacts})
+            return
+
+        if IMAGE_TO_VIDEO.match(self.path):
+            video = random.Random(body.get('seed', 0)).randbytes(256 * 1024)
+            self._send_json(200, {'base64': base64.b64encode(video).decode('ascii'), 'finishReason': 'SUCCESS'})
+            return
+
+        self._send_json(404, {'message': f'Unknown path {self.path}'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(port: int = 8765, host: str = '127.0.0.1', latency: float = 0.0,
+                      slow_rate: float = 0.0, slow_latency: float = 0.0, key_limits: dict = None,
+                      key_credits: dict = None):
+    """Start the mock API in a background thread and return the server
+
+    A `slow_rate` fraction of requests take `slow_latency` instead, to model
+    upstream tail latency. `key_limits` caps concurrent requests per API key
+    (429 beyond it); with `key_credits`, only those keys are accepted and
+    each request spends from its balance (402 once it runs out).
+    """
+    server = MockServer((host, port), MockStabilityHandler)
+    server.latency = latency
+    server.slow_rate = slow_rate
+    server.slow_latency = slow_latency
+    server.key_limits = dict(key_limits or {})
+    server.key_credits = dict(key_credits) if key_credits is not None else None
+    server.key_in_flight = {}
+    server.keys_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='mock-stability', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Stability API")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds of simulated generation time at 50 steps")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="Fraction of requests that are slow")
+    parser.add_argument('--slow-latency', type=float, default=0.0, help="Seconds taken by a slow request")
+    parser.add_argument('--key-limit', action='append', default=[], metavar='KEY=N',
+                        help="Concurrent request limit for one API key (repeatable)")
+    args = parser.parse_args()
+
+    key_limits = {key: int(limit) for key, _, limit in (item.partition('=') for item in args.key_limit)}
+    server = start_mock_server(args.port, latency=args.latency, slow_rate=args.slow_rate,
+                               slow_latency=args.slow_latency, key_limits=key_limits)
+    print(f"Mock Stability API on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,159 @@
+import argparse
+import json
+import re
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# A stand-in for the parts of the Stripe API the app calls, for local testing
+# and benchmarking. Run it and set STRIPE_API_BASE=http://127.0.0.1:<port>.
+
+CHECKOUT_SESSIONS = '/v1/checkout/sessions'
+CHECKOUT_SESSION = re.compile(r'^/v1/checkout/sessions/([\w-]+)$')
+EXPIRE_SESSION = re.compile(r'^/v1/checkout/sessions/([\w-]+)/expire$')
+SESSION_TTL_SECONDS = 24 * 3600
+
+
+def _nested(form: dict, name: str) -> dict:
+    """Collect Stripe's bracketed form fields, e.g. metadata[plan_id]"""
+    prefix = f'{name}['
+    return {key[len(prefix):-1]: value for key, value in form.items()
+            if key.startswith(prefix) and key.endswith(']') and '][' not in key[len(prefix):]}
+
+
+class MockStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def complete(self, session_id: str):
+        """Mark a checkout session as paid, as if the customer finished checkout"""
+        with self.lock:
+            self.sessions[session_id].update(status='complete', payment_status='paid')
+
+
+class MockStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str, kind: str = 'invalid_request_error'):
+        self._send_json(status, {'error': {'type': kind, 'message': message}})
+
+    def _begin(self, route: str) -> bool:
+        with self.server.lock:
+            self.server.calls[f'{self.command} {route}'] += 1
+        time.sleep(self.server.latency)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self._error(401, 'You did not provide an API key.')
+            return False
+        return True
+
+    def _session(self, session_id: str):
+        with self.server.lock:
+            session = self.server.sessions.get(session_id)
+            if session is not None and session['status'] == 'open' and session['expires_at'] <= time.time():
+                session['status'] = 'expired'
+            return dict(session) if session is not None else None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+
+        if self.path == CHECKOUT_SESSIONS:
+            if not self._begin('create_checkout_session'):
+                return
+            if form.get('mode') not in ('payment', 'subscription'):
+                self._error(400, 'Invalid mode: must be one of payment or subscription')
+                return
+            if not form.get('line_items[0][price]'):
+                self._error(400, 'Missing required param: line_items.')
+                return
+            session_id = f"cs_test_{secrets.token_hex(16)}"
+            session = {
+                'id': session_id,
+                'object': 'checkout.session',
+                'url': f"http://{self.headers.get('Host')}/pay/{session_id}",
+                'mode': form['mode'],
+                'status': 'open',
+                'payment_status': 'unpaid',
+                'client_reference_id': form.get('client_reference_id'),
+                'metadata': _nested(form, 'metadata'),
+                'success_url': form.get('success_url'),
+                'cancel_url': form.get('cancel_url'),
+                'created': int(time.time()),
+                'expires_at': int(time.time()) + SESSION_TTL_SECONDS,
+            }
+            with self.server.lock:
+                self.server.sessions[session_id] = session
+            self._send_json(200, session)
+            return
+
+        match = EXPIRE_SESSION.match(self.path)
+        if match:
+            if not self._begin('expire_checkout_session'):
+                return
+            with self.server.lock:
+                session = self.server.sessions.get(match.group(1))
+                if session is not None and session['status'] == 'open':
+                    session['status'] = 'expired'
+            if session is None:
+                self._error(404, f"No such checkout.session: '{match.group(1)}'")
+                return
+            self._send_json(200, self._session(match.group(1)))
+            return
+
+        self._error(404, f'Unrecognized request URL (POST: {self.path})')
+
+    def do_GET(self):
+        match = CHECKOUT_SESSION.match(self.path)
+        if not match:
+            self._error(404, f'Unrecognized request URL (GET: {self.path})')
+            return
+        if not self._begin('retrieve_checkout_session'):
+            return
+        session = self._session(match.group(1))
+        if session is None:
+            self._error(404, f"No such checkout.session: '{match.group(1)}'")
+            return
+        self._send_json(200, session)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(port: int = 12111, host: str = '127.0.0.1', latency: float = 0.0):
+    """Start the mock Stripe API in a background thread and return the server
+
+    `server.calls` counts requests per operation and `server.complete(id)`
+    marks a checkout session as paid.
+    """
+    server = MockStripeServer((host, port), MockStripeHandler)
+    server.latency = latency
+    server.sessions = {}
+    server.calls = Counter()
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='mock-stripe', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Stripe API")
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request")
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, latency=args.latency)
+    print(f"Mock Stripe API on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,10 +1,14 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Index, Boolean, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import relationship, sessionmaker, Session
 from datetime import datetime
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import streamlit as st
+import metrics
 
 # Load environment variables
 load_dotenv()
@@ -18,7 +22,8 @@ class User(Base):
     email = Column(String, unique=True)
     password = Column(String)
     subscription_type = Column(String, default='free')  # 'free', 'basic', 'pro', 'business', 'pay_as_you_go'
-    subscription_end = Column(DateTime, nullable=True)
+    subscription_end = Column(DateTime, nullable=True, index=True)  # scanned by the renewal job
+    auto_renew = Column(Boolean, default=True)
     credits_remaining = Column(Integer, default=3)  # Start with 3 free credits
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -37,10 +42,36 @@ class Image(Base):
     width = Column(Integer)
     height = Column(Integer)
     image_url = Column(String)
+    # 64-bit difference hash (see phash.py), stored signed
+    phash = Column(BigInteger, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
     user = relationship("User", back_populates="images")
+    
+    # Serves keyset pagination on (created_at, id) per user
+    __table_args__ = (
+        Index('ix_images_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+# Read-only view of every image, including months partitioned out of the
+# live table (see partitions.py). It lives on its own metadata so
+# create_all never tries to create it as a table.
+ViewBase = declarative_base()
+
+class ImageRecord(ViewBase):
+    __tablename__ = 'images_all'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    prompt = Column(String)
+    negative_prompt = Column(String, nullable=True)
+    style = Column(String, nullable=True)
+    width = Column(Integer)
+    height = Column(Integer)
+    image_url = Column(String)
+    phash = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime)
 
 class Payment(Base):
     __tablename__ = 'payments'
@@ -49,30 +80,228 @@ class Payment(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     amount = Column(Float)
     payment_type = Column(String)  # 'subscription' or 'credits'
+    plan = Column(String)  # Plan bought, or 'pay_as_you_go' for credit packs
     status = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
     user = relationship("User", back_populates="payments")
+    
+    __table_args__ = (
+        Index('ix_payments_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+class ProcessedEvent(Base):
+    __tablename__ = 'processed_events'
+    
+    # Stripe event IDs already applied; makes webhook delivery idempotent
+    event_id = Column(String, primary_key=True)
+    event_type = Column(String)
+    status = Column(String)  # 'applied', 'ignored' or 'failed'
+    processed_at = Column(DateTime, default=datetime.utcnow)
+
+class ApiKey(Base):
+    __tablename__ = 'api_keys'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # SHA-256 of the key; the key itself is only shown once, when created
+    key_hash = Column(String, unique=True)
+    prefix = Column(String)  # first characters, to tell keys apart in listings
+    created_at = Column(DateTime, default=datetime.utcnow)
+    revoked_at = Column(DateTime, nullable=True)
+
+# Reporting reads can go to a replica so they don't compete with billing
+# writes for the primary's connections. A user's own reads stay on the
+# primary for a short window after they write, so they see their changes.
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+_RECENT_WRITES_MAX = 10000
+
+_engines = {}
+_session_factories = {}
+_engines_lock = threading.Lock()
+_initialized = set()
+# user_id -> time.monotonic() of that user's last commit in this process
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+
+class ReadOnlySessionError(RuntimeError):
+    """Raised when a replica session tries to flush changes"""
+
+
+def get_engine(url: str):
+    """Get the process-wide engine (and connection pool) for a database URL"""
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = _engines[url] = create_engine(url, pool_pre_ping=True)
+            _session_factories[url] = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        return engine
+
+
+def _session(url: str, read_only: bool = False, replica: bool = False) -> Session:
+    get_engine(url)
+    session = _session_factories[url]()
+    session.info['read_only'] = read_only
+    session.info['replica'] = replica
+    return session
+
+
+def _written_user_id(obj):
+    if isinstance(obj, User):
+        return obj.id
+    return getattr(obj, 'user_id', None)
+
+
+@event.listens_for(Session, 'before_flush')
+def _reject_replica_writes(session, flush_context, instances):
+    if session.info.get('read_only') and (session.new or session.dirty or session.deleted):
+        raise ReadOnlySessionError("Read-only replica sessions can't write; use get_write_db()")
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_written_users(session, flush_context):
+    written = session.info.setdefault('written_users', set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        user_id = _written_user_id(obj)
+        if user_id is not None:
+            written.add(user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _stamp_written_users(session):
+    written = session.info.pop('written_users', None)
+    if written:
+        now = time.monotonic()
+        with _recent_writes_lock:
+            for user_id in written:
+                _recent_writes[user_id] = now
+            if len(_recent_writes) > _RECENT_WRITES_MAX:
+                _prune_writes(now)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written_users(session):
+    session.info.pop('written_users', None)
+
+
+def note_write(user_id):
+    """Record a write made outside the ORM unit of work (e.g. bulk UPDATEs);
+    with None, just prune stamps older than the read-your-writes window"""
+    now = time.monotonic()
+    with _recent_writes_lock:
+        if user_id is not None:
+            _recent_writes[user_id] = now
+        _prune_writes(now)
+
+
+def _prune_writes(now: float):
+    # Caller holds _recent_writes_lock
+    cutoff = now - READ_YOUR_WRITES_SECONDS
+    for stale in [uid for uid, stamp in _recent_writes.items() if stamp < cutoff]:
+        del _recent_writes[stale]
+
+
+def wrote_recently(user_id) -> bool:
+    with _recent_writes_lock:
+        stamp = _recent_writes.get(user_id)
+    return stamp is not None and time.monotonic() - stamp < READ_YOUR_WRITES_SECONDS
+
+
+# Columns and indexes added to tables after they were first released.
+# create_all only creates missing tables, so existing databases get these
+# through _migrate_columns instead.
+ADDED_COLUMNS = [
+    ('users', 'auto_renew', 'BOOLEAN DEFAULT TRUE'),
+    ('images', 'phash', 'BIGINT'),
+    ('payments', 'plan', 'VARCHAR'),
+]
+ADDED_INDEXES = [
+    ('ix_users_subscription_end', 'users', ('subscription_end',)),
+    # Keyset pagination (see Analytics._keyset_page)
+    ('ix_images_user_created', 'images', ('user_id', 'created_at', 'id')),
+    ('ix_payments_user_created', 'payments', ('user_id', 'created_at', 'id')),
+]
+
+
+def _migrate_columns(conn):
+    """Add ADDED_COLUMNS and ADDED_INDEXES where they are missing (idempotent)"""
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    for table, column, ddl in ADDED_COLUMNS:
+        if table in tables and column not in {c['name'] for c in inspector.get_columns(table)}:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    for name, table, columns in ADDED_INDEXES:
+        if table in tables:
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+
+def create_schema(engine):
+    """Create missing tables, bring older tables up to date, and create the
+    images_all view and the prompt search index"""
+    import partitions
+    import search
+
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        _migrate_columns(conn)
+        partitions.ensure_images_view(conn, replace=False)
+    search.ensure_prompt_index(engine)
+    return engine
+
+
+def _create_schema(url: str):
+    """create_schema, once per process and database URL"""
+    engine = get_engine(url)
+    if url not in _initialized:
+        create_schema(engine)
+        _initialized.add(url)
+    return engine
+
+
+def _database_url() -> str:
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if not DATABASE_URL:
+        st.error("Database URL not found in environment variables!")
+        st.stop()
+    return DATABASE_URL
+
+
+def get_write_db() -> Session:
+    """Get a new session on the primary database"""
+    return _session(_database_url())
+
+
+def get_read_db(user_id: int = None, primary: bool = False) -> Session:
+    """Get a new read-only session, on the replica when one is configured
+
+    Falls back to the primary for a user who committed a write in this
+    process within the last READ_YOUR_WRITES_SECONDS. Write stamps are not
+    shared between processes, so changes made elsewhere (e.g. a plan the
+    webhook server updated) only show on the replica after replication lag;
+    pass primary=True for reads that must see them.
+    """
+    replica_url = os.getenv('DATABASE_REPLICA_URL', DATABASE_REPLICA_URL)
+    if not replica_url or primary or (user_id is not None and wrote_recently(user_id)):
+        metrics.inc("db_sessions_total", target="primary", kind="read")
+        return _session(_database_url(), read_only=True)
+    metrics.inc("db_sessions_total", target="replica", kind="read")
+    return _session(replica_url, read_only=True, replica=True)
+
 
 def get_db():
     """Get database session"""
     if 'db' not in st.session_state:
-        DATABASE_URL = os.getenv('DATABASE_URL')
-        if not DATABASE_URL:
-            st.error("Database URL not found in environment variables!")
-            st.stop()
+        DATABASE_URL = _database_url()
             
         try:
-            # Create engine and session
-            engine = create_engine(DATABASE_URL)
-            SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-            
             # Create tables
-            Base.metadata.create_all(engine)
+            _create_schema(DATABASE_URL)
             
             # Store session in streamlit state
-            st.session_state.db = SessionLocal()
+            st.session_state.db = _session(DATABASE_URL)
             
         except Exception as e:
             st.error(f"Failed to connect to database: {str(e)}")
@@ -82,15 +311,11 @@ def get_db():
 
 def init_db():
     """Initialize database"""
-    DATABASE_URL = os.getenv('DATABASE_URL')
-    if not DATABASE_URL:
-        st.error("Database URL not found in environment variables!")
-        st.stop()
+    DATABASE_URL = _database_url()
         
     try:
-        engine = create_engine(DATABASE_URL)
-        Base.metadata.create_all(engine)
-        return engine
+        # Schema creation only needs to happen once per process
+        return _create_schema(DATABASE_URL)
     except Exception as e:
         st.error(f"Failed to initialize database: {str(e)}")
         st.stop()
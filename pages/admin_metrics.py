@@ -0,0 +1,50 @@
+import streamlit as st
+import pandas as pd
+import os
+import metrics
+import auth
+
+def is_admin() -> bool:
+    """Check the logged-in user against ADMIN_EMAILS"""
+    admins = {email.strip().lower() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()}
+    user = auth.current_user()
+    return user is not None and user.email.lower() in admins
+
+def show_admin_metrics():
+    if not is_admin():
+        st.warning("This page is restricted to administrators")
+        return
+
+    st.title("Pipeline Latency")
+    st.caption(
+        f"Timings from this server process (last {metrics.SAMPLE_WINDOW} samples per stage). "
+        f"Prometheus scrape endpoint: http://127.0.0.1:{metrics.METRICS_PORT}/metrics"
+    )
+    st.button("Refresh", key="metrics_refresh")
+
+    rows = metrics.stage_summary()
+    if rows:
+        df = pd.DataFrame(rows)
+        # Show latencies in milliseconds
+        for column in ['mean', 'p50', 'p95', 'p99']:
+            df[column] = (df[column] * 1000).round(1)
+        df = df.rename(columns={
+            'mean': 'mean (ms)', 'p50': 'p50 (ms)', 'p95': 'p95 (ms)', 'p99': 'p99 (ms)'
+        })
+        st.dataframe(df, use_container_width=True, hide_index=True)
+    else:
+        st.info("No timings recorded yet")
+
+    st.header("Counters")
+    counters = metrics.counter_values()
+    if counters:
+        st.dataframe(
+            pd.DataFrame(sorted(counters.items()), columns=['series', 'value']),
+            use_container_width=True,
+            hide_index=True
+        )
+    else:
+        st.info("No counters recorded yet")
+
+if __name__ == "__main__":
+    show_admin_metrics()
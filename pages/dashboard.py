@@ -2,23 +2,118 @@ import streamlit as st
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from models import User, Image, Payment, init_db
+from sqlalchemy import func
+from models import User, Image, ImageRecord, Payment, init_db, get_read_db
 from subscription import PLANS
+from search import get_prompt_index, SEARCH_PAGE_SIZE
+from analytics import Analytics
+import auth
+
+def _current_cursor(name):
+    # Each list keeps a stack of cursors for the pages already visited
+    stack = st.session_state.get(f"{name}_cursors", [])
+    return stack[-1] if stack else None
+
+def _next_page(name, cursor):
+    st.session_state.setdefault(f"{name}_cursors", []).append(cursor)
+
+def _previous_page(name):
+    st.session_state[f"{name}_cursors"].pop()
+
+def _page_controls(name, next_cursor):
+    prev_col, _, next_col = st.columns([1, 4, 1])
+    with prev_col:
+        st.button("← Newer", key=f"{name}_prev", disabled=not st.session_state.get(f"{name}_cursors"),
+                  on_click=_previous_page, args=(name,))
+    with next_col:
+        st.button("Older →", key=f"{name}_next", disabled=next_cursor is None,
+                  on_click=_next_page, args=(name, next_cursor))
+
+def _change_search_page(delta):
+    st.session_state.prompt_search_page += delta
+
+def show_prompt_search(db, user_id):
+    st.header("Search Your Images")
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        query = st.text_input("Search prompts", placeholder="e.g. castle at sunset", key="prompt_search")
+    with col2:
+        month = st.selectbox(
+            "Month",
+            ["Any"] + [datetime(2000, m, 1).strftime("%B") for m in range(1, 13)],
+            key="prompt_search_month"
+        )
+    
+    if not query:
+        return
+    
+    # Reset to the first page whenever the search changes
+    search_key = (query, month)
+    if st.session_state.get('prompt_search_key') != search_key:
+        st.session_state.prompt_search_key = search_key
+        st.session_state.prompt_search_page = 1
+    page = st.session_state.prompt_search_page
+    
+    since = until = None
+    if month != "Any":
+        month_number = datetime.strptime(month, "%B").month
+        today = datetime.utcnow()
+        year = today.year if month_number <= today.month else today.year - 1
+        since = datetime(year, month_number, 1)
+        until = datetime(year + (month_number == 12), month_number % 12 + 1, 1)
+    
+    results, total = get_prompt_index(db).search(user_id, query, page=page, since=since, until=until)
+    if not results:
+        st.info("No matching images")
+        return
+    
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    st.caption(f"{total} matching images · page {page} of {pages}")
+    result_cols = st.columns(5)
+    for idx, image in enumerate(results):
+        with result_cols[idx % 5]:
+            st.image(image.image_url, caption=f"{image.prompt[:40]} · {image.created_at.strftime('%Y-%m-%d')}")
+    
+    prev_col, _, next_col = st.columns([1, 4, 1])
+    with prev_col:
+        st.button("← Previous", key="prompt_search_prev", disabled=page <= 1,
+                  on_click=_change_search_page, args=(-1,))
+    with next_col:
+        st.button("Next →", key="prompt_search_next", disabled=page >= pages,
+                  on_click=_change_search_page, args=(1,))
 
 def show_dashboard():
-    if 'user' not in st.session_state:
+    principal = auth.current_user()
+    if principal is None:
         st.warning("Please login to view your dashboard")
         st.session_state.redirect_to_login = True
         return
         
     # Initialize database
-    engine = init_db()
-    Session = sessionmaker(bind=engine)
-    db = Session()
-    
-    user = db.query(User).filter(User.id == st.session_state.user.id).first()
+    init_db()
+    # Plan and credits are written by the webhook server, whose writes the
+    # replica routing can't see, so the account row comes from the primary
+    account_db = get_read_db(principal.id, primary=True)
+    try:
+        user = account_db.query(User).filter(User.id == principal.id).first()
+    finally:
+        account_db.close()
+    if user is None:
+        auth.sign_out()
+        st.warning("Your account no longer exists")
+        return
+    if user.subscription_type != principal.plan:
+        # The plan changed since the token was issued (e.g. a checkout completed)
+        auth.sign_in(auth.issue_token(user))
     
+    # Reports read from the replica when one is configured
+    db = get_read_db(principal.id)
+    try:
+        _show_reports(db, user)
+    finally:
+        db.close()
+
+def _show_reports(db, user):
     st.title("Account Dashboard")
     
     # Custom CSS
@@ -64,7 +159,7 @@ def show_dashboard():
         """.format(user.credits_remaining), unsafe_allow_html=True)
         
     with col3:
-        total_images = db.query(Image).filter(Image.user_id == user.id).count()
+        total_images = db.query(ImageRecord).filter(ImageRecord.user_id == user.id).count()
         st.markdown("""
         <div class="stat-card">
             <h3>Total Images</h3>
@@ -112,29 +207,28 @@ def show_dashboard():
     
     st.plotly_chart(fig, use_container_width=True)
     
+    analytics = Analytics(db)
+    
     # Recent Images
     st.header("Recent Images")
-    recent_images = db.query(Image).filter(
-        Image.user_id == user.id
-    ).order_by(
-        Image.created_at.desc()
-    ).limit(10).all()
+    recent_images, next_cursor = analytics.get_images_page(
+        user.id, limit=10, cursor=_current_cursor("images"))
     
     if recent_images:
         image_cols = st.columns(5)
         for idx, image in enumerate(recent_images):
             with image_cols[idx % 5]:
                 st.image(image.image_url, caption=f"Created: {image.created_at.strftime('%Y-%m-%d')}")
+        _page_controls("images", next_cursor)
     else:
         st.info("No images generated yet")
     
+    show_prompt_search(db, user.id)
+    
     # Billing History
     st.header("Billing History")
-    payments = db.query(Payment).filter(
-        Payment.user_id == user.id
-    ).order_by(
-        Payment.created_at.desc()
-    ).limit(5).all()
+    payments, next_cursor = analytics.get_payment_history(
+        user.id, limit=5, cursor=_current_cursor("payments"))
     
     if payments:
         for payment in payments:
@@ -145,6 +239,7 @@ def show_dashboard():
                 <div>Status: {payment.status.title()}</div>
             </div>
             """, unsafe_allow_html=True)
+        _page_controls("payments", next_cursor)
     else:
         st.info("No billing history yet")
 
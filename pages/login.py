@@ -0,0 +1,56 @@
+import streamlit as st
+import auth
+from models import init_db, get_write_db
+
+def _submit(action, email, password):
+    if not email or not password:
+        st.warning("Please enter your email and password")
+        return
+    init_db()
+    db = get_write_db()
+    try:
+        with st.spinner("Checking your details..."):
+            token = action(db, email, password)
+    except auth.AuthError as e:
+        st.error(str(e))
+        return
+    finally:
+        db.close()
+    auth.sign_in(token)
+    st.session_state.pop('redirect_to_login', None)
+    st.rerun()
+
+def show_login_page():
+    user = auth.current_user()
+    if user is not None:
+        st.title("Account")
+        st.write(f"Signed in as **{user.email}** on the {user.plan.replace('_', ' ').title()} plan")
+        if st.button("Log out", key="logout"):
+            auth.sign_out()
+            st.rerun()
+        return
+
+    st.title("Log In")
+    login_tab, register_tab = st.tabs(["Log in", "Create account"])
+
+    with login_tab:
+        with st.form("login_form"):
+            email = st.text_input("Email", key="login_email")
+            password = st.text_input("Password", type="password", key="login_password")
+            submitted = st.form_submit_button("Log in", type="primary")
+        if submitted:
+            _submit(auth.login, email, password)
+
+    with register_tab:
+        with st.form("register_form"):
+            email = st.text_input("Email", key="register_email")
+            password = st.text_input(
+                "Password", type="password", key="register_password",
+                help=f"At least {auth.MIN_PASSWORD_LENGTH} characters"
+            )
+            submitted = st.form_submit_button("Create account", type="primary")
+        if submitted:
+            _submit(auth.register, email, password)
+
+if __name__ == "__main__":
+    show_login_page()
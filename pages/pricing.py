@@ -1,12 +1,11 @@
 import streamlit as st
 from subscription import PLANS, CREDIT_PACKAGES, SubscriptionManager
+from models import init_db, get_read_db
+import auth
 import os
 
-def show_pricing_page():
-    st.title("Choose Your Plan")
-    
-    # Custom CSS for pricing cards
-    st.markdown("""
+# Custom CSS for pricing cards
+PRICING_CSS = """
     <style>
     .pricing-card {
         background-color: #1E1E1E;
@@ -31,15 +30,14 @@ def show_pricing_page():
         color: #CCC;
     }
     </style>
-    """, unsafe_allow_html=True)
-    
-    # Subscription Plans
-    st.header("Monthly Subscriptions")
-    cols = st.columns(3)
-    
-    for idx, (plan_id, plan) in enumerate(PLANS.items()):
-        with cols[idx]:
-            st.markdown(f"""
+    """
+
+# Page scripts re-execute on every rerun, so the markup is cached by Streamlit
+@st.cache_data(show_spinner=False)
+def plan_card_html(plan_id):
+    """Build a subscription card's markup"""
+    plan = PLANS[plan_id]
+    return f"""
             <div class="pricing-card">
                 <h3>{plan['name']}</h3>
                 <div class="price">${plan['price']}/month</div>
@@ -47,49 +45,87 @@ def show_pricing_page():
                     {''.join(f'<div class="feature-item">✓ {feature}</div>' for feature in plan['features'])}
                 </div>
             </div>
-            """, unsafe_allow_html=True)
+            """
+
+@st.cache_data(show_spinner=False)
+def credit_card_html(package_id):
+    """Build a credit package card's markup"""
+    package = CREDIT_PACKAGES[package_id]
+    return f"""
+            <div class="pricing-card">
+                <h3>{package['name']}</h3>
+                <div class="price">${package['price']}</div>
+                <div class="feature-list">
+                    <div class="feature-item">✓ {package['credits']} image credits</div>
+                    <div class="feature-item">✓ Never expires</div>
+                    <div class="feature-item">✓ All styles included</div>
+                </div>
+            </div>
+            """
+
+@st.fragment
+def subscription_plans():
+    # Subscription Plans
+    st.header("Monthly Subscriptions")
+    cols = st.columns(3)
+    
+    for idx, (plan_id, plan) in enumerate(PLANS.items()):
+        with cols[idx]:
+            st.markdown(plan_card_html(plan_id), unsafe_allow_html=True)
             
             if st.button(f"Subscribe to {plan['name']}", key=f"sub_{plan_id}"):
-                if 'user' not in st.session_state:
+                user = auth.current_user()
+                if user is None:
                     st.warning("Please log in first")
                     st.session_state.redirect_to_login = True
                 else:
+                    init_db()
+                    # Payments land on the primary, from the webhook server
+                    db = get_read_db(user.id, primary=True)
                     try:
                         manager = SubscriptionManager(os.getenv('STRIPE_SECRET_KEY'))
-                        session = manager.create_checkout_session(plan_id, st.session_state.user.id)
+                        session = manager.create_checkout_session(plan_id, user.id, db)
                         st.markdown(f'<meta http-equiv="refresh" content="0;url={session.url}">', unsafe_allow_html=True)
                     except Exception as e:
                         st.error(f"Error creating checkout session: {str(e)}")
-    
+                    finally:
+                        db.close()
+
+@st.fragment
+def credit_packages():
     # Credit Packages
     st.header("Pay As You Go Credits")
     credit_cols = st.columns(3)
     
     for idx, (package_id, package) in enumerate(CREDIT_PACKAGES.items()):
         with credit_cols[idx]:
-            st.markdown(f"""
-            <div class="pricing-card">
-                <h3>{package['name']}</h3>
-                <div class="price">${package['price']}</div>
-                <div class="feature-list">
-                    <div class="feature-item">✓ {package['credits']} image credits</div>
-                    <div class="feature-item">✓ Never expires</div>
-                    <div class="feature-item">✓ All styles included</div>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(credit_card_html(package_id), unsafe_allow_html=True)
             
             if st.button(f"Buy {package['name']}", key=f"credit_{package_id}"):
-                if 'user' not in st.session_state:
+                user = auth.current_user()
+                if user is None:
                     st.warning("Please log in first")
                     st.session_state.redirect_to_login = True
                 else:
+                    init_db()
+                    db = get_read_db(user.id, primary=True)
                     try:
                         manager = SubscriptionManager(os.getenv('STRIPE_SECRET_KEY'))
-                        session = manager.create_credit_checkout(package_id, st.session_state.user.id)
+                        session = manager.create_credit_checkout(package_id, user.id, db)
                         st.markdown(f'<meta http-equiv="refresh" content="0;url={session.url}">', unsafe_allow_html=True)
                     except Exception as e:
                         st.error(f"Error creating checkout session: {str(e)}")
+                    finally:
+                        db.close()
+
+def show_pricing_page():
+    st.title("Choose Your Plan")
+    
+    # Custom CSS for pricing cards
+    st.markdown(PRICING_CSS, unsafe_allow_html=True)
+    
+    subscription_plans()
+    credit_packages()
 
     # FAQ Section
     st.header("Frequently Asked Questions")
@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import Table, Column, MetaData, Index, create_engine, select, delete, text
+from models import Image, ImageRecord
+import metrics
+
+# The images table is split by month of created_at.
+# - Postgres: `images` becomes a natively RANGE-partitioned table with one
+#   partition per month (migrate_postgres), so recent-window queries prune to
+#   one or two partitions and vacuum works per partition.
+# - SQLite: `images` keeps the last HOT_MONTHS months; older months are moved
+#   into images_pYYYY_MM tables and the images_all view unions them all.
+# Months older than ARCHIVE_AFTER_MONTHS are written to compressed columnar
+# files in ARCHIVE_DIR and dropped from the database.
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '12'))
+HOT_MONTHS = 3
+# Days of history the SQLite hot table is guaranteed to hold
+HOT_DAYS = 28 * (HOT_MONTHS - 1)
+PARTITIONS_AHEAD = 3
+PARTITION_RE = re.compile(r'^images_p(\d{4})_(\d{2})$')
+COLUMNS = [column.name for column in Image.__table__.columns]
+NULL_TIMESTAMP = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1)
+
+
+def month_start(value: datetime, offset: int = 0) -> datetime:
+    """First instant of the month `offset` months after value's month"""
+    index = value.year * 12 + value.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"images_p{month.year:04d}_{month.month:02d}"
+
+
+def _partition_month(name: str):
+    match = PARTITION_RE.match(name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def list_partitions(conn) -> list:
+    """Monthly partition table names, oldest first"""
+    if conn.dialect.name == 'postgresql':
+        names = conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'images'")).scalars()
+    else:
+        names = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars()
+    return sorted(name for name in names if PARTITION_RE.match(name))
+
+
+def ensure_images_view(conn, replace: bool = True):
+    """Create images_all over the live table and every monthly partition;
+    with replace=False an existing view is left alone"""
+    column_list = ', '.join(COLUMNS)
+    if conn.dialect.name == 'postgresql':
+        # Partitions are already part of `images`
+        conn.execute(text(f"CREATE OR REPLACE VIEW images_all AS SELECT {column_list} FROM images"))
+        return
+    if not replace:
+        conn.execute(text(f"CREATE VIEW IF NOT EXISTS images_all AS SELECT {column_list} FROM images"))
+        return
+    selects = [f"SELECT {column_list} FROM {name}" for name in ['images', *list_partitions(conn)]]
+    conn.execute(text("DROP VIEW IF EXISTS images_all"))
+    conn.execute(text("CREATE VIEW images_all AS " + " UNION ALL ".join(selects)))
+
+
+def _sqlite_partition_table(name: str) -> Table:
+    table = Table(name, MetaData(), *[
+        Column(column.name, column.type, primary_key=column.primary_key)
+        for column in Image.__table__.columns
+    ])
+    Index(f"ix_{name}_user_created", table.c.user_id, table.c.created_at, table.c.id)
+    return table
+
+
+def migrate_postgres(conn, months_ahead: int = PARTITIONS_AHEAD):
+    """Convert a plain images table into a monthly RANGE-partitioned one, in the caller's transaction
+
+    The primary key becomes (id, created_at) since Postgres requires the
+    partition key in it; ids still come from the same sequence. Run it with
+    the app stopped: the prompt search index is rebuilt on the next start.
+
+    Only SQLite runs in the tests and benchmarks, so this path is untested;
+    try it on a copy of the database first.
+    """
+    if conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'images'")).scalar() == 'p':
+        return
+    conn.execute(text("LOCK TABLE images IN ACCESS EXCLUSIVE MODE"))
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence('images', 'id')")).scalar()
+    conn.execute(text("DROP VIEW IF EXISTS images_all"))
+    # The partition key can't be NULL in the primary key
+    conn.execute(text("UPDATE images SET created_at = coalesce((SELECT min(created_at) FROM images), now()) "
+                      "WHERE created_at IS NULL"))
+    conn.execute(text("ALTER TABLE images RENAME TO images_unpartitioned"))
+    conn.execute(text("ALTER TABLE images_unpartitioned RENAME CONSTRAINT images_pkey TO images_unpartitioned_pkey"))
+    conn.execute(text(
+        "CREATE TABLE images (LIKE images_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"))
+    conn.execute(text("ALTER TABLE images ADD PRIMARY KEY (id, created_at)"))
+    conn.execute(text("ALTER TABLE images ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+    conn.execute(text("CREATE TABLE images_default PARTITION OF images DEFAULT"))
+
+    oldest = conn.execute(text("SELECT min(created_at) FROM images_unpartitioned")).scalar()
+    ensure_partitions(conn, since=oldest, months_ahead=months_ahead)
+    conn.execute(text(f"INSERT INTO images ({', '.join(COLUMNS)}) "
+                      f"SELECT {', '.join(COLUMNS)} FROM images_unpartitioned"))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    conn.execute(text("DROP TABLE images_unpartitioned"))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY images.id"))
+    # Indexes on the parent cascade to every partition
+    conn.execute(text("CREATE INDEX ix_images_user_created ON images (user_id, created_at, id)"))
+    conn.execute(text("CREATE INDEX ix_images_id ON images (id)"))
+    ensure_images_view(conn)
+
+
+def ensure_partitions(conn, since: datetime = None, months_ahead: int = PARTITIONS_AHEAD) -> list:
+    """Create Postgres partitions from `since` (default: this month) through months_ahead"""
+    now = datetime.utcnow()
+    month = month_start(since or now)
+    last = month_start(now, months_ahead)
+    created = []
+    existing = set(list_partitions(conn))
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing:
+            conn.execute(text(
+                f"CREATE TABLE {name} PARTITION OF images "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{month_start(month, 1).isoformat()}')"))
+            created.append(name)
+        month = month_start(month, 1)
+    return created
+
+
+def roll_sqlite_months(conn, now: datetime = None) -> list:
+    """Move months older than the hot window out of `images` into monthly tables"""
+    cutoff = month_start(now or datetime.utcnow(), -(HOT_MONTHS - 1))
+    images = Image.__table__
+    # Never move the newest row: SQLite reuses rowids above the current max
+    newest = conn.execute(select(images.c.id).order_by(images.c.id.desc()).limit(1)).scalar()
+    oldest = conn.execute(select(images.c.created_at).where(images.c.created_at.isnot(None))
+                          .order_by(images.c.created_at).limit(1)).scalar()
+    moved = []
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        end = month_start(month, 1)
+        window = (images.c.created_at >= month) & (images.c.created_at < end) & (images.c.id != newest)
+        if conn.execute(select(images.c.id).where(window).limit(1)).first():
+            table = _sqlite_partition_table(partition_name(month))
+            table.create(conn, checkfirst=True)
+            count = conn.execute(table.insert().from_select(COLUMNS, select(*images.c).where(window))).rowcount
+            conn.execute(delete(images).where(window))
+            moved.append((table.name, count))
+        month = end
+    ensure_images_view(conn)
+    return moved
+
+
+def _encode_strings(values: list) -> tuple:
+    # Variable-length strings as one UTF-8 buffer plus offsets; -1 length marks NULL
+    encoded = [None if v is None else v.encode('utf-8') for v in values]
+    lengths = np.array([-1 if e is None else len(e) for e in encoded], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.maximum(lengths, 0))])
+    data = np.frombuffer(b''.join(e for e in encoded if e), dtype=np.uint8)
+    return data, offsets, lengths
+
+
+def _decode_strings(data: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> list:
+    raw = data.tobytes()
+    return [None if n < 0 else raw[o:o + n].decode('utf-8') for o, n in zip(offsets[:-1].tolist(), lengths.tolist())]
+
+
+def write_archive(rows: list, path: str) -> int:
+    """Write image rows (dicts) to one compressed .npz of columns; returns the row count"""
+    columns = {}
+    for name in COLUMNS:
+        values = [row[name] for row in rows]
+        kind = Image.__table__.c[name].type.python_type
+        if kind is datetime:
+            columns[name] = np.array([
+                NULL_TIMESTAMP if v is None else (v - EPOCH) // timedelta(microseconds=1)
+                for v in values], dtype=np.int64)
+        elif kind is int:
+            columns[name] = np.array([0 if v is None else v for v in values], dtype=np.int64)
+            columns[f"{name}.null"] = np.array([v is None for v in values])
+        else:
+            columns[f"{name}.data"], columns[f"{name}.offsets"], columns[f"{name}.lengths"] = _encode_strings(values)
+    temporary = f"{path}.tmp.npz"
+    np.savez_compressed(temporary, **columns)
+    os.replace(temporary, path)
+    return len(rows)
+
+
+def read_archive(path: str) -> list:
+    """Read an archive written by write_archive back into row dicts"""
+    with np.load(path) as archive:
+        columns = {}
+        for name in COLUMNS:
+            kind = Image.__table__.c[name].type.python_type
+            if kind is datetime:
+                columns[name] = [None if v == NULL_TIMESTAMP else EPOCH + timedelta(microseconds=v)
+                                 for v in archive[name].tolist()]
+            elif kind is int:
+                columns[name] = [None if null else v
+                                 for v, null in zip(archive[name].tolist(), archive[f"{name}.null"].tolist())]
+            else:
+                columns[name] = _decode_strings(archive[f"{name}.data"], archive[f"{name}.offsets"],
+                                                archive[f"{name}.lengths"])
+    return [dict(zip(COLUMNS, values)) for values in zip(*columns.values())]
+
+
+@metrics.timed("job.archive_images")
+def archive_cold_months(engine, directory: str = ARCHIVE_DIR, after_months: int = ARCHIVE_AFTER_MONTHS,
+                        now: datetime = None) -> list:
+    """Write monthly partitions older than `after_months` to ARCHIVE_DIR and drop them"""
+    cutoff = month_start(now or datetime.utcnow(), -after_months)
+    os.makedirs(directory, exist_ok=True)
+    archived = []
+    with engine.connect() as conn:
+        names = [name for name in list_partitions(conn) if _partition_month(name) < cutoff]
+    for name in names:
+        month = _partition_month(name)
+        path = os.path.join(directory, f"images-{month:%Y-%m}.npz")
+        # One transaction per month; the partition is only dropped once its
+        # archive has been written and read back
+        with engine.begin() as conn:
+            table = Table(name, MetaData(), autoload_with=conn)
+            rows = [dict(row._mapping) for row in conn.execute(select(table).order_by(table.c.id))]
+            write_archive(rows, path)
+            if len(read_archive(path)) != len(rows):
+                raise RuntimeError(f"Archive {path} doesn't match {name}")
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text(f"ALTER TABLE images DETACH PARTITION {name}"))
+            else:
+                _forget_search_rows(conn, rows)
+            conn.execute(text(f"DROP TABLE {name}"))
+            if conn.dialect.name == 'sqlite':
+                ensure_images_view(conn)
+        with open(os.path.join(directory, 'manifest.json'), 'a') as f:
+            f.write(json.dumps({'partition': name, 'file': os.path.basename(path), 'rows': len(rows),
+                                'archived_at': datetime.utcnow().isoformat()}) + '\n')
+        metrics.inc("images_archived_total", len(rows))
+        archived.append((name, len(rows)))
+    return archived
+
+
+def _forget_search_rows(conn, rows: list):
+    # Contentless FTS5 rows are deleted by replaying their original values
+    if not rows or not conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'images_fts'")).first():
+        return
+    conn.execute(text(
+        "INSERT INTO images_fts(images_fts, rowid, prompt, owner) VALUES ('delete', :id, :prompt, :owner)"),
+        [{'id': row['id'], 'prompt': row['prompt'] or '', 'owner': f"u{row['user_id']}"} for row in rows])
+
+
+def maintain(engine, now: datetime = None) -> dict:
+    """Create upcoming partitions (Postgres) or roll cold months out of the hot table (SQLite)"""
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            migrate_postgres(conn)
+            return {'created': ensure_partitions(conn)}
+        return {'moved': roll_sqlite_months(conn, now)}
+
+
+def benchmark(rows: int = 2_000_000, months: int = 36, users: int = 2000, queries: int = 200):
+    """Time 30-day usage queries before and after partitioning a SQLite history, then archive"""
+    import random
+    import tempfile
+    from sqlalchemy import func
+    from models import Base
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'partitions.db')
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    now = datetime.utcnow()
+    rng = random.Random(0)
+    span = months * 30 * 86400
+    with engine.begin() as conn:
+        for start in range(0, rows, 100_000):
+            stamps = sorted(now - timedelta(seconds=rng.randrange(span)) for _ in range(min(100_000, rows - start)))
+            conn.execute(Image.__table__.insert(), [{
+                'user_id': rng.randrange(1, users + 1), 'prompt': 'benchmark prompt', 'style': 'Cinematic',
+                'width': 1024, 'height': 1024, 'image_url': 'https://example.com/i.png', 'created_at': stamp,
+            } for stamp in stamps])
+        ensure_images_view(conn)
+
+    def daily_usage(model):
+        since = now - timedelta(days=30)
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            for _ in range(queries):
+                conn.execute(select(func.date(model.created_at), func.count(model.id)).where(
+                    model.user_id == rng.randrange(1, users + 1), model.created_at >= since
+                ).group_by(func.date(model.created_at))).all()
+            return (time.perf_counter() - started) / queries * 1000
+
+    def hot_rows():
+        with engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(Image.__table__)).scalar()
+
+    before = daily_usage(Image)
+    before_rows = hot_rows()
+    started = time.perf_counter()
+    moved = maintain(engine, now)['moved']
+    rolled = time.perf_counter() - started
+    after = daily_usage(Image)
+    history = daily_usage(ImageRecord)
+    print(f"{rows:,} rows over {months} months")
+    print(f"rolled {sum(n for _, n in moved):,} rows into {len(moved)} monthly tables in {rolled:.1f}s; "
+          f"hot table {before_rows:,} -> {hot_rows():,} rows")
+    print(f"30-day usage query: {before:.2f} ms -> {after:.2f} ms (images_all view: {history:.2f} ms)")
+
+    started = time.perf_counter()
+    archived = archive_cold_months(engine, os.path.join(directory, 'archive'), now=now)
+    elapsed = time.perf_counter() - started
+    archive_bytes = sum(os.path.getsize(os.path.join(directory, 'archive', f))
+                        for f in os.listdir(os.path.join(directory, 'archive')) if f.endswith('.npz'))
+    print(f"archived {sum(n for _, n in archived):,} rows from {len(archived)} months in {elapsed:.1f}s "
+          f"to {archive_bytes / 1e6:.1f} MB of .npz")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monthly partitioning and archival for the images table")
+    parser.add_argument('command', choices=['migrate', 'maintain', 'archive', 'bench'])
+    parser.add_argument('--dir', default=ARCHIVE_DIR)
+    parser.add_argument('--after-months', type=int, default=ARCHIVE_AFTER_MONTHS)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        benchmark()
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        engine = create_engine(os.environ['DATABASE_URL'])
+        if args.command == 'migrate':
+            with engine.begin() as conn:
+                if conn.dialect.name == 'postgresql':
+                    migrate_postgres(conn)
+                else:
+                    roll_sqlite_months(conn)
+            print("images is now partitioned by month")
+        elif args.command == 'maintain':
+            print(maintain(engine))
+        else:
+            for name, count in archive_cold_months(engine, args.dir, args.after_months):
+                print(f"archived {name}: {count} rows")
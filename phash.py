@@ -0,0 +1,202 @@
+import threading
+from functools import lru_cache
+import numpy as np
+from PIL import Image as PILImage
+from sqlalchemy import select
+import metrics
+
+# 64-bit difference hashes: each bit says whether a pixel of a 9x8 grayscale
+# thumbnail is brighter than its right-hand neighbour. Near-identical images
+# differ in a handful of bits.
+HASH_SIZE = 8
+# Images this close count as near duplicates in galleries
+NEAR_DUPLICATE_DISTANCE = 6
+
+# Multi-index hashing: the hash is split into CHUNKS 16-bit pieces. Two hashes
+# within distance r agree to within r // CHUNKS bits on at least one piece,
+# so only entries near one of the query's pieces have to be compared.
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+# New hashes go to a small unsorted tail that is scanned linearly and merged
+# into the sorted chunk tables once it grows past this
+MERGE_THRESHOLD = 4096
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash_array(gray: np.ndarray) -> np.ndarray:
+    """Hash a stack of (..., 8, 9) grayscale thumbnails to uint64"""
+    bits = gray[..., :, 1:] > gray[..., :, :-1]
+    packed = np.packbits(bits.reshape(*bits.shape[:-2], 64), axis=-1, bitorder='little')
+    return packed.view('<u8')[..., 0]
+
+
+def dhash(image: PILImage.Image) -> int:
+    """64-bit difference hash of a PIL image"""
+    thumb = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PILImage.LANCZOS)
+    return int(dhash_array(np.asarray(thumb, dtype=np.int16)))
+
+
+def to_signed(value: int) -> int:
+    """Map an unsigned 64-bit hash into BigInteger's signed range"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a: np.ndarray, b) -> np.ndarray:
+    """Vectorised Hamming distance between uint64 hashes"""
+    diff = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.uint64(b))
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def _chunks(hashes: np.ndarray) -> np.ndarray:
+    # (n, CHUNKS) array of 16-bit pieces
+    return hashes.view(np.uint16).reshape(-1, CHUNKS)
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(radius: int) -> np.ndarray:
+    """Every 16-bit mask with at most `radius` bits set"""
+    masks = np.arange(1 << CHUNK_BITS, dtype=np.uint32)
+    bits = _POPCOUNT[masks & 0xFF] + _POPCOUNT[masks >> 8]
+    return masks[bits <= radius].astype(np.uint16)
+
+
+class HashIndex:
+    """Multi-index hash table answering Hamming-radius queries over image hashes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._owners = np.empty(0, dtype=np.int64)
+        # Per chunk: sorted piece values and the row each came from
+        self._keys = [np.empty(0, dtype=np.uint16) for _ in range(CHUNKS)]
+        self._rows = [np.empty(0, dtype=np.int64) for _ in range(CHUNKS)]
+        self._sorted = 0
+        self.last_id = 0
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def extend(self, ids, hashes, owners):
+        """Add many (id, unsigned hash, owner) rows"""
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            self._hashes = np.concatenate([self._hashes, np.asarray(hashes, dtype=np.uint64)])
+            self._ids = np.concatenate([self._ids, ids])
+            self._owners = np.concatenate([self._owners, np.asarray(owners, dtype=np.int64)])
+            if len(ids):
+                self.last_id = max(self.last_id, int(ids.max()))
+            if len(self._hashes) - self._sorted > MERGE_THRESHOLD:
+                self._rebuild()
+
+    def add(self, image_id: int, value: int, owner: int):
+        self.extend([image_id], [value], [owner])
+
+    def _rebuild(self):
+        pieces = _chunks(self._hashes)
+        for c in range(CHUNKS):
+            order = np.argsort(pieces[:, c], kind='stable')
+            self._keys[c] = pieces[order, c]
+            self._rows[c] = order
+        self._sorted = len(self._hashes)
+
+    def _candidates(self, value: int, radius: int) -> np.ndarray:
+        pieces = _chunks(np.array([value], dtype=np.uint64))[0]
+        found = [np.arange(self._sorted, len(self._hashes))]
+        for c in range(CHUNKS):
+            probes = np.sort(np.bitwise_xor(_flip_masks(radius), pieces[c]))
+            lo = np.searchsorted(self._keys[c], probes, 'left')
+            hi = np.searchsorted(self._keys[c], probes, 'right')
+            found.extend(self._rows[c][start:stop] for start, stop in zip(lo, hi) if stop > start)
+        return np.unique(np.concatenate(found))
+
+    @metrics.timed("phash.query")
+    def query(self, value: int, max_distance: int = NEAR_DUPLICATE_DISTANCE, owner: int = None) -> list:
+        """[(image_id, distance)] within max_distance of an unsigned hash, closest first"""
+        with self._lock:
+            rows = self._candidates(value, max_distance // CHUNKS)
+            if owner is not None:
+                rows = rows[self._owners[rows] == owner]
+            distances = hamming(self._hashes[rows], value)
+            keep = distances <= max_distance
+            ids, distances = self._ids[rows[keep]], distances[keep]
+        # A row added locally can also arrive through catch-up; report it once
+        ids, first = np.unique(ids, return_index=True)
+        distances = distances[first]
+        order = np.argsort(distances, kind='stable')
+        return list(zip(ids[order].tolist(), distances[order].tolist()))
+
+    def linear_query(self, value: int, max_distance: int = NEAR_DUPLICATE_DISTANCE) -> list:
+        """Brute-force equivalent of query(), for benchmarking"""
+        distances = hamming(self._hashes, value)
+        rows = np.flatnonzero(distances <= max_distance)
+        order = np.argsort(distances[rows], kind='stable')
+        return list(zip(self._ids[rows[order]].tolist(), distances[rows[order]].tolist()))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_hash_index(db) -> HashIndex:
+    """Get the process-wide hash index for a database, catching up on rows added elsewhere
+
+    Rows are read through images_all so months rolled out of the hot table
+    are covered. Archived rows stay in the index until restart; callers look
+    matches up in images_all, which drops them.
+    """
+    from models import ImageRecord
+
+    url = str(db.get_bind().url)
+    with _indexes_lock:
+        index = _indexes.setdefault(url, HashIndex())
+    # Only rows newer than the last one seen are read, via the primary key
+    rows = db.execute(
+        select(ImageRecord.id, ImageRecord.phash, ImageRecord.user_id)
+        .where(ImageRecord.id > index.last_id, ImageRecord.phash.isnot(None))
+        .order_by(ImageRecord.id)
+    ).all()
+    if rows:
+        index.extend([r.id for r in rows], [to_unsigned(r.phash) for r in rows],
+                     [r.user_id or 0 for r in rows])
+    return index
+
+
+def benchmark(size: int = 1_000_000, queries: int = 1000, max_distance: int = NEAR_DUPLICATE_DISTANCE):
+    """Time radius queries over `size` random hashes against a linear scan"""
+    import time
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2 ** 64, size, dtype=np.uint64)
+    index = HashIndex()
+    started = time.perf_counter()
+    index.extend(np.arange(1, size + 1), hashes, np.zeros(size))
+    build = time.perf_counter() - started
+
+    # Queries are perturbed copies of stored hashes, so each has a true match
+    targets = hashes[rng.integers(0, size, queries)]
+    flips = rng.integers(0, 64, (queries, max_distance))
+    probes = [int(t) ^ sum(1 << int(f) for f in set(fl)) for t, fl in zip(targets, flips)]
+
+    started = time.perf_counter()
+    indexed = [index.query(p, max_distance) for p in probes]
+    indexed_time = time.perf_counter() - started
+    started = time.perf_counter()
+    linear = [index.linear_query(p, max_distance) for p in probes[:50]]
+    linear_time = (time.perf_counter() - started) / 50 * queries
+
+    if any(sorted(a) != sorted(b) for a, b in zip(indexed, linear)):
+        raise SystemExit("Indexed and linear results differ")
+    print(f"{size:,} hashes indexed in {build:.2f}s")
+    print(f"radius {max_distance}: multi-index {indexed_time / queries * 1000:.2f} ms/query, "
+          f"linear scan {linear_time / queries * 1000:.2f} ms/query "
+          f"({linear_time / indexed_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    benchmark()
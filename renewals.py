@@ -0,0 +1,148 @@
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select, update, insert
+from sqlalchemy.orm import Session, sessionmaker
+from models import User, Payment, create_schema
+from subscription import PLANS
+import metrics
+
+# Users are processed in chunks, each in its own short transaction, so the
+# job never holds row locks on a large part of the users table
+RENEWAL_CHUNK_SIZE = int(os.getenv('RENEWAL_CHUNK_SIZE', '1000'))
+RENEWAL_PERIOD = timedelta(days=30)
+
+
+def _due_conditions(plan_id: str, now: datetime, auto_renew: bool) -> tuple:
+    return (
+        User.subscription_end <= now,
+        User.subscription_type == plan_id,
+        # NULL (rows created before the column existed) counts as auto-renew
+        User.auto_renew.isnot(False) if auto_renew else User.auto_renew.is_(False),
+    )
+
+
+def _due_ids(db: Session, plan_id: str, now: datetime, auto_renew: bool, limit: int) -> list:
+    # Walks the subscription_end index in order
+    return list(db.execute(
+        select(User.id).where(*_due_conditions(plan_id, now, auto_renew))
+        .order_by(User.subscription_end, User.id).limit(limit)
+    ).scalars())
+
+
+def _update_due(db: Session, ids: list, plan_id: str, now: datetime, auto_renew: bool, **values) -> list:
+    """Apply `values` to the users in `ids` that are still due; returns the ids updated
+
+    The due conditions are repeated in the UPDATE, so a user changed since
+    _due_ids (e.g. by a webhook or another job run) is left alone.
+    """
+    statement = update(User).where(User.id.in_(ids), *_due_conditions(plan_id, now, auto_renew)).values(**values)
+    if db.get_bind().dialect.update_returning:
+        return list(db.execute(statement.returning(User.id),
+                               execution_options={'synchronize_session': False}).scalars())
+    # Without RETURNING, find the rows by the values just written
+    db.execute(statement.execution_options(synchronize_session=False))
+    return list(db.execute(select(User.id).where(
+        User.id.in_(ids), *(getattr(User, name) == value for name, value in values.items())
+    )).scalars())
+
+
+def renew_plan(db: Session, plan_id: str, now: datetime, chunk_size: int = RENEWAL_CHUNK_SIZE) -> int:
+    """Reset credits and extend every due auto-renewing subscription on a plan"""
+    plan = PLANS[plan_id]
+    renewed = 0
+    while True:
+        ids = _due_ids(db, plan_id, now, True, chunk_size)
+        if not ids:
+            return renewed
+        updated = _update_due(db, ids, plan_id, now, True,
+                              subscription_end=now + RENEWAL_PERIOD,
+                              credits_remaining=plan['images_per_month'])
+        # Charge only the users actually renewed
+        if updated:
+            db.execute(insert(Payment), [{
+                'user_id': user_id,
+                'amount': plan['price'],
+                'payment_type': 'subscription',
+                'plan': plan_id,
+                'status': 'completed',
+                'created_at': now,
+            } for user_id in updated])
+        db.commit()
+        renewed += len(updated)
+
+
+def expire_plan(db: Session, plan_id: str, now: datetime, chunk_size: int = RENEWAL_CHUNK_SIZE) -> int:
+    """Move due subscriptions that won't renew back to the free tier
+
+    Remaining credits are left alone since they may include purchased packs.
+    """
+    expired = 0
+    while True:
+        ids = _due_ids(db, plan_id, now, False, chunk_size)
+        if not ids:
+            return expired
+        updated = _update_due(db, ids, plan_id, now, False, subscription_type='free', subscription_end=None)
+        db.commit()
+        expired += len(updated)
+
+
+def run_renewals(db: Session, now: datetime = None, chunk_size: int = RENEWAL_CHUNK_SIZE) -> dict:
+    """Renew or expire every subscription whose period has ended"""
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    stats = {'renewed': 0, 'expired': 0}
+    with metrics.span("job.renewals"):
+        for plan_id in PLANS:
+            stats['renewed'] += renew_plan(db, plan_id, now, chunk_size)
+            stats['expired'] += expire_plan(db, plan_id, now, chunk_size)
+    stats['seconds'] = time.perf_counter() - started
+    rows = stats['renewed'] + stats['expired']
+    stats['rows_per_second'] = rows / stats['seconds'] if stats['seconds'] else 0.0
+    metrics.inc("subscription_renewals_total", stats['renewed'], outcome="renewed")
+    metrics.inc("subscription_renewals_total", stats['expired'], outcome="expired")
+    return stats
+
+
+def benchmark(users: int = 200_000, chunk_size: int = RENEWAL_CHUNK_SIZE):
+    """Seed a SQLite database with due subscriptions and time one job run"""
+    import random
+    import tempfile
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'renewals.db')}")
+    create_schema(engine)
+    now = datetime.utcnow()
+    rng = random.Random(0)
+    plans = list(PLANS)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{
+            'email': f"user{i}@example.com",
+            'subscription_type': rng.choice(plans),
+            # Roughly half are due; the rest are mid-period
+            'subscription_end': now + timedelta(days=rng.uniform(-15, 15)),
+            'auto_renew': rng.random() < 0.8,
+            'credits_remaining': rng.randrange(0, 100),
+        } for i in range(users)])
+
+    db = sessionmaker(bind=engine)()
+    stats = run_renewals(db, now, chunk_size)
+    print(f"{users:,} users: renewed {stats['renewed']:,}, expired {stats['expired']:,} "
+          f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:,.0f} rows/s, chunks of {chunk_size})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monthly subscription renewal and expiry job")
+    parser.add_argument('--bench', type=int, metavar='USERS', help="Benchmark against a seeded SQLite database")
+    parser.add_argument('--chunk-size', type=int, default=RENEWAL_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.chunk_size)
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        engine = create_schema(create_engine(os.environ['DATABASE_URL']))
+        stats = run_renewals(sessionmaker(bind=engine)(), chunk_size=args.chunk_size)
+        print(f"Renewed {stats['renewed']}, expired {stats['expired']} "
+              f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:,.0f} rows/s)")
@@ -0,0 +1,252 @@
+import re
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from sqlalchemy import and_, func, text
+from sqlalchemy.orm import Session
+from models import Image, ImageRecord
+import metrics
+
+SEARCH_PAGE_SIZE = 20
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _tokens(query: str) -> list:
+    return TOKEN_RE.findall(query.lower())
+
+
+class PromptIndex(ABC):
+    """Ranked full-text search over Image.prompt, scoped to one user"""
+
+    _ready = set()
+    _ready_lock = threading.Lock()
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.bind = db.get_bind()
+        # Replicas get the index structures from the primary
+        if not db.info.get('replica'):
+            self.ensure_once(self.bind)
+
+    @classmethod
+    def ensure_once(cls, bind):
+        key = (cls.__name__, str(bind.url))
+        with cls._ready_lock:
+            if key not in cls._ready:
+                cls.ensure(bind)
+                cls._ready.add(key)
+
+    @classmethod
+    @abstractmethod
+    def ensure(cls, bind):
+        """Create the index structures if they don't exist"""
+
+    @abstractmethod
+    def add(self, image: Image):
+        """Index a newly flushed image (called in the caller's transaction)"""
+
+    @abstractmethod
+    def _search_ids(self, user_id: int, query: str, limit: int, offset: int,
+                    since: datetime, until: datetime) -> tuple:
+        """(ids, total) for one page of matches, best first"""
+
+    def search(self, user_id: int, query: str, page: int = 1, per_page: int = SEARCH_PAGE_SIZE,
+               since: datetime = None, until: datetime = None) -> tuple:
+        """Return (images, total) for one page of ranked results"""
+        if not _tokens(query):
+            return [], 0
+        with metrics.span("db.search.prompts"):
+            ids, total = self._search_ids(user_id, query, per_page, (page - 1) * per_page, since, until)
+            if not ids:
+                return [], total
+            rows = {image.id: image for image in self.db.query(ImageRecord).filter(ImageRecord.id.in_(ids))}
+        return [rows[i] for i in ids if i in rows], total
+
+
+class SQLitePromptIndex(PromptIndex):
+    """FTS5 index; the owner column lets MATCH narrow to one user's rows"""
+
+    @classmethod
+    def ensure(cls, bind):
+        with bind.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'images_fts'").first()
+            if exists:
+                return
+            conn.exec_driver_sql(
+                "CREATE VIRTUAL TABLE images_fts USING fts5("
+                "prompt, owner, content='', tokenize='porter unicode61')")
+            cls._index_all(conn)
+
+    @classmethod
+    def rebuild(cls, bind):
+        """Re-index every image, e.g. after rows were loaded without add()"""
+        cls.ensure_once(bind)
+        with bind.begin() as conn:
+            conn.exec_driver_sql("INSERT INTO images_fts(images_fts) VALUES ('delete-all')")
+            cls._index_all(conn)
+
+    @staticmethod
+    def _index_all(conn):
+        conn.exec_driver_sql(
+            "INSERT INTO images_fts(rowid, prompt, owner) "
+            "SELECT id, coalesce(prompt, ''), 'u' || user_id FROM images_all")
+
+    def add(self, image: Image):
+        self.db.execute(
+            text("INSERT INTO images_fts(rowid, prompt, owner) VALUES (:id, :prompt, :owner)"),
+            {'id': image.id, 'prompt': image.prompt or '', 'owner': f"u{image.user_id}"}
+        )
+
+    def _match(self, user_id: int, query: str) -> str:
+        terms = ' '.join(f'"{token}"' for token in _tokens(query))
+        return f'owner : "u{user_id}" AND prompt : ({terms})'
+
+    def _search_ids(self, user_id, query, limit, offset, since, until):
+        params = {'match': self._match(user_id, query), 'limit': limit, 'offset': offset}
+        date_filter = ''
+        if since or until:
+            date_filter = ' AND images_fts.rowid IN (SELECT id FROM images_all WHERE user_id = :user_id'
+            params['user_id'] = user_id
+            if since:
+                date_filter += ' AND created_at >= :since'
+                params['since'] = since
+            if until:
+                date_filter += ' AND created_at < :until'
+                params['until'] = until
+            date_filter += ')'
+
+        ids = [row[0] for row in self.db.execute(text(
+            "SELECT rowid FROM images_fts WHERE images_fts MATCH :match" + date_filter +
+            " ORDER BY rank LIMIT :limit OFFSET :offset"), params)]
+        total = self.db.execute(text(
+            "SELECT count(*) FROM images_fts WHERE images_fts MATCH :match" + date_filter),
+            params).scalar()
+        return ids, total
+
+
+class PostgresPromptIndex(PromptIndex):
+    """GIN expression index over to_tsvector(prompt); Postgres keeps it in sync"""
+
+    VECTOR = "to_tsvector('english', coalesce(prompt, ''))"
+
+    @classmethod
+    def ensure(cls, bind):
+        with bind.begin() as conn:
+            conn.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS ix_images_prompt_fts ON images USING GIN ({cls.VECTOR})")
+
+    def add(self, image: Image):
+        pass
+
+    def _search_ids(self, user_id, query, limit, offset, since, until):
+        where = f"user_id = :user_id AND {self.VECTOR} @@ plainto_tsquery('english', :query)"
+        params = {'user_id': user_id, 'query': ' '.join(_tokens(query)), 'limit': limit, 'offset': offset}
+        if since:
+            where += " AND created_at >= :since"
+            params['since'] = since
+        if until:
+            where += " AND created_at < :until"
+            params['until'] = until
+
+        ids = [row[0] for row in self.db.execute(text(
+            f"SELECT id FROM images WHERE {where} "
+            f"ORDER BY ts_rank({self.VECTOR}, plainto_tsquery('english', :query)) DESC, id DESC "
+            "LIMIT :limit OFFSET :offset"), params)]
+        total = self.db.execute(text(f"SELECT count(*) FROM images WHERE {where}"), params).scalar()
+        return ids, total
+
+
+class LikePromptIndex(PromptIndex):
+    """Fallback for databases without a full-text backend: every query term
+    must appear in the prompt, newest first, with no index to help"""
+
+    @classmethod
+    def ensure(cls, bind):
+        pass
+
+    def add(self, image: Image):
+        pass
+
+    def _search_ids(self, user_id, query, limit, offset, since, until):
+        conditions = [ImageRecord.user_id == user_id]
+        conditions += [func.lower(ImageRecord.prompt).like(f"%{token.replace('_', '/_')}%", escape='/')
+                       for token in _tokens(query)]
+        if since:
+            conditions.append(ImageRecord.created_at >= since)
+        if until:
+            conditions.append(ImageRecord.created_at < until)
+        where = and_(*conditions)
+
+        ids = [row[0] for row in self.db.query(ImageRecord.id).filter(where)
+               .order_by(ImageRecord.created_at.desc(), ImageRecord.id.desc()).limit(limit).offset(offset)]
+        total = self.db.query(func.count(ImageRecord.id)).filter(where).scalar()
+        return ids, total
+
+
+INDEX_BACKENDS = {'sqlite': SQLitePromptIndex, 'postgresql': PostgresPromptIndex}
+
+
+def _backend(bind):
+    return INDEX_BACKENDS.get(bind.dialect.name, LikePromptIndex)
+
+
+def ensure_prompt_index(engine):
+    """Create the search index on a primary database (part of models.create_schema)"""
+    _backend(engine).ensure_once(engine)
+
+
+def get_prompt_index(db: Session) -> PromptIndex:
+    """Pick the full-text backend for the session's database"""
+    return _backend(db.get_bind())(db)
+
+
+def benchmark(rows: int = 1_000_000, users: int = 1000, queries: int = 200):
+    """Time ranked prompt search over a synthetic SQLite table"""
+    import os
+    import random
+    import tempfile
+    import time
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from models import create_schema
+
+    words = ("castle dragon forest sunset city neon portrait ocean mountain robot cat "
+             "knight wizard river desert space ship garden winter storm temple").split()
+    rng = random.Random(0)
+    path = os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+    engine = create_schema(create_engine(f"sqlite:///{path}"))
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        batch = []
+        for i in range(1, rows + 1):
+            batch.append((i, rng.randrange(1, users + 1), ' '.join(rng.sample(words, 6)), 1024, 1024,
+                          datetime(2026, rng.randrange(1, 13), rng.randrange(1, 28))))
+            if len(batch) == 50_000:
+                conn.exec_driver_sql(
+                    "INSERT INTO images (id, user_id, prompt, width, height, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            conn.exec_driver_sql(
+                "INSERT INTO images (id, user_id, prompt, width, height, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", batch)
+    SQLitePromptIndex.rebuild(engine)
+    db = sessionmaker(bind=engine)()
+    index = get_prompt_index(db)
+    print(f"Loaded and indexed {rows:,} rows in {time.perf_counter() - start:.1f}s")
+
+    timings = []
+    for _ in range(queries):
+        query = ' '.join(rng.sample(words, rng.randrange(1, 3)))
+        started = time.perf_counter()
+        index.search(rng.randrange(1, users + 1), query, page=rng.randrange(1, 3))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    for q in (0.5, 0.95, 0.99):
+        print(f"p{int(q * 100)}: {timings[int(q * (len(timings) - 1))] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import date, datetime, timedelta
+import numpy as np
+from sqlalchemy import create_engine, select, func, case, and_
+from models import ImageRecord, Payment
+from partitions import ensure_images_view
+from subscription import PLANS
+
+# Columnar snapshots of the images and payments tables for fleet-wide
+# reporting. Each column is a .npy file that is memory-mapped on load;
+# strings are dictionary-encoded and dates are stored as int64 days.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+EXPORT_CHUNK_ROWS = 100_000
+EPOCH = date(1970, 1, 1)
+NULL_DAY = -1
+BINCOUNT_MAX_KEYS = 50_000_000
+
+# Payments made before Payment.plan existed: subscriptions are matched to a
+# plan by price, credit packs are pay-as-you-go
+LEGACY_PAYMENT_PLAN = case(
+    *[(and_(Payment.payment_type == 'subscription', Payment.amount == plan['price']), plan_id)
+      for plan_id, plan in PLANS.items()],
+    (Payment.payment_type == 'credits', 'pay_as_you_go'),
+)
+
+# column name -> (SQL expression, kind)
+IMAGE_COLUMNS = {
+    'id': (ImageRecord.id, 'int64'),
+    'user_id': (ImageRecord.user_id, 'int64'),
+    'day': (ImageRecord.created_at, 'day'),
+    'style': (ImageRecord.style, 'string'),
+    'width': (ImageRecord.width, 'int32'),
+    'height': (ImageRecord.height, 'int32'),
+}
+PAYMENT_COLUMNS = {
+    'id': (Payment.id, 'int64'),
+    'user_id': (Payment.user_id, 'int64'),
+    'day': (Payment.created_at, 'day'),
+    'amount': (Payment.amount, 'float64'),
+    'payment_type': (Payment.payment_type, 'string'),
+    'status': (Payment.status, 'string'),
+    'plan': (func.coalesce(Payment.plan, LEGACY_PAYMENT_PLAN), 'string'),
+}
+
+
+def to_day(value) -> int:
+    """Days since 1970-01-01 for a datetime/date, NULL_DAY for None"""
+    if value is None:
+        return NULL_DAY
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def from_day(day: int) -> date:
+    return EPOCH + timedelta(days=int(day))
+
+
+def _export_table(conn, model, columns: dict, directory: str):
+    max_id = conn.execute(select(func.max(model.id))).scalar() or 0
+    rows = conn.execute(select(func.count(model.id)).where(model.id <= max_id)).scalar()
+    os.makedirs(directory)
+
+    arrays = {}
+    dictionaries = {}
+    for name, (_, kind) in columns.items():
+        dtype = 'int64' if kind == 'day' else 'int32' if kind == 'string' else kind
+        arrays[name] = np.lib.format.open_memmap(
+            os.path.join(directory, f"{name}.npy"), mode='w+', dtype=dtype, shape=(rows,))
+        if kind == 'string':
+            dictionaries[name] = {}
+
+    query = select(*[expr for expr, _ in columns.values()]).where(model.id <= max_id).order_by(model.id)
+    result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(query)
+
+    offset = 0
+    for chunk in result.partitions(EXPORT_CHUNK_ROWS):
+        # Rows committed after max_id was read are excluded by the WHERE, but
+        # guard against rows deleted mid-export shrinking the result
+        chunk = chunk[:rows - offset]
+        end = offset + len(chunk)
+        for idx, (name, (_, kind)) in enumerate(columns.items()):
+            values = [row[idx] for row in chunk]
+            if kind == 'string':
+                codes = dictionaries[name]
+                arrays[name][offset:end] = [codes.setdefault(v, len(codes)) for v in values]
+            elif kind == 'day':
+                arrays[name][offset:end] = [to_day(v) for v in values]
+            else:
+                arrays[name][offset:end] = [0 if v is None else v for v in values]
+        offset = end
+        if offset >= rows:
+            break
+
+    for array in arrays.values():
+        array.flush()
+    meta = {
+        'rows': offset,
+        'columns': {name: kind for name, (_, kind) in columns.items()},
+        'dictionaries': {name: list(codes) for name, codes in dictionaries.items()},
+    }
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return offset
+
+
+def export_snapshot(database_url: str, directory: str = SNAPSHOT_DIR) -> dict:
+    """Write a fresh snapshot of images and payments, replacing the old one"""
+    engine = create_engine(database_url)
+    staging = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    counts = {}
+    try:
+        with engine.begin() as conn:
+            ensure_images_view(conn, replace=False)
+        with engine.connect() as conn:
+            # Postgres' default READ COMMITTED takes a new snapshot per statement;
+            # REPEATABLE READ keeps one for both tables. Elsewhere each table is
+            # only bounded by the max id read at its start.
+            if engine.dialect.name == 'postgresql':
+                conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            with conn.begin():
+                counts['images'] = _export_table(conn, ImageRecord, IMAGE_COLUMNS, os.path.join(staging, 'images'))
+                counts['payments'] = _export_table(conn, Payment, PAYMENT_COLUMNS, os.path.join(staging, 'payments'))
+        with open(os.path.join(staging, 'snapshot.json'), 'w') as f:
+            json.dump({'exported_at': datetime.utcnow().isoformat(), 'rows': counts}, f)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        engine.dispose()
+
+    previous = f"{directory}.old-{os.getpid()}"
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(staging, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+    return counts
+
+
+class ColumnTable:
+    """A memory-mapped columnar table with dictionary-encoded strings"""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.kinds = meta['columns']
+        self.dictionaries = meta['dictionaries']
+        self.columns = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')[:self.rows]
+            for name in self.kinds
+        }
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def code(self, column: str, value) -> int:
+        """Dictionary code for a string value, -1 if it never occurs"""
+        try:
+            return self.dictionaries[column].index(value)
+        except ValueError:
+            return -1
+
+    def _decode(self, column: str, code):
+        kind = self.kinds[column]
+        if kind == 'string':
+            return self.dictionaries[column][code]
+        if kind == 'day':
+            return None if code == NULL_DAY else from_day(code)
+        return code.item() if hasattr(code, 'item') else code
+
+    def aggregate(self, by: list, value: str = None, mask: np.ndarray = None) -> dict:
+        """Group rows by columns and count them (or sum `value`) in one vectorised pass"""
+        keys = np.zeros(self.rows if mask is None else int(np.count_nonzero(mask)), dtype=np.int64)
+        bases = []
+        stride = 1
+        for column in reversed(by):
+            data = self.columns[column] if mask is None else self.columns[column][mask]
+            low = int(data.min()) if len(data) else 0
+            span = (int(data.max()) - low + 1) if len(data) else 1
+            keys += (data.astype(np.int64) - low) * stride
+            bases.append((column, low, span, stride))
+            stride *= span
+        weights = None
+        if value is not None:
+            weights = self.columns[value] if mask is None else self.columns[value][mask]
+
+        if stride <= BINCOUNT_MAX_KEYS:
+            totals = np.bincount(keys, weights=weights, minlength=stride)
+            present = np.flatnonzero(totals if weights is None else np.bincount(keys, minlength=stride))
+            groups, values = present, totals[present]
+        else:
+            groups, inverse = np.unique(keys, return_inverse=True)
+            values = np.bincount(inverse, weights=weights)
+
+        output = {}
+        for group, total in zip(groups.tolist(), values.tolist()):
+            parts = []
+            for column, low, span, col_stride in bases:
+                parts.append(self._decode(column, (group // col_stride) % span + low))
+            output[tuple(reversed(parts))] = total
+        return output
+
+
+class Snapshot:
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        with open(os.path.join(directory, 'snapshot.json')) as f:
+            self.info = json.load(f)
+        self.images = ColumnTable(os.path.join(directory, 'images'))
+        self.payments = ColumnTable(os.path.join(directory, 'payments'))
+
+    def daily_generations_by_style(self, since: date = None) -> dict:
+        """{(day, style): images generated}"""
+        mask = None if since is None else self.images['day'] >= to_day(since)
+        return self.images.aggregate(['day', 'style'], mask=mask)
+
+    def revenue_by_plan(self, status: str = 'completed') -> dict:
+        """{(plan,): total amount} for payments with the given status, by the plan each one bought"""
+        mask = self.payments['status'] == self.payments.code('status', status)
+        return self.payments.aggregate(['plan'], value='amount', mask=mask)
+
+    def revenue_by_month(self, status: str = 'completed') -> dict:
+        """{(year, month): total amount}"""
+        mask = self.payments['status'] == self.payments.code('status', status)
+        days = self.payments['day'][mask].astype('datetime64[D]')
+        months = days.astype('datetime64[M]').astype(np.int64)
+        amounts = self.payments['amount'][mask]
+        groups, inverse = np.unique(months, return_inverse=True)
+        totals = np.bincount(inverse, weights=amounts)
+        return {(1970 + g // 12, g % 12 + 1): t for g, t in zip(groups.tolist(), totals.tolist())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar analytics snapshots")
+    parser.add_argument('command', choices=['export', 'report'])
+    parser.add_argument('--dir', default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from dotenv import load_dotenv
+        load_dotenv()
+        started = time.perf_counter()
+        counts = export_snapshot(os.environ['DATABASE_URL'], args.dir)
+        print(f"Exported {counts} in {time.perf_counter() - started:.1f}s")
+    else:
+        snapshot = Snapshot(args.dir)
+        started = time.perf_counter()
+        by_style = snapshot.daily_generations_by_style(date.today() - timedelta(days=30))
+        by_plan = snapshot.revenue_by_plan()
+        elapsed = time.perf_counter() - started
+        for (day, style), count in sorted(by_style.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            print(f"{day} {style or 'None':<15} {int(count)}")
+        for (plan,), amount in sorted(by_plan.items(), key=lambda item: str(item[0])):
+            print(f"{plan or 'unknown':<15} ${amount:,.2f}")
+        print(f"Aggregated {snapshot.images.rows + snapshot.payments.rows:,} rows in {elapsed * 1000:.1f} ms")
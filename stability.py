@@ -0,0 +1,254 @@
+import base64
+import json
+import os
+import time
+import requests
+import metrics
+
+# Point STABILITY_API_HOST at mock_stability.py for local benchmarking
+API_HOST = os.getenv('STABILITY_API_HOST', 'https://api.stability.ai').rstrip('/')
+DEFAULT_ENGINE = 'stable-diffusion-xl-1024-v1-0'
+CHUNK_SIZE = 64 * 1024
+
+# 'binary' asks for image/png directly; 'json' returns base64 artifacts
+RESPONSE_MODE = os.getenv('STABILITY_RESPONSE_MODE', 'binary')
+
+# Upstream credits for one 50-step image; cost scales with steps and samples
+CREDITS_PER_IMAGE = float(os.getenv('STABILITY_CREDITS_PER_IMAGE', '0.9'))
+# Upstream credits for one image-to-video generation
+CREDITS_PER_VIDEO = float(os.getenv('STABILITY_CREDITS_PER_VIDEO', '20'))
+
+# (connect, read) timeouts for generation requests. The read timeout bounds
+# each wait on the socket, including the wait for headers while upstream
+# renders; timeouts surface as requests.Timeout, which dispatch retries.
+CONNECT_TIMEOUT = float(os.getenv('STABILITY_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('STABILITY_READ_TIMEOUT', '120'))
+VIDEO_READ_TIMEOUT = float(os.getenv('STABILITY_VIDEO_READ_TIMEOUT', '300'))
+
+
+class StabilityError(Exception):
+    """Raised when the Stability API returns a non-200 response"""
+
+    def __init__(self, status_code: int, message: str, retry_after: float = None):
+        super().__init__(f"Non-200 response ({status_code}): {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+class RequestCancelled(Exception):
+    """Raised when a caller abandoned a request (e.g. a losing hedge) before its body was read"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Request cancelled after a {status_code} response")
+        self.status_code = status_code
+
+
+# Prompt suffixes for each style preset offered in the UI and the API
+STYLE_PROMPTS = {
+    "Photorealistic": "ultra realistic, 8k uhd, high detail, professional photography",
+    "Cinematic": "cinematic lighting, dramatic composition, movie still, 8k resolution",
+    "Anime": "high quality anime art, detailed illustration, Studio Ghibli style",
+    "Digital Art": "highly detailed digital art, 8k resolution, trending on artstation",
+    "Fantasy": "epic fantasy art, detailed illustration, trending on artstation, 8k"
+}
+
+
+def build_image_body(prompt: str, style: str = "", width: int = 1024, height: int = 1024,
+                     steps: int = 50, samples: int = 1, seed: int = 0) -> dict:
+    """Build the text-to-image request body, with style-specific prompt enhancements
+
+    seed=0 lets the API pick one; the seed used comes back with each artifact.
+    """
+    style_enhancement = STYLE_PROMPTS.get(style, "")
+    enhanced_prompt = f"{prompt}, {style_enhancement}, masterpiece, highly detailed, sharp focus, 8k uhd" if style else f"{prompt}, masterpiece, highly detailed, sharp focus, 8k uhd"
+    return {
+        "text_prompts": [
+            {"text": enhanced_prompt, "weight": 1},
+            {"text": "blurry, low quality, low resolution, pixelated, watermark", "weight": -1}
+        ],
+        "cfg_scale": 8,  # Increased for better prompt adherence
+        "height": height,
+        "width": width,
+        "samples": samples,
+        "steps": steps,  # 50 for final images; drafts use fewer
+        "seed": seed,
+        "style_preset": "enhance",
+        # Deterministic for a given seed, so a refined draft keeps its composition
+        "sampler": "K_DPMPP_2M",
+    }
+
+
+def estimate_credits(body: dict) -> float:
+    """Approximate upstream credits consumed by a text-to-image request"""
+    return CREDITS_PER_IMAGE * body.get('samples', 1) * body.get('steps', 50) / 50
+
+
+def _read_body(response) -> bytearray:
+    """Read a streamed response body into a buffer sized from Content-Length"""
+    length = response.headers.get('Content-Length')
+    if length and not response.headers.get('Content-Encoding'):
+        buf = bytearray(int(length))
+        view = memoryview(buf)
+        pos = 0
+        while pos < len(buf):
+            read = response.raw.readinto(view[pos:])
+            if not read:
+                break
+            pos += read
+        if pos < len(buf):
+            del buf[pos:]
+        return buf
+
+    buf = bytearray()
+    for chunk in response.iter_content(CHUNK_SIZE):
+        buf += chunk
+    return buf
+
+
+def text_to_image(api_key: str, body: dict, engine: str = DEFAULT_ENGINE, binary: bool = None,
+                  cancel=None) -> list:
+    """Call text-to-image and return a list of {'image', 'seed', 'finish_reason'} artifacts
+
+    Binary mode is used for single-sample requests; multi-sample requests
+    always use JSON since image/png responses carry exactly one artifact.
+    If `cancel` (a threading.Event) is set by the time headers arrive, the
+    body is not downloaded and RequestCancelled is raised.
+    """
+    if binary is None:
+        binary = RESPONSE_MODE == 'binary'
+    binary = binary and body.get('samples', 1) == 1
+
+    url = f"{API_HOST}/v1/generation/{engine}/text-to-image"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "Accept": "image/png" if binary else "application/json",
+    }
+    if binary:
+        # PNG is already compressed; keep Content-Length usable for pre-sizing
+        headers["Accept-Encoding"] = "identity"
+
+    # stream=True returns once headers arrive, so upstream queueing and
+    # payload transfer are timed separately
+    with metrics.span("image.upstream_wait"):
+        response = requests.post(url, headers=headers, json=body, stream=True,
+                                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    with response:
+        if cancel is not None and cancel.is_set():
+            raise RequestCancelled(response.status_code)
+        with metrics.span("image.transfer"):
+            content = _read_body(response)
+        metrics.inc("upstream_response_bytes_total", len(content), kind="image",
+                    mode="binary" if binary else "json")
+        if response.status_code != 200:
+            raise StabilityError(response.status_code, content.decode('utf-8', 'replace'), _retry_after(response))
+
+        if binary:
+            return [{
+                'image': content,
+                'seed': int(response.headers.get('Seed', 0) or 0),
+                'finish_reason': response.headers.get('Finish-Reason', 'SUCCESS'),
+            }]
+
+        with metrics.span("image.json_parse"):
+            data = json.loads(content)
+        artifacts = []
+        with metrics.span("image.b64decode"):
+            for artifact in data["artifacts"]:
+                artifacts.append({
+                    'image': base64.b64decode(artifact["base64"]),
+                    'seed': artifact.get('seed', 0),
+                    'finish_reason': artifact.get('finishReason', 'SUCCESS'),
+                })
+        return artifacts
+
+
+def get_balance(api_key: str, timeout: float = 10) -> float:
+    """Credits remaining on the account behind an API key"""
+    response = requests.get(f"{API_HOST}/v1/user/balance", headers={"Authorization": f"Bearer {api_key}"},
+                            timeout=timeout)
+    if response.status_code != 200:
+        raise StabilityError(response.status_code, response.text, _retry_after(response))
+    return float(response.json()['credits'])
+
+
+def image_to_video(api_key: str, image: bytes, seed: int = 0, motion_bucket_id: int = 32,
+                   text_prompt: str = "", cfg_scale: float = 2.5, fps: int = 24) -> bytes:
+    """Animate an image and return the MP4 bytes"""
+    url = f"{API_HOST}/v1/generation/stable-video-diffusion/image-to-video/upscale"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+
+    with metrics.span("video.b64encode"):
+        body = {
+            "image": base64.b64encode(image).decode('utf-8'),
+            "seed": seed,
+            "cfg_scale": cfg_scale,
+            "motion_bucket_id": motion_bucket_id,
+            "fps": fps
+        }
+    if text_prompt.strip():
+        body["text_prompt"] = text_prompt
+
+    with metrics.span("video.upstream_wait"):
+        response = requests.post(url, headers=headers, json=body, stream=True,
+                                 timeout=(CONNECT_TIMEOUT, VIDEO_READ_TIMEOUT))
+    with response:
+        with metrics.span("video.transfer"):
+            content = _read_body(response)
+        metrics.inc("upstream_response_bytes_total", len(content), kind="video", mode="json")
+        if response.status_code != 200:
+            raise StabilityError(response.status_code, content.decode('utf-8', 'replace'), _retry_after(response))
+
+        with metrics.span("video.json_parse"):
+            result = json.loads(content)
+        if 'base64' not in result:
+            raise StabilityError(response.status_code, "Invalid response format from API")
+        with metrics.span("video.b64decode"):
+            return base64.b64decode(result['base64'])
+
+
+def benchmark(requests_per_mode: int = 20, width: int = 1024, height: int = 1024):
+    """Compare JSON and binary response modes against a local mock server"""
+    import mock_stability
+
+    global API_HOST
+    server = mock_stability.start_mock_server(port=0)
+    API_HOST = f"http://127.0.0.1:{server.server_address[1]}"
+    body = {
+        "text_prompts": [{"text": "benchmark", "weight": 1}],
+        "height": height,
+        "width": width,
+        "samples": 1,
+        "steps": 50,
+    }
+    try:
+        for binary in (False, True):
+            start = time.perf_counter()
+            received = 0
+            for _ in range(requests_per_mode):
+                artifact = text_to_image("mock-key", body, binary=binary)[0]
+                received += len(artifact['image'])
+            elapsed = time.perf_counter() - start
+            mode = "binary" if binary else "json"
+            wire = metrics.counter_values().get(
+                f'upstream_response_bytes_total{{kind="image",mode="{mode}"}}', 0)
+            print(f"{mode:>6}: {elapsed / requests_per_mode * 1000:.1f} ms/request, "
+                  f"{wire / requests_per_mode / 1e6:.2f} MB on the wire, "
+                  f"{received / requests_per_mode / 1e6:.2f} MB decoded")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark()
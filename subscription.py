@@ -1,7 +1,31 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 import stripe
+from stripe.api_requestor import APIRequestor
+from stripe.http_client import RequestsClient
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from models import User, Payment
+from models import User, Payment, note_write
+import metrics
+
+# Stripe calls share one HTTP client with short timeouts and kept-alive
+# connections. STRIPE_API_BASE can point at a local stand-in (mock_stripe.py).
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_TIMEOUT_SECONDS = float(os.getenv('STRIPE_TIMEOUT_SECONDS', '10'))
+STRIPE_MAX_NETWORK_RETRIES = 2
+
+# Open checkout sessions are reused per (user, plan or package) rather than
+# created on every click. One younger than CHECKOUT_TRUST_SECONDS is handed
+# out as is (double-clicks, reruns); an older one is re-fetched first in case
+# it has been paid or expired since. Payments are applied by the webhook
+# server, a separate process whose cache clearing doesn't reach this one, so
+# a session is also re-fetched when the user has paid since it was created.
+CHECKOUT_TRUST_SECONDS = float(os.getenv('CHECKOUT_TRUST_SECONDS', '60'))
+# Don't hand out a session this close to its expires_at
+CHECKOUT_EXPIRY_MARGIN_SECONDS = 300
+CHECKOUT_CACHE_SIZE = 10000
 
 # Subscription Plans
 PLANS = {
@@ -68,17 +92,126 @@ CREDIT_PACKAGES = {
     }
 }
 
+class _StripeHttpClient(RequestsClient):
+    # Retried POSTs are safe: every request carries an Idempotency-Key
+    def _max_network_retries(self):
+        return STRIPE_MAX_NETWORK_RETRIES
+
+
+_stripe_client = None
+_stripe_client_lock = threading.Lock()
+
+
+def get_stripe_client() -> RequestsClient:
+    """Get the process-wide Stripe HTTP client; each thread keeps its own connection pool"""
+    global _stripe_client
+    with _stripe_client_lock:
+        if _stripe_client is None:
+            _stripe_client = _StripeHttpClient(timeout=STRIPE_TIMEOUT_SECONDS)
+        return _stripe_client
+
+
+class _CheckoutCache:
+    """Open checkout sessions by (user_id, kind, item), least recently used evicted first"""
+
+    def __init__(self, size: int = CHECKOUT_CACHE_SIZE, stripes: int = 64):
+        self.size = size
+        self._entries = OrderedDict()  # key -> (session, monotonic time it was last confirmed open)
+        self._lock = threading.Lock()
+        # Serialises creation per key without a lock object per user
+        self._creation_locks = [threading.Lock() for _ in range(stripes)]
+
+    def creation_lock(self, key: tuple) -> threading.Lock:
+        return self._creation_locks[hash(key) % len(self._creation_locks)]
+
+    def get(self, key: tuple):
+        """(session, seconds since confirmed open), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            session, confirmed_at = entry
+            if session.expires_at - time.time() < CHECKOUT_EXPIRY_MARGIN_SECONDS:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return session, time.monotonic() - confirmed_at
+
+    def put(self, key: tuple, session):
+        with self._lock:
+            self._entries[key] = (session, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def forget_user(self, user_id: int):
+        """Drop the user's sessions from this process's cache only"""
+        with self._lock:
+            for kind, items in (('plan', PLANS), ('credits', CREDIT_PACKAGES)):
+                for item_id in items:
+                    self._entries.pop((user_id, kind, item_id), None)
+
+
+_checkout_cache = _CheckoutCache()
+
+
+def _paid_since(db: Session, user_id: int, created: int) -> bool:
+    """Whether the user has a Payment recorded since the epoch time `created`"""
+    if db is None:
+        return False
+    return db.query(Payment.id).filter(
+        Payment.user_id == user_id, Payment.created_at >= datetime.utcfromtimestamp(created)
+    ).first() is not None
+
+
 class SubscriptionManager:
-    def __init__(self, stripe_secret_key: str):
-        stripe.api_key = stripe_secret_key
+    def __init__(self, stripe_secret_key: str, api_base: str = None):
+        # Per-manager credentials; the global stripe.api_key is left alone
+        self._requestor = APIRequestor(key=stripe_secret_key, client=get_stripe_client(),
+                                       api_base=api_base or STRIPE_API_BASE)
+    
+    def _request(self, method: str, url: str, operation: str, params: dict = None):
+        with metrics.span(f"stripe.{operation}"):
+            response, api_key = self._requestor.request(method, url, params)
+        metrics.inc("stripe_requests_total", operation=operation)
+        return stripe.util.convert_to_stripe_object(response, api_key)
+    
+    def _checkout(self, user_id: int, kind: str, item_id: str, params: dict, db: Session = None):
+        """Reuse the user's open checkout session for this item, or create one
+
+        With `db`, a cached session is re-fetched if the user paid since it was created.
+        """
+        key = (user_id, kind, item_id)
+        with _checkout_cache.creation_lock(key):
+            cached = _checkout_cache.get(key)
+            if cached is not None:
+                session, age = cached
+                if age < CHECKOUT_TRUST_SECONDS and not _paid_since(db, user_id, session.created):
+                    metrics.inc("checkout_sessions_total", outcome="reused")
+                    return session
+                session = self._request('get', f'/v1/checkout/sessions/{session.id}', 'retrieve_checkout_session')
+                if session.status == 'open':
+                    _checkout_cache.put(key, session)
+                    metrics.inc("checkout_sessions_total", outcome="revalidated")
+                    return session
+                _checkout_cache.discard(key)
+            
+            session = self._request('post', '/v1/checkout/sessions', 'create_checkout_session', params)
+            _checkout_cache.put(key, session)
+            metrics.inc("checkout_sessions_total", outcome="created")
+            return session
         
-    def create_checkout_session(self, plan_id: str, user_id: int):
-        """Create a Stripe checkout session for subscription"""
+    def create_checkout_session(self, plan_id: str, user_id: int, db: Session = None):
+        """Get a Stripe checkout session for subscription, reusing an open one"""
         plan = PLANS.get(plan_id)
         if not plan:
             raise ValueError("Invalid plan ID")
             
-        session = stripe.checkout.Session.create(
+        return self._checkout(user_id, 'plan', plan_id, dict(
             payment_method_types=['card'],
             line_items=[{
                 'price': plan['stripe_price_id'],
@@ -87,17 +220,17 @@ class SubscriptionManager:
             mode='subscription',
             success_url='https://your-domain.com/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url='https://your-domain.com/cancel',
-            client_reference_id=str(user_id)
-        )
-        return session
+            client_reference_id=str(user_id),
+            metadata={'plan_id': plan_id}
+        ), db)
         
-    def create_credit_checkout(self, package_id: str, user_id: int):
-        """Create a Stripe checkout session for credit purchase"""
+    def create_credit_checkout(self, package_id: str, user_id: int, db: Session = None):
+        """Get a Stripe checkout session for credit purchase, reusing an open one"""
         package = CREDIT_PACKAGES.get(package_id)
         if not package:
             raise ValueError("Invalid package ID")
             
-        session = stripe.checkout.Session.create(
+        return self._checkout(user_id, 'credits', package_id, dict(
             payment_method_types=['card'],
             line_items=[{
                 'price': package['stripe_price_id'],
@@ -106,12 +239,13 @@ class SubscriptionManager:
             mode='payment',
             success_url='https://your-domain.com/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url='https://your-domain.com/cancel',
-            client_reference_id=str(user_id)
-        )
-        return session
+            client_reference_id=str(user_id),
+            metadata={'package_id': package_id}
+        ), db)
 
-def update_user_subscription(db: Session, user_id: int, plan_id: str):
-    """Update user's subscription status"""
+@metrics.timed("db.subscription.update_user_subscription")
+def update_user_subscription(db: Session, user_id: int, plan_id: str, commit: bool = True):
+    """Update user's subscription status (commit=False leaves it to the caller's transaction)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise ValueError("User not found")
@@ -123,19 +257,24 @@ def update_user_subscription(db: Session, user_id: int, plan_id: str):
     user.subscription_type = plan_id
     user.subscription_end = datetime.utcnow() + timedelta(days=30)
     user.credits_remaining = plan['images_per_month']
+    # Sessions for the purchase just made must not be handed out again
+    _checkout_cache.forget_user(user_id)
     
     payment = Payment(
         user_id=user_id,
         amount=plan['price'],
         payment_type='subscription',
+        plan=plan_id,
         status='completed'
     )
     
     db.add(payment)
-    db.commit()
+    if commit:
+        db.commit()
     
-def add_user_credits(db: Session, user_id: int, package_id: str):
-    """Add credits to user's account"""
+@metrics.timed("db.subscription.add_user_credits")
+def add_user_credits(db: Session, user_id: int, package_id: str, commit: bool = True):
+    """Add credits to user's account (commit=False leaves it to the caller's transaction)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise ValueError("User not found")
@@ -145,17 +284,21 @@ def add_user_credits(db: Session, user_id: int, package_id: str):
         raise ValueError("Invalid package")
         
     user.credits_remaining += package['credits']
+    _checkout_cache.forget_user(user_id)
     
     payment = Payment(
         user_id=user_id,
         amount=package['price'],
         payment_type='credits',
+        plan='pay_as_you_go',
         status='completed'
     )
     
     db.add(payment)
-    db.commit()
+    if commit:
+        db.commit()
 
+@metrics.timed("db.subscription.check_user_credits")
 def check_user_credits(db: Session, user_id: int) -> bool:
     """Check if user has credits available"""
     user = db.query(User).filter(User.id == user_id).first()
@@ -164,14 +307,110 @@ def check_user_credits(db: Session, user_id: int) -> bool:
         
     return user.credits_remaining > 0
 
-def deduct_credit(db: Session, user_id: int):
-    """Deduct one credit from user's account"""
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise ValueError("User not found")
-        
-    if user.credits_remaining <= 0:
+@metrics.timed("db.subscription.deduct_credit")
+def deduct_credit(db: Session, user_id: int, amount: int = 1):
+    """Deduct credits from user's account
+    
+    A single conditional UPDATE, so concurrent requests (e.g. from the API
+    server) can't both spend the last credit.
+    """
+    updated = db.query(User).filter(
+        User.id == user_id,
+        User.credits_remaining >= amount
+    ).update({User.credits_remaining: User.credits_remaining - amount}, synchronize_session=False)
+    if not updated:
+        db.rollback()
+        if not db.query(User.id).filter(User.id == user_id).first():
+            raise ValueError("User not found")
         raise ValueError("No credits remaining")
         
-    user.credits_remaining -= 1
     db.commit()
+    note_write(user_id)
+
+@metrics.timed("db.subscription.refund_credit")
+def refund_credit(db: Session, user_id: int, amount: int = 1):
+    """Give back credits deducted for a job that failed"""
+    db.query(User).filter(User.id == user_id).update(
+        {User.credits_remaining: User.credits_remaining + amount}, synchronize_session=False)
+    db.commit()
+    note_write(user_id)
+
+def benchmark(users: int = 30, latency: float = 0.25, trust: float = 2.0):
+    """Drive the pricing page for many users against mock_stripe and count upstream calls
+
+    Each user double-clicks a plan, buys credits, goes back to the plan,
+    reruns the page and clicks the plan again. Then a third of them pay for
+    the plan, recorded straight in the database as the webhook server would,
+    and everyone clicks it once more within CHECKOUT_TRUST_SECONDS; the paid
+    ones must get a fresh session. Before reuse, every click created a session.
+    """
+    import re
+    import tempfile
+    import types
+    from streamlit.testing.v1 import AppTest
+    from mock_stripe import start_mock_server
+    import auth
+    from models import get_write_db
+    # The page imports this module by name, which isn't __main__ when run as a script
+    import subscription
+
+    server = start_mock_server(port=0, latency=latency)
+    subscription.STRIPE_API_BASE = f"http://127.0.0.1:{server.server_address[1]}"
+    subscription.CHECKOUT_TRUST_SECONDS = trust
+    os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_local')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'checkout.db')}"
+    page = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages', 'pricing.py')
+    pattern = ['sub_pro', 'sub_pro', 'credit_medium', 'sub_pro', None, 'sub_pro']
+    clicks = 0
+    timings = {'reused': [], 'created': []}
+
+    def click(app, key):
+        nonlocal clicks
+        calls_before = sum(server.calls.values())
+        started = time.perf_counter()
+        if key is None:
+            app.run()
+            return None
+        app.button(key=key).click().run()
+        clicks += 1
+        timings['created' if sum(server.calls.values()) > calls_before else 'reused'].append(
+            time.perf_counter() - started)
+        urls = [re.search(r'url=([^"]+)"', m.value) for m in app.markdown if 'http-equiv' in m.value]
+        return urls[-1].group(1).rsplit('/', 1)[1]
+
+    apps = []
+    for user_id in range(1, users + 1):
+        app = AppTest.from_file(page, default_timeout=60)
+        app.session_state.auth_token = auth.issue_token(types.SimpleNamespace(
+            id=user_id, email=f"user{user_id}@example.com", subscription_type='free'))
+        app.run()
+        sessions = [click(app, key) for key in pattern]
+        apps.append((app, {session_id for key, session_id in zip(pattern, sessions) if key == 'sub_pro'}))
+
+    stale = 0
+    db = get_write_db()
+    for user_id, (app, plan_sessions) in enumerate(apps, 1):
+        paid = user_id % 3 == 0
+        if paid:
+            for session_id in plan_sessions:
+                server.complete(session_id)
+            db.add(Payment(user_id=user_id, amount=PLANS['pro']['price'], payment_type='subscription',
+                           plan='pro', status='completed'))
+            db.commit()
+        if click(app, 'sub_pro') in plan_sessions and paid:
+            stale += 1
+    db.close()
+    server.shutdown()
+
+    upstream = sum(server.calls.values())
+    mean_ms = lambda values: sum(values) / len(values) * 1000 if values else 0.0
+    print(f"{users} users, {clicks} checkout clicks, {latency * 1000:.0f} ms per Stripe call")
+    print(f"upstream calls: {upstream} ({dict(server.calls)}) vs {clicks} without reuse, "
+          f"{clicks - upstream} saved ({1 - upstream / clicks:.0%})")
+    print(f"click to redirect: {mean_ms(timings['reused']):.0f} ms reused ({len(timings['reused'])}), "
+          f"{mean_ms(timings['created']):.0f} ms with a Stripe call ({len(timings['created'])})")
+    print(f"paid sessions handed out again: {stale}")
+
+
+if __name__ == "__main__":
+    benchmark()
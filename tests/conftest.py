@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# The app is a set of top-level modules, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from models import create_schema
+import stability
+from mock_stability import start_mock_server
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh SQLite database with the current schema"""
+    return create_schema(create_engine(f"sqlite:///{tmp_path / 'test.db'}"))
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(bind=engine, autoflush=False)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """Start mock_stability servers (kwargs as for start_mock_server) and point stability at the latest"""
+    servers = []
+
+    def start(**kwargs):
+        server = start_mock_server(port=0, **kwargs)
+        servers.append(server)
+        monkeypatch.setattr(stability, 'API_HOST', f"http://127.0.0.1:{server.server_address[1]}")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
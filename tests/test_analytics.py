@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+from analytics import Analytics
+from models import Payment
+
+
+def test_keyset_pages_cover_every_row_once_newest_first(db):
+    start = datetime(2026, 5, 1)
+    # Shared timestamps make the id tiebreak matter
+    db.add_all([Payment(user_id=1, amount=1.0, payment_type='credits', status='completed',
+                        created_at=start + timedelta(minutes=i // 3)) for i in range(23)])
+    db.add(Payment(user_id=2, amount=1.0, payment_type='credits', status='completed', created_at=start))
+    db.commit()
+
+    analytics = Analytics(db)
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = analytics.get_payment_history(1, limit=5, cursor=cursor)
+        seen += rows
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 5 and len(seen) == 23
+    assert {row.user_id for row in seen} == {1}
+    keys = [(row.created_at, row.id) for row in seen]
+    assert keys == sorted(keys, reverse=True) and len(set(keys)) == 23
+
+
+def test_keyset_page_without_more_rows_has_no_cursor(db):
+    db.add(Payment(user_id=1, amount=1.0, payment_type='credits', status='completed'))
+    db.commit()
+    rows, cursor = Analytics(db).get_payment_history(1, limit=1)
+    assert len(rows) == 1 and cursor is None
+    assert Analytics(db).get_images_page(1) == ([], None)
@@ -0,0 +1,71 @@
+import io
+import time
+import pytest
+import requests
+from PIL import Image as PILImage
+import api_server
+from api_server import ApiService
+from models import User
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = ApiService(f"sqlite:///{tmp_path / 'api.db'}", 'local', workers=1, max_result_bytes=250)
+    yield service
+    service.close()
+
+
+def _finish(service, result: bytes, finished_at: float = None):
+    job = api_server._Job(1, 'image')
+    service._jobs[job.id] = job
+    service._pending += 1
+    service._run(job, 0, lambda: (result, 'image/png', {}))
+    if finished_at is not None:
+        job.finished_at = finished_at
+    return job
+
+
+def test_finished_jobs_expire_after_ttl_even_behind_running_ones(service):
+    running = api_server._Job(1, 'image')
+    service._jobs[running.id] = running
+    old = _finish(service, b'x' * 10, finished_at=time.time() - api_server.JOB_TTL_SECONDS - 1)
+    fresh = _finish(service, b'x' * 10)
+    with service._lock:
+        service._expire_jobs()
+    assert list(service._jobs) == [running.id, fresh.id]
+    assert service.get_job(old.id, 1) is None
+    assert service._result_bytes == 10
+
+
+def test_results_over_the_memory_cap_drop_the_oldest_jobs(service):
+    jobs = [_finish(service, b'x' * 100) for _ in range(3)]
+    assert [service.get_job(job.id, 1) for job in jobs] == [None, jobs[1], jobs[2]]
+    assert service._result_bytes == 200
+
+
+def test_video_jobs_run_against_the_upstream(tmp_path, mock_api):
+    mock_api()
+    server, port = api_server.start_api_server(f"sqlite:///{tmp_path / 'api.db'}", 'local', port=0, workers=2)
+    try:
+        service = server.config.app.state.service
+        db = service.session_factory()
+        user = User(email='api@example.com', subscription_type='business', credits_remaining=5)
+        db.add(user)
+        db.commit()
+        headers = {'Authorization': f"Bearer {api_server.create_api_key(db, user.id)}"}
+
+        image = io.BytesIO()
+        PILImage.new('RGB', (1024, 576), (40, 80, 120)).save(image, format='JPEG')
+        base = f"http://127.0.0.1:{port}"
+        response = requests.post(f"{base}/v1/videos?seed=7", data=image.getvalue(), headers=headers, timeout=10)
+        assert response.status_code == 202
+        job = requests.get(f"{base}/v1/jobs/{response.json()['id']}?wait=10", headers=headers, timeout=20).json()
+        assert job['status'] == 'succeeded', job
+        result = requests.get(f"{base}{job['result_url']}", headers=headers, timeout=10)
+        assert result.headers['Content-Type'] == 'video/mp4' and len(result.content) == 256 * 1024
+        db.expire_all()
+        assert db.get(User, user.id).credits_remaining == 4
+        db.close()
+    finally:
+        server.should_exit = True
+        server.config.app.state.service.close()
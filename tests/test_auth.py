@@ -0,0 +1,43 @@
+import time
+import pytest
+import auth
+from models import User
+
+
+@pytest.fixture(autouse=True)
+def fast_bcrypt(monkeypatch):
+    monkeypatch.setattr(auth, 'BCRYPT_ROUNDS', 4)
+
+
+def test_login_checks_the_password(db):
+    auth.register(db, "a@example.com", "correct horse")
+    assert auth.verify_token(auth.login(db, "A@example.com ", "correct horse")).email == "a@example.com"
+    with pytest.raises(auth.AuthError):
+        auth.login(db, "a@example.com", "wrong password")
+    with pytest.raises(auth.AuthError):
+        auth.login(db, "nobody@example.com", "correct horse")
+
+
+def test_expired_tokens_are_reissued_with_the_current_plan(db, monkeypatch):
+    monkeypatch.setattr(auth, 'JWT_TTL_SECONDS', -1)
+    token = auth.register(db, "a@example.com", "correct horse")
+    with pytest.raises(auth.TokenExpired):
+        auth.verify_token(token)
+
+    db.query(User).filter(User.email == "a@example.com").one().subscription_type = 'pro'
+    db.commit()
+    monkeypatch.setattr(auth, 'JWT_TTL_SECONDS', 300)
+    principal = auth.verify_token(auth.refresh_token(db, token))
+    assert principal.plan == 'pro'
+
+
+def test_refresh_stops_when_the_login_ends(db, monkeypatch):
+    token = auth.register(db, "a@example.com", "correct horse")
+    user = db.query(User).one()
+    ended = auth.issue_token(user, session_expires_at=int(time.time()) - 1)
+    with pytest.raises(auth.TokenExpired):
+        auth.verify_token(ended)
+    with pytest.raises(auth.AuthError):
+        auth.refresh_token(db, ended)
+    with pytest.raises(auth.AuthError):
+        auth.refresh_token(db, token + "x")
@@ -0,0 +1,94 @@
+import io
+import time
+import pytest
+from PIL import Image
+import dispatch
+import stability
+from keypool import KeyPool, NoKeyAvailable
+
+
+def _jpeg(size=(1024, 576)) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', size, (40, 80, 120)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def test_animate_returns_the_video_and_spends_video_credits(mock_api):
+    mock_api(key_credits={'key-a': 100.0})
+    pool = KeyPool(['key-a'])
+    pool.refresh_balances()
+    video = dispatch.animate(pool, _jpeg(), seed=7)
+    assert len(video) == 256 * 1024
+    assert pool.snapshot()[0]['balance'] == 100.0 - stability.CREDITS_PER_VIDEO
+
+
+def test_breaker_opens_on_errors_and_a_trial_closes_it():
+    breaker = dispatch.CircuitBreaker('sdxl', min_requests=4, cooldown=0.05)
+    for _ in range(4):
+        breaker.record(False)
+    assert breaker.state == 'open' and not breaker.allow()
+    time.sleep(0.05)
+    assert breaker.allow()
+    assert breaker.state == 'half-open' and not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == 'closed'
+
+
+def _half_open(dispatcher, engine):
+    breaker = dispatcher.breakers[engine]
+    for _ in range(breaker.min_requests):
+        breaker.record(False)
+    breaker.cooldown = 0
+    return breaker
+
+
+def test_calls_that_never_reach_the_engine_dont_decide_its_trial():
+    dispatcher = dispatch.HedgedDispatcher(['sdxl'], hedge_delay=10)
+    breaker = _half_open(dispatcher, 'sdxl')
+
+    def no_key(engine, cancel):
+        raise NoKeyAvailable("every key is busy")
+
+    with pytest.raises(NoKeyAvailable):
+        dispatcher.call(no_key)
+    assert breaker.state == 'half-open'
+    # The trial slot was given back for a real probe
+    assert dispatcher.call(lambda engine, cancel: engine) == 'sdxl'
+    assert breaker.state == 'closed'
+
+
+def test_engine_failures_fail_over_to_the_next_engine():
+    dispatcher = dispatch.HedgedDispatcher(['sdxl', 'v1-6'], hedge_delay=10)
+
+    def request(engine, cancel):
+        if engine == 'sdxl':
+            raise stability.StabilityError(503, "overloaded")
+        return engine
+
+    assert dispatcher.call(request) == 'v1-6'
+
+    engines = []
+
+    def bad_prompt(engine, cancel):
+        engines.append(engine)
+        raise stability.StabilityError(400, "bad prompt")
+
+    with pytest.raises(stability.StabilityError):
+        dispatcher.call(bad_prompt)
+    # Client errors aren't retried elsewhere
+    assert engines == ['sdxl']
+
+
+def test_a_slow_attempt_is_hedged_and_the_loser_cancelled():
+    dispatcher = dispatch.HedgedDispatcher(['sdxl'], hedge_delay=0.05)
+    cancels = []
+
+    def request(engine, cancel):
+        cancels.append(cancel)
+        if len(cancels) == 1:
+            cancel.wait(5)
+            raise stability.RequestCancelled(200)
+        return 'hedge'
+
+    assert dispatcher.call(request) == 'hedge'
+    assert len(cancels) == 2 and cancels[0].wait(1) and not cancels[1].is_set()
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+import pytest
+from PIL import Image
+import history
+from history import ImageHistory
+
+# Large enough that thumbnails barely count against the budgets
+PNG = b'p' * 100_000
+
+
+@pytest.fixture
+def store(tmp_path):
+    stores = []
+
+    def make(**kwargs):
+        kwargs.setdefault('session_budget', len(PNG) * 10)
+        kwargs.setdefault('global_budget', len(PNG) * 100)
+        stores.append(ImageHistory(str(tmp_path / 'history'), **kwargs))
+        return stores[-1]
+
+    yield make
+    for s in stores:
+        s.close()
+
+
+def _add(store, session_id, count=1):
+    image = Image.new('RGB', (64, 64))
+    return [store.add(session_id, image, PNG, prompt=f"p{n}") for n in range(count)]
+
+
+def test_session_budget_spills_oldest_pngs_to_disk(store, tmp_path):
+    history_store = store(session_budget=len(PNG) * 3.5)
+    ids = _add(history_store, 'a', 5)
+    thumbnails = sum(len(e.thumbnail) for e in history_store.entries('a'))
+
+    assert sorted(os.listdir(tmp_path / 'history')) == sorted(f"{i}.png" for i in ids[:2])
+    assert history_store.resident_bytes('a') == thumbnails + len(PNG) * 3
+    # Spilled and resident entries read back the same
+    assert all(history_store.get_png('a', entry_id) == PNG for entry_id in ids)
+    assert [e.id for e in history_store.entries('a')] == ids[::-1]
+
+
+def test_global_budget_spills_across_sessions(store, tmp_path):
+    history_store = store(global_budget=len(PNG) * 4.5)
+    a = _add(history_store, 'a', 3)
+    _add(history_store, 'b', 3)
+    assert history_store.resident_bytes() <= len(PNG) * 4.5
+    # The least recently used PNGs go first, whichever session they belong to
+    assert sorted(os.listdir(tmp_path / 'history')) == sorted(f"{i}.png" for i in a[:2])
+
+    history_store.drop_session('a')
+    assert history_store.entries('a') == []
+    assert all(name[:-4] in {e.id for e in history_store.entries('b')}
+               for name in os.listdir(tmp_path / 'history'))
+
+
+def test_entry_count_is_capped(store):
+    history_store = store(max_entries=3)
+    ids = _add(history_store, 'a', 5)
+    assert [e.id for e in history_store.entries('a')] == ids[:1:-1]
+    with pytest.raises(KeyError):
+        history_store.get_png('a', ids[0])
+
+
+def test_idle_sessions_expire_without_new_images(store, tmp_path):
+    history_store = store(session_budget=0, session_ttl=0.1, expire_interval=0.05)
+    _add(history_store, 'idle', 2)
+    assert len(os.listdir(tmp_path / 'history')) == 2
+
+    deadline = time.monotonic() + 5
+    while os.listdir(tmp_path / 'history') and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert os.listdir(tmp_path / 'history') == []
+    assert history_store.entries('idle') == [] and history_store.resident_bytes() == 0
+
+
+def test_spill_files_are_written_outside_the_lock(store, monkeypatch):
+    history_store = store(session_budget=0)
+    writing, release = threading.Event(), threading.Event()
+    real_open = open
+
+    def slow_open(path, mode='r', *args, **kwargs):
+        if 'w' in mode and str(path).endswith('.png'):
+            writing.set()
+            release.wait(5)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(history, 'open', slow_open, raising=False)
+    adder = threading.Thread(target=_add, args=(history_store, 'a'))
+    adder.start()
+    assert writing.wait(5)
+    # Other sessions aren't blocked by the write, and the PNG is still readable
+    assert history_store._lock.acquire(timeout=1)
+    history_store._lock.release()
+    [entry] = history_store.entries('a')
+    assert history_store.get_png('a', entry.id) == PNG
+    release.set()
+    adder.join(5)
+    assert history_store.get_png('a', entry.id) == PNG
+    assert entry.png is None
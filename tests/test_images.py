@@ -0,0 +1,77 @@
+import io
+import numpy as np
+from PIL import Image as PILImage
+from sqlalchemy import create_engine, inspect
+import media
+import phash
+from analytics import Analytics
+from models import create_schema
+
+
+def _png(seed: int, tweak: bool = False) -> tuple:
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8).repeat(4, axis=0).repeat(4, axis=1)
+    if tweak:
+        pixels[0, 0] ^= 1
+    image = PILImage.fromarray(pixels)
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return image, output.getvalue()
+
+
+def test_store_image_shares_identical_bytes_only(tmp_path):
+    _, png = _png(1)
+    _, tweaked = _png(1, tweak=True)
+    first = media.store_image(png, str(tmp_path))
+    assert media.store_image(png, str(tmp_path)) == first
+    other = media.store_image(tweaked, str(tmp_path))
+    assert other != first
+    with open(first, 'rb') as f:
+        assert f.read() == png
+
+
+def test_saved_images_are_hashed_and_found_as_near_duplicates(db, tmp_path):
+    analytics = Analytics(db)
+    saved = []
+    for seed, tweak in ((1, False), (1, True), (2, False)):
+        image, png = _png(seed, tweak)
+        saved.append(analytics.track_image_generation(
+            7, f"prompt {seed}", "", 256, 256, media.store_image(png, str(tmp_path)), phash=phash.dhash(image)))
+
+    assert all(image.phash is not None for image in saved)
+    # Each row keeps its own file; near-identical images aren't merged
+    assert saved[0].image_url != saved[1].image_url
+    assert [i.id for i in analytics.find_near_duplicates(7, saved[0].id)] == [saved[1].id]
+    assert analytics.find_near_duplicates(8, saved[0].id) == []
+
+
+def test_create_schema_adds_phash_to_existing_images_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE images (id INTEGER PRIMARY KEY, user_id INTEGER, prompt VARCHAR, "
+            "negative_prompt VARCHAR, style VARCHAR, width INTEGER, height INTEGER, image_url VARCHAR, "
+            "created_at DATETIME)")
+    create_schema(engine)
+    assert 'phash' in {c['name'] for c in inspect(engine).get_columns('images')}
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT phash FROM images_all").all() == []
+
+
+def _encode(image, format: str, **params) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format=format, **params)
+    return output.getvalue()
+
+
+def test_video_input_is_downscaled_and_never_grows():
+    photo = PILImage.fromarray(np.random.default_rng(0).integers(0, 256, (1152, 2048, 3), dtype=np.uint8))
+    data, info = media.prepare_video_input(_encode(photo, 'JPEG', quality=95))
+    assert PILImage.open(io.BytesIO(data)).size == info['size'] == (1024, 576)
+    assert info['bytes_saved'] > 0
+
+    # Already the right size and smaller than a quality-90 re-encode
+    small = _encode(photo.resize((768, 768)), 'JPEG', quality=40)
+    data, info = media.prepare_video_input(small)
+    assert data == small
+    assert info['bytes_saved'] == 0
@@ -0,0 +1,54 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import metrics
+import stability
+from keypool import KeyPool, NoKeyAvailable, key_label
+
+BODY = {"text_prompts": [{"text": "test", "weight": 1}], "width": 64, "height": 64, "samples": 1, "steps": 50}
+
+
+def _served(before, after, key, outcome='ok'):
+    name = f'stability_key_requests_total{{key="{key_label(key)}",outcome="{outcome}"}}'
+    return after.get(name, 0) - before.get(name, 0)
+
+
+def test_pool_learns_each_keys_concurrency_limit(mock_api):
+    limits = {'key-small': 2, 'key-large': 6}
+    mock_api(latency=0.05, key_limits=limits)
+    pool = KeyPool(list(limits))
+    before = metrics.counter_values()
+    with ThreadPoolExecutor(12) as executor:
+        results = list(executor.map(
+            lambda _: pool.call(lambda key: stability.text_to_image(key, BODY)), range(120)))
+    after = metrics.counter_values()
+
+    assert len(results) == 120
+    learned = {state.key: state.limit for state in pool.keys}
+    assert learned['key-small'] <= limits['key-small']
+    assert learned['key-large'] <= limits['key-large']
+    # The larger key takes the larger share, and few requests were throttled
+    assert _served(before, after, 'key-large') > 2 * _served(before, after, 'key-small')
+    throttled = sum(_served(before, after, key, 'throttled') for key in limits)
+    assert throttled < 12
+
+
+def test_rejected_and_exhausted_keys_are_skipped(mock_api):
+    mock_api(key_credits={'key-good': 1e6, 'key-broke': 0.0})
+    pool = KeyPool(['key-revoked', 'key-broke', 'key-good'])
+    for _ in range(5):
+        pool.call(lambda key: stability.text_to_image(key, BODY))
+    drained = {info['key']: info['drained'] for info in pool.snapshot()}
+    assert drained == {key_label('key-revoked'): True, key_label('key-broke'): True, key_label('key-good'): False}
+
+
+def test_fails_fast_when_no_key_can_serve(mock_api):
+    mock_api(key_credits={'key-broke': 0.0})
+    pool = KeyPool(['key-revoked', 'key-broke'], wait=30)
+    started = time.monotonic()
+    with pytest.raises(stability.StabilityError) as error:
+        pool.call(lambda key: stability.text_to_image(key, BODY))
+    assert error.value.status_code in (401, 402)
+    with pytest.raises(NoKeyAvailable):
+        pool.call(lambda key: stability.text_to_image(key, BODY))
+    assert time.monotonic() - started < 5
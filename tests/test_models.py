@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import time
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+import models
+from models import User, create_schema
+
+
+def _baseline_users_table(path):
+    # The users table as first released, before auto_renew and the renewal index
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE, password VARCHAR, "
+            "subscription_type VARCHAR, subscription_end DATETIME, credits_remaining INTEGER, "
+            "created_at DATETIME)")
+        conn.exec_driver_sql("INSERT INTO users (email, subscription_type, credits_remaining) "
+                             "VALUES ('old@example.com', 'pro', 5)")
+    return engine
+
+
+def test_create_schema_adds_columns_to_existing_tables(tmp_path):
+    engine = create_schema(_baseline_users_table(tmp_path / 'old.db'))
+
+    columns = {c['name'] for c in inspect(engine).get_columns('users')}
+    assert 'auto_renew' in columns
+    assert 'ix_users_subscription_end' in {i['name'] for i in inspect(engine).get_indexes('users')}
+    user = sessionmaker(bind=engine)().query(User).one()
+    assert user.email == 'old@example.com'
+    assert user.auto_renew
+
+
+def test_create_schema_is_idempotent(tmp_path):
+    engine = _baseline_users_table(tmp_path / 'old.db')
+    create_schema(engine)
+    create_schema(engine)
+    assert sessionmaker(bind=engine)().query(User).count() == 1
+
+
+def test_create_schema_adds_keyset_indexes_to_existing_tables(tmp_path):
+    engine = _baseline_users_table(tmp_path / 'old.db')
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE images (id INTEGER PRIMARY KEY, user_id INTEGER, prompt VARCHAR, "
+            "negative_prompt VARCHAR, style VARCHAR, width INTEGER, height INTEGER, image_url VARCHAR, "
+            "created_at DATETIME)")
+        conn.exec_driver_sql(
+            "CREATE TABLE payments (id INTEGER PRIMARY KEY, user_id INTEGER, amount FLOAT, "
+            "payment_type VARCHAR, status VARCHAR, created_at DATETIME)")
+    create_schema(engine)
+
+    indexes = {table: {i['name']: i['column_names'] for i in inspect(engine).get_indexes(table)}
+               for table in ('images', 'payments')}
+    assert indexes['images']['ix_images_user_created'] == ['user_id', 'created_at', 'id']
+    assert indexes['payments']['ix_payments_user_created'] == ['user_id', 'created_at', 'id']
+    assert 'plan' in {c['name'] for c in inspect(engine).get_columns('payments')}
+    with engine.connect() as conn:
+        plan = ' '.join(row[-1] for row in conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT id FROM payments WHERE user_id = 1 "
+            "AND (created_at, id) < ('2026-01-01', 5) ORDER BY created_at DESC, id DESC LIMIT 20"))
+    assert 'ix_payments_user_created' in plan
+
+
+@pytest.fixture
+def replicated(tmp_path, monkeypatch):
+    """A primary and a replica SQLite file, with the replica a copy of the primary's state so far"""
+    primary_path, replica_path = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{primary_path}")
+    monkeypatch.setenv('DATABASE_REPLICA_URL', f"sqlite:///{replica_path}")
+    monkeypatch.setattr(models, '_recent_writes', {})
+    create_schema(models.get_engine(os.environ['DATABASE_URL']))
+
+    def replicate():
+        with sqlite3.connect(primary_path) as source, sqlite3.connect(replica_path) as target:
+            source.backup(target)
+
+    return replicate
+
+
+def _read(user_id):
+    session = models.get_read_db(user_id)
+    try:
+        target = 'replica' if session.info['replica'] else 'primary'
+        return target, session.query(User.credits_remaining).filter(User.id == user_id).scalar()
+    finally:
+        session.close()
+
+
+def test_reads_stay_on_the_primary_right_after_a_write(replicated, monkeypatch):
+    monkeypatch.setattr(models, 'READ_YOUR_WRITES_SECONDS', 0.2)
+    db = models.get_write_db()
+    db.add_all([User(email='writer@example.com', credits_remaining=10),
+                User(email='reader@example.com', credits_remaining=10)])
+    db.commit()
+    writer, reader = (user.id for user in db.query(User).order_by(User.id))
+    replicated()
+    models._recent_writes.clear()
+
+    # The replica lags behind this write
+    db.query(User).filter(User.id == writer).one().credits_remaining = 9
+    db.commit()
+    db.close()
+    assert _read(writer) == ('primary', 9)
+    assert _read(reader) == ('replica', 10)
+    time.sleep(0.2)
+    assert _read(writer) == ('replica', 10)
+
+    session = models.get_read_db(writer, primary=True)
+    assert not session.info['replica']
+    session.close()
+
+
+def test_read_sessions_reject_writes(replicated):
+    replicated()
+    session = models.get_read_db()
+    session.add(User(email='new@example.com'))
+    with pytest.raises(models.ReadOnlySessionError):
+        session.flush()
+    session.rollback()
+    session.close()
+
+
+def test_write_stamps_are_pruned(monkeypatch):
+    monkeypatch.setattr(models, '_recent_writes', {})
+    monkeypatch.setattr(models, 'READ_YOUR_WRITES_SECONDS', 0.05)
+    models.note_write(1)
+    assert models.wrote_recently(1)
+    time.sleep(0.05)
+    models.note_write(2)
+    assert set(models._recent_writes) == {2} and not models.wrote_recently(1)
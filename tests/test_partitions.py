@@ -0,0 +1,77 @@
+from datetime import datetime
+from sqlalchemy import inspect
+import partitions
+import phash
+from analytics import Analytics
+from models import Image, ImageRecord
+from search import get_prompt_index
+
+NOW = datetime(2026, 6, 15)
+
+
+def _seed(db):
+    analytics = Analytics(db)
+    saved = []
+    for prompt, created_at, hash_value in (
+        ("castle in january", datetime(2026, 1, 3), 0x0F0F),
+        ("castle on a hill", datetime(2026, 1, 20), None),
+        ("castle in march", datetime(2026, 3, 9), 0x0F0E),
+        ("castle in may", datetime(2026, 5, 1), None),
+        ("castle in june", datetime(2026, 6, 2), None),
+    ):
+        image = analytics.track_image_generation(1, prompt, "", 512, 512, "x.png", phash=hash_value)
+        image.created_at = created_at
+        saved.append(image)
+    db.commit()
+    return [image.id for image in saved]
+
+
+def test_rolled_months_stay_readable_through_images_all(engine, db):
+    ids = _seed(db)
+    with engine.begin() as conn:
+        moved = partitions.roll_sqlite_months(conn, NOW)
+
+    assert moved == [('images_p2026_01', 2), ('images_p2026_03', 1)]
+    assert {image.id for image in db.query(Image)} == set(ids[3:])
+    assert sorted(image.id for image in db.query(ImageRecord)) == ids
+    assert 'ix_images_p2026_01_user_created' in {
+        index['name'] for index in inspect(engine).get_indexes('images_p2026_01')}
+    # Rolling again moves nothing
+    with engine.begin() as conn:
+        assert partitions.roll_sqlite_months(conn, NOW) == []
+
+    results, total = get_prompt_index(db).search(1, "castle", since=datetime(2026, 1, 1), until=datetime(2026, 2, 1))
+    assert (total, {image.id for image in results}) == (2, set(ids[:2]))
+    # Near-duplicate lookups cover rolled months too
+    assert [match for match, _ in phash.get_hash_index(db).query(0x0F0F, 1)] == [ids[0], ids[2]]
+
+
+def test_archived_months_leave_the_database_and_read_back(engine, db, tmp_path):
+    ids = _seed(db)
+    with engine.begin() as conn:
+        partitions.roll_sqlite_months(conn, NOW)
+    before = {row['id']: row for row in (
+        {column: getattr(image, column) for column in partitions.COLUMNS}
+        for image in db.query(ImageRecord).filter(ImageRecord.id.in_(ids[:2])))}
+    db.rollback()
+
+    archived = partitions.archive_cold_months(engine, str(tmp_path / 'archive'), after_months=4, now=NOW)
+
+    assert archived == [('images_p2026_01', 2)]
+    assert 'images_p2026_01' not in inspect(engine).get_table_names()
+    assert sorted(image.id for image in db.query(ImageRecord)) == ids[2:]
+    results, total = get_prompt_index(db).search(1, "castle")
+    assert (total, sorted(image.id for image in results)) == (3, ids[2:])
+    assert get_prompt_index(db).search(1, "hill") == ([], 0)
+
+    rows = partitions.read_archive(str(tmp_path / 'archive' / 'images-2026-01.npz'))
+    assert rows == [before[i] for i in ids[:2]]
+    assert rows[0]['phash'] == 0x0F0F and rows[1]['phash'] is None
+
+
+def test_archive_round_trips_nulls_and_unicode(tmp_path):
+    row = dict.fromkeys(partitions.COLUMNS)
+    row.update(id=7, user_id=3, prompt="château 🏰", width=512, created_at=datetime(2026, 1, 2, 3, 4, 5, 6))
+    path = str(tmp_path / 'images.npz')
+    assert partitions.write_archive([row, dict(row, id=8, prompt='', created_at=None)], path) == 2
+    assert partitions.read_archive(path) == [row, dict(row, id=8, prompt='', created_at=None)]
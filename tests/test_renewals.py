@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+import renewals
+from models import User, Payment
+from subscription import PLANS
+
+NOW = datetime(2026, 6, 1)
+
+
+def _user(db, email, plan='pro', days=-1, auto_renew=True, credits=0):
+    user = User(email=email, subscription_type=plan, subscription_end=NOW + timedelta(days=days),
+                auto_renew=auto_renew, credits_remaining=credits)
+    db.add(user)
+    db.commit()
+    return user
+
+
+def test_renews_due_and_expires_cancelled(db):
+    due = _user(db, 'due@example.com')
+    cancelled = _user(db, 'cancelled@example.com', auto_renew=False, credits=7)
+    current = _user(db, 'current@example.com', days=10)
+
+    stats = renewals.run_renewals(db, NOW, chunk_size=1)
+
+    assert (stats['renewed'], stats['expired']) == (1, 1)
+    db.expire_all()
+    assert due.subscription_end == NOW + renewals.RENEWAL_PERIOD
+    assert due.credits_remaining == PLANS['pro']['images_per_month']
+    assert (cancelled.subscription_type, cancelled.subscription_end, cancelled.credits_remaining) == ('free', None, 7)
+    assert current.subscription_end == NOW + timedelta(days=10)
+    assert [p.user_id for p in db.query(Payment)] == [due.id]
+
+
+def test_second_run_changes_nothing(db):
+    _user(db, 'due@example.com')
+    renewals.run_renewals(db, NOW)
+    stats = renewals.run_renewals(db, NOW)
+    assert (stats['renewed'], stats['expired']) == (0, 0)
+    assert db.query(Payment).count() == 1
+
+
+def test_user_changed_after_selection_is_not_renewed_or_charged(db, monkeypatch):
+    due = _user(db, 'due@example.com')
+    switched = _user(db, 'switched@example.com')
+    select_due = renewals._due_ids
+
+    def due_ids_then_webhook(session, *args):
+        ids = select_due(session, *args)
+        if ids:
+            # A webhook cancels auto-renew between the SELECT and the UPDATE
+            session.query(User).filter(User.id == switched.id).update({'auto_renew': False})
+        return ids
+
+    monkeypatch.setattr(renewals, '_due_ids', due_ids_then_webhook)
+    assert renewals.renew_plan(db, 'pro', NOW) == 1
+    assert [p.user_id for p in db.query(Payment)] == [due.id]
+    db.expire_all()
+    assert switched.subscription_end == NOW - timedelta(days=1)
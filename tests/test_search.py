@@ -0,0 +1,64 @@
+from datetime import datetime
+import pytest
+from sqlalchemy.orm import sessionmaker
+from analytics import Analytics
+import search
+from search import get_prompt_index
+
+
+@pytest.fixture
+def images(db):
+    analytics = Analytics(db)
+    rows = [
+        (1, "castle at sunset over the sea", datetime(2026, 3, 2)),
+        (1, "a castle in the clouds", datetime(2026, 4, 5)),
+        (1, "robot cat", datetime(2026, 4, 6)),
+        (2, "castle made of sand", datetime(2026, 4, 7)),
+    ]
+    saved = []
+    for user_id, prompt, created in rows:
+        image = analytics.track_image_generation(user_id, prompt, "", 512, 512, "x.png")
+        image.created_at = created
+        saved.append(image)
+    db.commit()
+    return saved
+
+
+def test_search_is_scoped_to_user_and_ranked(db, images):
+    results, total = get_prompt_index(db).search(1, "castle")
+    assert total == 2
+    assert {image.id for image in results} == {images[0].id, images[1].id}
+    assert get_prompt_index(db).search(1, "dragon") == ([], 0)
+    assert get_prompt_index(db).search(1, "  ") == ([], 0)
+
+
+def test_search_filters_by_month_and_pages(db, images):
+    index = get_prompt_index(db)
+    results, total = index.search(1, "castle", since=datetime(2026, 4, 1), until=datetime(2026, 5, 1))
+    assert (total, [image.id for image in results]) == (1, [images[1].id])
+    page_one, total = index.search(1, "castle", per_page=1)
+    page_two, _ = index.search(1, "castle", page=2, per_page=1)
+    assert total == 2 and {page_one[0].id, page_two[0].id} == {images[0].id, images[1].id}
+
+
+def test_read_only_session_on_a_fresh_primary_can_search(engine):
+    # The dashboard reads through a read-only session even without a replica
+    session = sessionmaker(bind=engine)()
+    session.info['read_only'] = True
+    assert get_prompt_index(session).search(1, "castle") == ([], 0)
+
+
+def test_like_fallback_matches_every_term(db, images, monkeypatch):
+    # Dialects without a full-text backend (e.g. MySQL) fall back to LIKE
+    monkeypatch.setattr(search, 'INDEX_BACKENDS', {})
+    index = get_prompt_index(db)
+    assert isinstance(index, search.LikePromptIndex)
+    results, total = index.search(1, "Castle SEA")
+    assert (total, [image.id for image in results]) == (1, [images[0].id])
+    results, total = index.search(1, "castle")
+    assert [image.id for image in results] == [images[1].id, images[0].id]
+
+
+def test_prompt_index_is_abstract():
+    with pytest.raises(TypeError):
+        search.PromptIndex(None)
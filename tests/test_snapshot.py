@@ -0,0 +1,51 @@
+from datetime import date, datetime
+import numpy as np
+from models import User, Image, Payment
+from snapshot import Snapshot, export_snapshot
+from subscription import add_user_credits, update_user_subscription
+
+
+def test_revenue_is_attributed_to_the_plan_each_payment_bought(engine, db, tmp_path):
+    user = User(email='a@example.com', subscription_type='free', credits_remaining=0)
+    db.add(user)
+    db.commit()
+    # Paid before Payment.plan was recorded
+    db.add(Payment(user_id=user.id, amount=9.99, payment_type='subscription', status='completed',
+                   created_at=datetime(2026, 1, 5)))
+    db.commit()
+    update_user_subscription(db, user.id, 'pro')
+    add_user_credits(db, user.id, 'medium')
+    db.add(Payment(user_id=user.id, amount=49.99, payment_type='subscription', plan='business',
+                   status='failed'))
+    db.add_all([
+        Image(user_id=user.id, prompt='p', style=style, width=1024, height=1024, created_at=created_at)
+        for style, created_at in (('anime', datetime(2026, 1, 5, 9)), ('anime', datetime(2026, 1, 5, 18)),
+                                  ('photographic', datetime(2026, 1, 6)), (None, datetime(2026, 1, 6)))
+    ])
+    db.commit()
+
+    directory = str(tmp_path / 'snapshot')
+    assert export_snapshot(str(engine.url), directory) == {'images': 4, 'payments': 4}
+    snapshot = Snapshot(directory)
+
+    assert snapshot.revenue_by_plan() == {('basic',): 9.99, ('pro',): 19.99, ('pay_as_you_go',): 9.99}
+    assert snapshot.revenue_by_plan('failed') == {('business',): 49.99}
+    assert snapshot.daily_generations_by_style() == {
+        (date(2026, 1, 5), 'anime'): 2, (date(2026, 1, 6), 'photographic'): 1, (date(2026, 1, 6), None): 1}
+    assert snapshot.daily_generations_by_style(date(2026, 1, 6)) == {
+        (date(2026, 1, 6), 'photographic'): 1, (date(2026, 1, 6), None): 1}
+    assert sum(snapshot.revenue_by_month().values()) == snapshot.payments['amount'][
+        snapshot.payments['status'] == snapshot.payments.code('status', 'completed')].sum()
+    assert isinstance(snapshot.images['day'].base, np.memmap)
+
+
+def test_export_replaces_the_previous_snapshot(engine, db, tmp_path):
+    directory = str(tmp_path / 'snapshot')
+    assert export_snapshot(str(engine.url), directory) == {'images': 0, 'payments': 0}
+    assert Snapshot(directory).revenue_by_plan() == {}
+
+    db.add(Payment(user_id=1, amount=2.99, payment_type='credits', status='completed'))
+    db.commit()
+    export_snapshot(str(engine.url), directory)
+    assert Snapshot(directory).revenue_by_plan() == {('pay_as_you_go',): 2.99}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['snapshot', 'test.db']
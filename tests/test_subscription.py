@@ -0,0 +1,59 @@
+import pytest
+import subscription
+from models import Payment, User
+from mock_stripe import start_mock_server
+from subscription import SubscriptionManager, _CheckoutCache
+
+
+@pytest.fixture
+def stripe_api(monkeypatch):
+    server = start_mock_server(port=0)
+    monkeypatch.setattr(subscription, '_checkout_cache', _CheckoutCache())
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def manager(stripe_api):
+    return SubscriptionManager('sk_test_local', api_base=f"http://127.0.0.1:{stripe_api.server_address[1]}")
+
+
+def test_open_sessions_are_reused_per_user_and_item(stripe_api, manager):
+    first = manager.create_checkout_session('pro', 1)
+    assert manager.create_checkout_session('pro', 1).id == first.id
+    assert manager.create_checkout_session('basic', 1).id != first.id
+    assert manager.create_checkout_session('pro', 2).id != first.id
+    assert manager.create_credit_checkout('small', 1).id != first.id
+    assert stripe_api.calls['POST create_checkout_session'] == 4
+
+
+def test_stale_sessions_are_revalidated(stripe_api, manager, monkeypatch):
+    monkeypatch.setattr(subscription, 'CHECKOUT_TRUST_SECONDS', 0)
+    first = manager.create_checkout_session('pro', 1)
+    assert manager.create_checkout_session('pro', 1).id == first.id
+    stripe_api.complete(first.id)
+    assert manager.create_checkout_session('pro', 1).id != first.id
+    assert stripe_api.calls['GET retrieve_checkout_session'] == 2
+
+
+def test_payment_from_another_process_invalidates_a_trusted_session(stripe_api, manager, db):
+    user = User(email='a@example.com')
+    db.add(user)
+    db.commit()
+    first = manager.create_checkout_session('pro', user.id, db)
+    assert manager.create_checkout_session('pro', user.id, db).id == first.id
+
+    # The webhook server records the payment; this process's cache is untouched
+    stripe_api.complete(first.id)
+    db.add(Payment(user_id=user.id, amount=19.99, payment_type='subscription', status='completed'))
+    db.commit()
+    assert manager.create_checkout_session('pro', user.id, db).id != first.id
+
+
+def test_in_process_purchase_forgets_the_users_sessions(stripe_api, manager, db):
+    user = User(email='a@example.com')
+    db.add(user)
+    db.commit()
+    first = manager.create_checkout_session('pro', user.id)
+    subscription.update_user_subscription(db, user.id, 'pro')
+    assert manager.create_checkout_session('pro', user.id).id != first.id
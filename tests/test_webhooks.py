@@ -0,0 +1,61 @@
+import json
+import time
+import pytest
+import requests
+from models import Payment, ProcessedEvent, User
+from subscription import CREDIT_PACKAGES
+from webhooks import SignatureError, sign_payload, start_webhook_server, verify_signature
+
+SECRET = 'whsec_test'
+
+
+def _event(event_id: str, user_id: int, package_id: str = 'small') -> dict:
+    return {'id': event_id, 'type': 'checkout.session.completed', 'data': {'object': {
+        'client_reference_id': str(user_id), 'metadata': {'package_id': package_id}}}}
+
+
+@pytest.fixture
+def webhook_url(engine):
+    server = start_webhook_server(str(engine.url), port=0, secret=SECRET)
+    yield f"http://127.0.0.1:{server.server_address[1]}/stripe/webhook"
+    server.shutdown()
+    server.ingestor.stop()
+
+
+def _deliver(url: str, event: dict, secret: str = SECRET) -> int:
+    payload = json.dumps(event).encode('utf-8')
+    return requests.post(url, data=payload, headers={'Stripe-Signature': sign_payload(payload, secret)},
+                         timeout=10).status_code
+
+
+def test_signatures_are_checked():
+    payload = b'{"id": "evt_1"}'
+    assert verify_signature(payload, sign_payload(payload, SECRET), SECRET) == {'id': 'evt_1'}
+    with pytest.raises(SignatureError):
+        verify_signature(payload, sign_payload(payload, 'whsec_other'), SECRET)
+    with pytest.raises(SignatureError):
+        verify_signature(payload, sign_payload(payload, SECRET, int(time.time()) - 3600), SECRET)
+
+
+def test_redelivered_events_are_applied_once(db, webhook_url):
+    user = User(email='a@example.com', credits_remaining=0)
+    db.add(user)
+    db.commit()
+
+    event = _event('evt_1', user.id)
+    assert [_deliver(webhook_url, event) for _ in range(3)] == [200, 200, 200]
+    assert _deliver(webhook_url, _event('evt_2', user.id)) == 200
+    assert _deliver(webhook_url, event, secret='whsec_other') == 400
+
+    db.expire_all()
+    assert db.get(User, user.id).credits_remaining == 2 * CREDIT_PACKAGES['small']['credits']
+    assert db.query(Payment).filter(Payment.user_id == user.id).count() == 2
+    assert {row.event_id: row.status for row in db.query(ProcessedEvent)} == {
+        'evt_1': 'applied', 'evt_2': 'applied'}
+
+
+def test_bad_events_are_recorded_as_failed(db, webhook_url):
+    assert _deliver(webhook_url, _event('evt_bad', 12345)) == 200
+    assert _deliver(webhook_url, {'id': 'evt_other', 'type': 'invoice.paid'}) == 200
+    assert {row.event_id: row.status for row in db.query(ProcessedEvent)} == {
+        'evt_bad': 'failed', 'evt_other': 'ignored'}
@@ -0,0 +1,150 @@
+import io
+import struct
+import zlib
+import numpy as np
+from PIL import Image
+import metrics
+
+# Output is produced in bands of TILE_SIZE rows, each built from TILE_SIZE
+# wide tiles, and streamed straight into the PNG encoder. Peak memory is
+# bounded by one band rather than the full upscaled frame.
+TILE_SIZE = 256
+# Catmull-Rom reads two source pixels either side, so tiles overlap by that much
+HALO = 2
+PNG_LEVEL = 6
+
+
+def _cubic_weights(out_size: int, in_size: int, start: int, stop: int, src_lo: int, src_hi: int) -> np.ndarray:
+    """Catmull-Rom weights mapping source[src_lo:src_hi] to output[start:stop]"""
+    scale = in_size / out_size
+    centers = (np.arange(start, stop) + 0.5) * scale - 0.5
+    base = np.floor(centers).astype(np.int64)
+    frac = centers - base
+    weights = np.zeros((stop - start, src_hi - src_lo), dtype=np.float32)
+    rows = np.arange(stop - start)
+    for offset in (-1, 0, 1, 2):
+        t = np.abs(frac - offset)
+        w = np.where(t < 1, 1.5 * t ** 3 - 2.5 * t ** 2 + 1,
+                     np.where(t < 2, -0.5 * t ** 3 + 2.5 * t ** 2 - 4 * t + 2, 0.0))
+        # Clamp taps at the image edge
+        index = np.clip(base + offset, 0, in_size - 1) - src_lo
+        np.add.at(weights, (rows, index), w.astype(np.float32))
+    return weights
+
+
+def _source_span(start: int, stop: int, out_size: int, in_size: int) -> tuple:
+    scale = in_size / out_size
+    lo = int(np.floor((start + 0.5) * scale - 0.5)) - HALO + 1
+    hi = int(np.floor((stop - 0.5) * scale - 0.5)) + HALO + 1
+    return max(lo, 0), min(hi, in_size)
+
+
+def iter_upscaled_rows(source: np.ndarray, width: int, height: int, tile: int = TILE_SIZE):
+    """Yield the upscaled image one band of rows at a time"""
+    in_h, in_w, channels = source.shape
+    column_weights = []
+    for x0 in range(0, width, tile):
+        x1 = min(x0 + tile, width)
+        lo, hi = _source_span(x0, x1, width, in_w)
+        column_weights.append((x0, x1, lo, hi, _cubic_weights(width, in_w, x0, x1, lo, hi)))
+
+    for y0 in range(0, height, tile):
+        y1 = min(y0 + tile, height)
+        lo, hi = _source_span(y0, y1, height, in_h)
+        row_weights = _cubic_weights(height, in_h, y0, y1, lo, hi)
+        window = source[lo:hi].astype(np.float32)
+        # Resample vertically once per band, then each tile horizontally
+        vertical = np.tensordot(row_weights, window, axes=(1, 0))
+        band = np.empty((y1 - y0, width, channels), dtype=np.uint8)
+        for x0, x1, c_lo, c_hi, weights in column_weights:
+            tile_out = np.tensordot(vertical[:, c_lo:c_hi], weights, axes=(1, 1)).transpose(0, 2, 1)
+            np.clip(tile_out, 0, 255, out=tile_out)
+            band[:, x0:x1] = tile_out + 0.5
+        yield band
+
+
+def _png_chunk(fp, kind: bytes, data: bytes):
+    fp.write(struct.pack('>I', len(data)))
+    fp.write(kind)
+    fp.write(data)
+    fp.write(struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def write_png_stream(fp, width: int, height: int, channels: int, bands):
+    """Encode bands of uint8 rows to PNG without holding the whole image"""
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+    fp.write(b'\x89PNG\r\n\x1a\n')
+    _png_chunk(fp, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+    compressor = zlib.compressobj(PNG_LEVEL)
+    previous = np.zeros(width * channels, dtype=np.uint8)
+    for band in bands:
+        pixels = band.reshape(band.shape[0], -1)
+        # Filter type 2 (Up): each scanline minus the one above, mod 256
+        rows = np.empty((band.shape[0], 1 + width * channels), dtype=np.uint8)
+        rows[:, 0] = 2
+        np.subtract(pixels[0], previous, out=rows[0, 1:])
+        np.subtract(pixels[1:], pixels[:-1], out=rows[1:, 1:])
+        previous = pixels[-1].copy()
+        data = compressor.compress(rows)
+        if data:
+            _png_chunk(fp, b'IDAT', data)
+    _png_chunk(fp, b'IDAT', compressor.flush())
+    _png_chunk(fp, b'IEND', b'')
+
+
+@metrics.timed("image.upscale")
+def upscale_to_png(image: Image.Image, factor: int, fp=None, tile: int = TILE_SIZE):
+    """Upscale a PIL image by `factor` and stream it as PNG to fp (or return bytes)"""
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    source = np.asarray(image)
+    if source.ndim == 2:
+        source = source[:, :, None]
+    width, height = image.width * factor, image.height * factor
+
+    output = fp if fp is not None else io.BytesIO()
+    write_png_stream(output, width, height, source.shape[2],
+                     iter_upscaled_rows(source, width, height, tile))
+    if fp is None:
+        return output.getvalue()
+
+
+def benchmark(size: int = 1024, factor: int = 8):
+    """Compare peak RSS and throughput of tiled upscaling against a full-frame resize"""
+    import multiprocessing
+    import os
+    import tempfile
+
+    def run(mode, queue):
+        import resource
+        import time
+        rng = np.random.default_rng(0)
+        image = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        path = os.path.join(tempfile.mkdtemp(), f"{mode}.png")
+        started = time.perf_counter()
+        with open(path, 'wb') as f:
+            if mode == 'tiled':
+                upscale_to_png(image, factor, f)
+            else:
+                image.resize((size * factor, size * factor), Image.BICUBIC).save(f, format='PNG')
+        elapsed = time.perf_counter() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((mode, elapsed, (peak - baseline) / 1024, os.path.getsize(path)))
+        os.remove(path)
+
+    # Each mode runs in a fresh process so ru_maxrss reflects only that run
+    context = multiprocessing.get_context('fork')
+    pixels = (size * factor) ** 2
+    for mode in ('full-frame', 'tiled'):
+        queue = context.Queue()
+        process = context.Process(target=run, args=(mode, queue))
+        process.start()
+        mode, elapsed, peak_mb, out_bytes = queue.get()
+        process.join()
+        print(f"{mode:>10}: {size}px x{factor} in {elapsed:.2f}s "
+              f"({pixels / elapsed / 1e6:.1f} Mpx/s), peak RSS +{peak_mb:.0f} MB, {out_bytes / 1e6:.1f} MB PNG")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,321 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from models import ProcessedEvent, create_schema
+from subscription import update_user_subscription, add_user_credits
+import metrics
+
+WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8502'))
+SIGNATURE_TOLERANCE_SECONDS = 300
+
+# Events are applied in batches: one transaction per flush
+BATCH_SIZE = 500
+FLUSH_INTERVAL_SECONDS = 0.05
+ACK_TIMEOUT_SECONDS = 10
+
+
+class SignatureError(ValueError):
+    """Raised when a webhook payload fails Stripe signature verification"""
+
+
+def sign_payload(payload: bytes, secret: str, timestamp: int = None) -> str:
+    """Build a Stripe-Signature header for a payload (local stand-in for Stripe)"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f"{timestamp}.".encode('utf-8') + payload
+    digest = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify_signature(payload: bytes, header: str, secret: str,
+                     tolerance: int = SIGNATURE_TOLERANCE_SECONDS) -> dict:
+    """Check a Stripe-Signature header and return the decoded event"""
+    if not secret:
+        raise SignatureError("STRIPE_WEBHOOK_SECRET is not configured")
+    timestamp = None
+    signatures = []
+    for part in (header or '').split(','):
+        key, _, value = part.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        raise SignatureError("Malformed Stripe-Signature header")
+    if abs(time.time() - int(timestamp)) > tolerance:
+        raise SignatureError("Timestamp outside the tolerance window")
+
+    signed = f"{timestamp}.".encode('utf-8') + payload
+    expected = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise SignatureError("No signatures match the expected signature")
+    return json.loads(payload)
+
+
+def apply_event(db, event: dict) -> str:
+    """Apply one Stripe event inside the caller's transaction; returns its status"""
+    if event.get('type') != 'checkout.session.completed':
+        return 'ignored'
+
+    session = event['data']['object']
+    metadata = session.get('metadata') or {}
+    user_id = int(session['client_reference_id'])
+    if metadata.get('plan_id'):
+        update_user_subscription(db, user_id, metadata['plan_id'], commit=False)
+    elif metadata.get('package_id'):
+        add_user_credits(db, user_id, metadata['package_id'], commit=False)
+    else:
+        return 'ignored'
+    return 'applied'
+
+
+class _Pending:
+    __slots__ = ('event', 'done', 'error')
+
+    def __init__(self, event: dict):
+        self.event = event
+        self.done = threading.Event()
+        self.error = None
+
+
+class WebhookIngestor:
+    """Queue verified events and apply them in batched, idempotent transactions"""
+
+    def __init__(self, session_factory, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='webhook-ingestor', daemon=True)
+        self._thread.start()
+
+    def submit(self, event: dict) -> _Pending:
+        """Enqueue an event; wait on the result's `done` for it to be committed"""
+        pending = _Pending(event)
+        self._queue.put(pending)
+        return pending
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        error = None
+        for _ in range(2):
+            try:
+                with metrics.span("webhook.flush"):
+                    self._apply_batch(batch)
+                error = None
+                break
+            except IntegrityError as e:
+                # Another ingestor committed some of these event IDs first;
+                # retry so they are filtered out as duplicates
+                error = e
+            except Exception as e:
+                error = e
+                break
+        for pending in batch:
+            pending.error = error
+            pending.done.set()
+
+    def _apply_batch(self, batch: list):
+        db = self.session_factory()
+        try:
+            # Collapse retries that arrived in the same batch
+            events = {}
+            for pending in batch:
+                events.setdefault(pending.event['id'], pending.event)
+
+            seen = {
+                row.event_id for row in db.query(ProcessedEvent.event_id).filter(
+                    ProcessedEvent.event_id.in_(list(events)))
+            }
+            applied = 0
+            for event_id, event in events.items():
+                if event_id in seen:
+                    continue
+                try:
+                    status = apply_event(db, event)
+                except (KeyError, TypeError, ValueError):
+                    # Validation happens before any changes are made, so a bad
+                    # event can be recorded without rolling back the batch
+                    status = 'failed'
+                db.add(ProcessedEvent(event_id=event_id, event_type=event.get('type'), status=status))
+                applied += 1
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        metrics.inc("webhook_events_total", len(batch), outcome="received")
+        metrics.inc("webhook_events_total", applied, outcome="processed")
+        metrics.inc("webhook_events_total", len(batch) - applied, outcome="duplicate")
+        metrics.observe("webhook_batch_size", len(batch))
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Billing-day spikes arrive as bursts of concurrent deliveries
+    request_queue_size = 256
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/stripe/webhook':
+            self.send_error(404)
+            return
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            event = verify_signature(payload, self.headers.get('Stripe-Signature'), self.server.secret)
+        except (SignatureError, json.JSONDecodeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        if not event.get('id'):
+            self._reply(400, {'error': 'Event has no id'})
+            return
+
+        # Only acknowledge once the event is durably committed, so Stripe
+        # retries anything lost to a crash or a failed flush
+        pending = self.server.ingestor.submit(event)
+        if not pending.done.wait(ACK_TIMEOUT_SECONDS) or pending.error:
+            self._reply(500, {'error': 'Event not committed'})
+            return
+        self._reply(200, {'received': True})
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_webhook_server(database_url: str, port: int = WEBHOOK_PORT, host: str = '127.0.0.1',
+                         secret: str = None):
+    """Start the webhook endpoint in a background thread and return the server"""
+    engine = create_schema(create_engine(database_url))
+    server = WebhookServer((host, port), WebhookHandler)
+    server.secret = WEBHOOK_SECRET if secret is None else secret
+    server.ingestor = WebhookIngestor(sessionmaker(bind=engine, autoflush=False))
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    return server
+
+
+def replay_benchmark(events: int = 5000, duplicate_rate: float = 0.3, users: int = 200, workers: int = 32):
+    """Replay signed checkout events with duplicates and check nothing is double-credited"""
+    import random
+    import tempfile
+    import urllib.error
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from models import User
+    from subscription import CREDIT_PACKAGES
+
+    secret = 'whsec_local'
+    url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'webhooks.db')}"
+    server = start_webhook_server(url, port=0, secret=secret)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/stripe/webhook"
+    db = server.ingestor.session_factory()
+    db.add_all([User(email=f"user{i}@example.com", credits_remaining=0) for i in range(users)])
+    db.commit()
+    user_ids = [user.id for user in db.query(User)]
+
+    rng = random.Random(0)
+    unique = []
+    for i in range(events):
+        package_id = rng.choice(list(CREDIT_PACKAGES))
+        unique.append({
+            'id': f"evt_{i}",
+            'type': 'checkout.session.completed',
+            'data': {'object': {'client_reference_id': str(rng.choice(user_ids)),
+                                'metadata': {'package_id': package_id}}},
+        })
+    deliveries = unique + rng.sample(unique, int(events * duplicate_rate))
+    rng.shuffle(deliveries)
+
+    def deliver(event):
+        payload = json.dumps(event).encode('utf-8')
+        request = urllib.request.Request(endpoint, data=payload, method='POST', headers={
+            'Content-Type': 'application/json', 'Stripe-Signature': sign_payload(payload, secret)})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        statuses = list(pool.map(deliver, deliveries))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.ingestor.stop()
+
+    expected = sum(CREDIT_PACKAGES[e['data']['object']['metadata']['package_id']]['credits'] for e in unique)
+    db.expire_all()
+    credited = sum(user.credits_remaining for user in db.query(User))
+    counters = metrics.counter_values()
+    processed = counters.get('webhook_events_total{outcome="processed"}', 0)
+    skipped = counters.get('webhook_events_total{outcome="duplicate"}', 0)
+    batches = sum(row['count'] for row in metrics.stage_summary() if row['stage'] == 'webhook.flush')
+    print(f"{len(deliveries)} deliveries ({len(deliveries) - events} duplicates) in {elapsed:.2f}s "
+          f"= {len(deliveries) / elapsed:.0f} events/s over {batches} transactions")
+    print(f"non-200 responses: {sum(1 for s in statuses if s != 200)}")
+    print(f"credits granted: {credited} (expected {expected})")
+    print(f"processed: {processed:.0f}, duplicates skipped: {skipped:.0f}")
+    if credited != expected:
+        raise SystemExit("Duplicate deliveries changed the credit balance")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stripe webhook ingestion service")
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--events', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        replay_benchmark(args.events)
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        server = start_webhook_server(os.environ['DATABASE_URL'], args.port)
+        print(f"Listening for Stripe webhooks on http://127.0.0.1:{server.server_address[1]}/stripe/webhook")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+            server.ingestor.stop()